@@ -0,0 +1,388 @@
+import asyncio
+import codecs
+import ssl
+import time
+from collections import namedtuple
+from contextlib import asynccontextmanager
+from pathlib import Path
+
+import client
+from client import SERVER_HOST, SERVER_PORT, TRANSFER_BUFFER_SIZE, create_client_context, parse_facts
+from protocol import set_nodelay
+
+# Seconds a command may take, and a listing or transfer may go without progress, before it is abandoned
+OPERATION_TIMEOUT = 60
+# Operations run_bounded keeps in flight at once
+DEFAULT_CONCURRENCY = 32
+# Logged-in sessions an AsyncFTPClientPool keeps open
+POOL_SIZE = 8
+
+
+class Reply(namedtuple("Reply", "code text")):
+    """A server reply: the three-digit code and the full text, multi-line replies joined by newlines."""
+
+    @property
+    def ok(self):
+        return self.code < 400
+
+
+# Result of a RETR/STOR: the remote path, bytes moved and seconds taken
+Transfer = namedtuple("Transfer", "path size elapsed")
+
+
+class FTPError(Exception):
+    """The server answered an operation with an error reply."""
+
+    def __init__(self, reply):
+        super().__init__(reply.text)
+        self.reply = reply
+
+
+class AsyncFTPClient:
+    """FTP client on asyncio that returns replies and results instead of printing them.
+
+    One instance is one session; its operations are serialised on the control
+    connection. Run many sessions side by side, e.g. with `run_bounded`, to fan
+    out transfers. A command that takes longer than `timeout`, or a listing or
+    transfer that stalls for that long, raises asyncio.TimeoutError and closes
+    the session, since its control connection is no longer in step. Transfers
+    that keep moving data may take as long as they need; only the end of an
+    upload, while the server reads what is still buffered in the connection,
+    counts as one step.
+    """
+
+    def __init__(self, host=SERVER_HOST, port=SERVER_PORT, timeout=OPERATION_TIMEOUT):
+        self.host = host
+        self.port = port
+        self.timeout = timeout
+        self.context = create_client_context()
+        self.reader = None
+        self.writer = None
+        self.lock = asyncio.Lock()
+        self.authenticated = False
+
+    async def __aenter__(self):
+        await self.connect()
+        return self
+
+    async def __aexit__(self, exc_type, exc, tb):
+        if self.writer is not None and exc_type is None:
+            await self.quit()
+        self.close()
+
+    async def connect(self, username=None, password=None):
+        """Open the control connection, read the greeting and log in if credentials are given."""
+        self.reader, self.writer = await asyncio.wait_for(
+            asyncio.open_connection(self.host, self.port, ssl=self.context, server_hostname=SERVER_HOST),
+            self.timeout)
+        set_nodelay(self.writer.get_extra_info("socket"))
+        greeting = await self._run(self._read_reply)
+        if not greeting.ok:
+            self.close()
+            raise FTPError(greeting)
+        if username is not None:
+            await self.login(username, password)
+        return greeting
+
+    def close(self):
+        """Drop the control connection without QUIT."""
+        if self.writer is not None:
+            self.writer.close()
+            self.writer = None
+
+    async def _run(self, operation, *args, transfer=False):
+        """Run one operation alone on the control connection.
+
+        A command has to finish within the timeout. A `transfer` has no overall
+        deadline; it bounds each of its steps with `_step` instead.
+        """
+        async with self.lock:
+            if self.writer is None:
+                raise ConnectionError("Not connected.")
+            try:
+                if transfer:
+                    return await operation(*args)
+                return await asyncio.wait_for(operation(*args), self.timeout)
+            except asyncio.TimeoutError:
+                self.close()
+                raise
+
+    def _step(self, awaitable):
+        """Bound one step of a transfer (a reply, a read, a write) by the timeout."""
+        return asyncio.wait_for(awaitable, self.timeout)
+
+    async def _read_reply(self):
+        """Read one reply, following RFC 959 multi-line replies."""
+        line = await self._read_line()
+        lines = [line]
+        if line[3:4] == "-":
+            last = line[:3] + " "
+            while not line.startswith(last):
+                line = await self._read_line()
+                lines.append(line)
+        return Reply(int(lines[0][:3]), "\n".join(lines))
+
+    async def _read_line(self):
+        line = await self.reader.readline()
+        if not line:
+            raise ConnectionError("Control connection closed.")
+        return line.decode().rstrip("\r\n")
+
+    async def _command(self, command):
+        self.writer.write(f"{command}\r\n".encode())
+        await self.writer.drain()
+        return await self._read_reply()
+
+    async def _expect(self, command):
+        """Send a command and return its reply, raising FTPError for an error reply."""
+        reply = await self._command(command)
+        if not reply.ok:
+            raise FTPError(reply)
+        return reply
+
+    async def _open_data(self, command):
+        """Send a transfer command and connect to the passive port its 227 reply announces."""
+        reply = await self._expect(command)
+        if reply.code != 227:
+            raise FTPError(reply)
+        parts = reply.text.split("(")[1].split(")")[0].split(",")
+        port = int(parts[4]) * 256 + int(parts[5])
+        data_reader, data_writer = await asyncio.open_connection(self.host, port, ssl=self.context,
+                                                                 server_hostname=SERVER_HOST)
+        set_nodelay(data_writer.get_extra_info("socket"))
+        return data_reader, data_writer
+
+    async def _close_data(self, data_writer):
+        data_writer.close()
+        try:
+            await data_writer.wait_closed()
+        except (ConnectionError, ssl.SSLError):
+            pass
+
+    async def command(self, command):
+        """Send any single-reply command and return its Reply, errors included."""
+        return await self._run(self._command, command)
+
+    async def login(self, username, password):
+        """Log in; raises FTPError if the server refuses."""
+        await self._run(self._expect, f"USER {username}")
+        reply = await self._run(self._expect, f"PASS {password}")
+        self.authenticated = True
+        return reply
+
+    async def _lines(self, command):
+        data_reader, data_writer = await self._step(self._open_data(command))
+        decoder = codecs.getincrementaldecoder("utf-8")()
+        parts = []
+        try:
+            while chunk := await self._step(data_reader.read(TRANSFER_BUFFER_SIZE)):
+                parts.append(decoder.decode(chunk))
+            parts.append(decoder.decode(b"", final=True))
+        finally:
+            await self._step(self._close_data(data_writer))
+        data = "".join(parts)
+        reply = await self._step(self._read_reply())
+        if not reply.ok:
+            raise FTPError(reply)
+        return [line for line in data.split("\r\n") if line]
+
+    async def list(self, path=" "):
+        """Return the lines of a LIST reply."""
+        return await self._run(self._lines, f"LIST {path}", transfer=True)
+
+    async def mlsd(self, path="."):
+        """Return the entries of an MLSD reply as dicts of facts plus "name"."""
+        return [parse_facts(line) for line in await self._run(self._lines, f"MLSD {path}", transfer=True)]
+
+    async def _retrieve(self, file_path, destination_path):
+        loop = asyncio.get_running_loop()
+        started = time.perf_counter()
+        data_reader, data_writer = await self._step(self._open_data(f"RETR {file_path}"))
+        size = 0
+        try:
+            reply = await self._step(self._read_reply())
+            if reply.code != 150:
+                raise FTPError(reply)
+            f = await loop.run_in_executor(None, open, destination_path, "wb")
+            try:
+                while data := await self._step(data_reader.read(TRANSFER_BUFFER_SIZE)):
+                    await loop.run_in_executor(None, f.write, data)
+                    size += len(data)
+            finally:
+                f.close()
+        finally:
+            await self._step(self._close_data(data_writer))
+        reply = await self._step(self._read_reply())
+        if not reply.ok:
+            raise FTPError(reply)
+        return Transfer(file_path, size, time.perf_counter() - started)
+
+    async def retrieve(self, file_path, destination_path=None):
+        """Download a file, by default into the download directory; return a Transfer."""
+        if destination_path is None:
+            destination_path = client.download_dir() / file_path.split("\\")[-1]
+        return await self._run(self._retrieve, file_path, Path(destination_path), transfer=True)
+
+    async def _store(self, file_path, destination_path):
+        loop = asyncio.get_running_loop()
+        started = time.perf_counter()
+        data_reader, data_writer = await self._step(self._open_data(f"STOR {file_path.name} {destination_path}"))
+        size = 0
+        try:
+            reply = await self._step(self._read_reply())
+            if reply.code != 150:
+                raise FTPError(reply)
+            f = await loop.run_in_executor(None, open, file_path, "rb")
+            try:
+                while data := await loop.run_in_executor(None, f.read, TRANSFER_BUFFER_SIZE):
+                    data_writer.write(data)
+                    await self._step(data_writer.drain())
+                    size += len(data)
+            finally:
+                f.close()
+        finally:
+            # Closing sends close_notify and waits for the server's, so no queued data is lost
+            await self._step(self._close_data(data_writer))
+        reply = await self._step(self._read_reply())
+        if not reply.ok:
+            raise FTPError(reply)
+        return Transfer(f"{destination_path}/{file_path.name}", size, time.perf_counter() - started)
+
+    async def store(self, file_path, destination_path="Uploads"):
+        """Upload a local file (relative to the client base directory) into a remote directory; return a Transfer."""
+        return await self._run(self._store, client.BASE_DIR / file_path, destination_path, transfer=True)
+
+    async def delete(self, file_path):
+        return await self._run(self._expect, f"DELE {file_path}")
+
+    async def mkdir(self, directory_path):
+        return await self._run(self._expect, f"MKD {directory_path}")
+
+    async def rmdir(self, directory_path):
+        return await self._run(self._expect, f"RMD {directory_path}")
+
+    async def rename(self, from_path, to_path):
+        """Rename or move a remote file or directory (RNFR/RNTO)."""
+        async def rename():
+            await self._expect(f"RNFR {from_path}")
+            return await self._expect(f"RNTO {to_path}")
+        return await self._run(rename)
+
+    async def copy(self, source_path, destination_path):
+        """Copy a remote file on the server side."""
+        return await self._run(self._expect, f"COPY {source_path} {destination_path}")
+
+    async def cwd(self, path):
+        return await self._run(self._expect, f"CWD {path}")
+
+    async def cdup(self):
+        return await self._run(self._expect, "CDUP")
+
+    async def pwd(self):
+        """Return the current remote directory."""
+        reply = await self._run(self._expect, "PWD")
+        return reply.text.split('"')[1]
+
+    async def size(self, path):
+        """Return the size of a remote file in bytes."""
+        reply = await self._run(self._expect, f"SIZE {path}")
+        return int(reply.text[4:].strip())
+
+    async def mfmt(self, path, mtime):
+        """Set the modification time of a remote file from a POSIX timestamp."""
+        modify = time.strftime("%Y%m%d%H%M%S", time.gmtime(mtime))
+        return await self._run(self._expect, f"MFMT {modify} {path}")
+
+    async def quit(self):
+        """Send QUIT and close the control connection."""
+        try:
+            return await self._run(self._command, "QUIT")
+        finally:
+            self.close()
+
+
+class AsyncFTPClientPool:
+    """Logged-in AsyncFTPClient sessions kept open and lent out one at a time.
+
+    At most `size` sessions exist; a borrower waits for a free one, and only
+    opens a new connection (TLS handshake plus login) while the pool is below
+    `size`. A session that failed with anything but an FTP error reply is
+    dropped rather than returned, since its control connection may be out of step.
+    """
+
+    def __init__(self, host, port, username, password, size=POOL_SIZE, timeout=OPERATION_TIMEOUT):
+        self.host = host
+        self.port = port
+        self.credentials = (username, password)
+        self.size = size
+        self.timeout = timeout
+        self._slots = asyncio.Semaphore(size)
+        self._idle = []
+        self.opened = 0
+        self.reused = 0
+
+    async def __aenter__(self):
+        return self
+
+    async def __aexit__(self, exc_type, exc, tb):
+        await self.close()
+
+    @asynccontextmanager
+    async def session(self):
+        """Borrow a logged-in session for the duration of an `async with` block."""
+        async with self._slots:
+            if self._idle:
+                session = self._idle.pop()
+                self.reused += 1
+            else:
+                session = AsyncFTPClient(self.host, self.port, self.timeout)
+                await session.connect(*self.credentials)
+                self.opened += 1
+
+            try:
+                yield session
+            except FTPError:
+                self._keep(session)
+                raise
+            except BaseException:
+                session.close()
+                raise
+            else:
+                self._keep(session)
+
+    def _keep(self, session):
+        if session.writer is not None:
+            self._idle.append(session)
+
+    async def close(self):
+        """Quit every idle session."""
+        idle, self._idle = self._idle, []
+        for session in idle:
+            try:
+                await session.quit()
+            except (ConnectionError, OSError, ssl.SSLError, asyncio.TimeoutError):
+                pass
+
+    def stats(self):
+        """Return how many sessions were opened and how many borrows reused one."""
+        return {"size": self.size, "idle": len(self._idle), "opened": self.opened, "reused": self.reused}
+
+
+async def run_bounded(operations, concurrency=DEFAULT_CONCURRENCY, timeout=None):
+    """Run operations (callables returning coroutines) with at most `concurrency` in flight.
+
+    Each operation gets `timeout` seconds if given; by default only the
+    sessions' own timeouts apply, so long transfers are not cut off. Results
+    come back in order; an operation that failed or timed out yields its
+    exception instead.
+    """
+    semaphore = asyncio.Semaphore(concurrency)
+
+    async def run(operation):
+        async with semaphore:
+            try:
+                return await asyncio.wait_for(operation(), timeout)
+            except (FTPError, ConnectionError, OSError, ssl.SSLError, asyncio.TimeoutError) as e:
+                return e
+
+    return await asyncio.gather(*(run(operation) for operation in operations))
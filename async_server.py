@@ -0,0 +1,637 @@
+import asyncio
+import logging
+import os
+import ssl
+from concurrent.futures import ThreadPoolExecutor
+
+import metrics
+import server
+from bulk import HEADER, END_OF_ARCHIVE, pack_entry, collect_files, destination
+from compression import DEFAULT_METHOD, DEFAULT_LEVELS, Compressor, Decompressor, announce
+from delta import block_size_for, iter_signature, apply_delta
+from digests import DEFAULT_ALGORITHM
+from logs import new_session_id
+from protocol import set_nodelay
+from storage import Upload
+from server import FTPServer, SERVER_HOST, TRANSFER_BUFFER_SIZE, PASV_LEASE_TIMEOUT, MAX_WORKERS, LISTEN_BACKLOG, \
+    HANDSHAKE_TIMEOUT, CONTROL_IDLE_TIMEOUT, DATA_ACCEPT_TIMEOUT, DATA_IDLE_TIMEOUT, user_data, listing_cache, \
+    file_cache, digest_index, COMMANDS, is_allowed, missing_arguments
+
+log = logging.getLogger("ftp.server")
+
+
+def invalidate_caches(path, subtree=False):
+    """Drop `path` from the shared caches; blocking (the digest index is SQLite), so run it in the executor."""
+    listing_cache.invalidate(path, subtree=subtree)
+    digest_index.invalidate(path, subtree=subtree)
+    file_cache.invalidate(path, subtree=subtree)
+
+
+class _ReplyBuffer:
+    """Collect the replies a blocking handler sends so they can be written to a stream."""
+
+    def __init__(self):
+        self.data = b""
+
+    def send(self, data):
+        self.data += data
+        return len(data)
+
+
+class AsyncFTPServer(FTPServer):
+    """FTP server that runs every control and data channel on one asyncio event loop.
+
+    Sessions are coroutines instead of threads; filesystem work is handed to the
+    loop's default executor so a slow disk never stalls the other sessions.
+    """
+
+    async def start(self):
+        """Start the FTP server and serve clients until cancelled."""
+        # Blocking filesystem work shares one bounded pool instead of the loop's default size
+        asyncio.get_running_loop().set_default_executor(
+            ThreadPoolExecutor(max_workers=MAX_WORKERS, thread_name_prefix="ftp-blocking"))
+        if self.metrics_port:
+            metrics.serve_metrics(SERVER_HOST, self.metrics_port)
+        control_server = await asyncio.start_server(self.handle_client, self.host, self.port, ssl=self.context,
+                                                    ssl_handshake_timeout=HANDSHAKE_TIMEOUT, backlog=LISTEN_BACKLOG,
+                                                    reuse_port=self.reuse_port or None)
+        log.info("Server started at %s:%s (asyncio engine)", self.host, self.port)
+        async with control_server:
+            await control_server.serve_forever()
+
+    def session_limit(self):
+        """Sessions are coroutines, so the limit is ASYNC_MAX_SESSIONS rather than the thread pool size."""
+        return server.ASYNC_MAX_SESSIONS
+
+    async def reply(self, writer, message):
+        """Send a reply on a control or data stream."""
+        writer.write(message)
+        await writer.drain()
+
+    async def run_blocking(self, writer, handler, *args):
+        """Run a blocking control-channel handler in the executor, forward its replies and return its result."""
+        replies = _ReplyBuffer()
+        result = await asyncio.get_running_loop().run_in_executor(None, handler, replies, *args)
+        await self.reply(writer, replies.data)
+        return result
+
+    async def open_data_channel(self, writer):
+        """Lease a passive port, announce it and return the TLS streams of the client's data connection.
+
+        Returns (data_reader, data_writer), or Nones when no passive port is free or the client
+        does not connect within DATA_ACCEPT_TIMEOUT. The listener goes back to the pool as soon
+        as the connection is accepted.
+        """
+        loop = asyncio.get_running_loop()
+        listener = await loop.run_in_executor(None, self.data_ports.lease, PASV_LEASE_TIMEOUT)
+        if listener is None:
+            await self.reply(writer, b"425 Can't open data connection: no passive ports free.\r\n")
+            return None, None
+
+        try:
+            listener.setblocking(False)
+            port = listener.getsockname()[1]
+
+            # Send Passive Mode response with the leased port
+            await self.reply(writer, f"227 Entering Passive Mode (127,0,0,1,{port // 256},{port % 256})\r\n".encode())
+
+            # Wait for this session's client to connect to the data port
+            conn = await asyncio.wait_for(self.accept_data(listener, writer.get_extra_info("peername")[0]),
+                                          DATA_ACCEPT_TIMEOUT)
+        except asyncio.TimeoutError:
+            await self.reply(writer, b"425 Can't open data connection: timed out waiting for the client.\r\n")
+            return None, None
+        finally:
+            self.data_ports.release(listener)
+
+        data_reader = asyncio.StreamReader()
+        protocol = asyncio.StreamReaderProtocol(data_reader)
+        started = loop.time()
+        transport, _ = await loop.connect_accepted_socket(lambda: protocol, conn, ssl=self.context,
+                                                          ssl_handshake_timeout=HANDSHAKE_TIMEOUT)
+        metrics.tls_handshakes.observe(loop.time() - started, "data")
+        self.record_data_handshake(transport.get_extra_info("ssl_object"))
+        metrics.data_channels.inc()
+        return data_reader, asyncio.StreamWriter(transport, protocol, data_reader, loop)
+
+    async def accept_data(self, listener, peer_host):
+        """Accept the data connection of the session that leased `listener`."""
+        loop = asyncio.get_running_loop()
+        while True:
+            conn, address = await loop.sock_accept(listener)
+            if self.data_ports.is_session_peer(address, peer_host):
+                set_nodelay(conn)
+                return conn
+            conn.close()
+
+    async def throttle(self, channel, size):
+        """Sleep off the shaper's delay for `size` bytes just sent or received on `channel`."""
+        if self.shaper.enabled:
+            wait = channel.delay(size)
+            if wait:
+                await asyncio.sleep(wait)
+
+    async def close_data_channel(self, data_writer):
+        """Close the data streams."""
+        metrics.data_channels.dec()
+        data_writer.close()
+        try:
+            await data_writer.wait_closed()
+        except (ConnectionError, ssl.SSLError):
+            pass
+
+    async def handle_list(self, writer, path=" ", machine=False, compression=None):
+        """Handle the LIST command to list files with detailed information."""
+        loop = asyncio.get_running_loop()
+        direction = server.BASE_DIR / path
+        is_dir = await loop.run_in_executor(None, direction.is_dir)
+        if machine and not is_dir:
+            await self.reply(writer, b"550 Directory not found.\r\n")
+            return
+
+        data_reader, data_writer = await self.open_data_channel(writer)
+        if data_writer is None:
+            return
+
+        try:
+            compressor = Compressor(*compression) if compression else None
+            if is_dir:
+                # Read the directory chunk by chunk in the executor and stream each one
+                chunks = self.cached_listing(direction, machine)
+                while chunk := await loop.run_in_executor(None, next, chunks, None):
+                    if compressor:
+                        chunk = await loop.run_in_executor(None, compressor.compress, chunk)
+                    await self.reply(data_writer, chunk)
+            else:
+                log.info("LIST of missing path %s", direction)
+            if compressor:
+                await self.reply(data_writer, compressor.flush())
+                self.compression_stats.record(compressor)
+        finally:
+            await self.close_data_channel(data_writer)
+        await self.reply(writer, b"226 Transfer complete.\r\n")
+
+    async def handle_retrieve(self, writer, file_path, offset=0, count=None, compression=None, user=None):
+        """Handle the RETR command to send a file to the client, limited to a REST/RANG range if given."""
+        loop = asyncio.get_running_loop()
+        file_full_path = server.BASE_DIR / file_path
+
+        if not await loop.run_in_executor(None, file_full_path.is_file):
+            await self.reply(writer, b"550 File not found.\r\n")
+            return
+        size = count if count is not None else (await loop.run_in_executor(None, file_full_path.stat)).st_size - offset
+
+        data_reader, data_writer = await self.open_data_channel(writer)
+        if data_writer is None:
+            return
+        compression = self.select_compression(file_full_path, compression)
+        compressor = Compressor(*compression) if compression else None
+        await self.reply(writer, f"150 Opening data connection"
+                                 f"{announce(compression[0]) if compression else ''}.\r\n".encode())
+
+        try:
+            # Take the read lock off the loop: it may have to wait for a writer
+            key = await loop.run_in_executor(None, server.path_locks.acquire_read, file_full_path)
+            try:
+                # Hot files are sent as slices of the cached bytes, everything else is read from disk
+                data = await loop.run_in_executor(None, self.hot_file, file_full_path)
+                f = await loop.run_in_executor(None, open, file_full_path, "rb") if data is None else None
+                try:
+                    if f is not None:
+                        f.seek(offset)
+                    position = offset
+                    remaining = count
+                    with self.shaped(user, size) as channel, metrics.transfer("RETR") as transfer:
+                        while remaining is None or remaining > 0:
+                            read_size = TRANSFER_BUFFER_SIZE if remaining is None else min(TRANSFER_BUFFER_SIZE,
+                                                                                           remaining)
+                            if f is None:
+                                chunk = memoryview(data)[position:position + read_size]
+                            else:
+                                chunk = await loop.run_in_executor(None, f.read, read_size)
+                            if not chunk:
+                                break
+                            position += len(chunk)
+                            if remaining is not None:
+                                remaining -= len(chunk)
+                            if compressor:
+                                chunk = await loop.run_in_executor(None, compressor.compress, chunk)
+                            await self.reply(data_writer, chunk)
+                            await self.throttle(channel, len(chunk))
+                        if compressor:
+                            await self.reply(data_writer, compressor.flush())
+                            self.compression_stats.record(compressor)
+                        transfer.bytes = position - offset
+                finally:
+                    if f is not None:
+                        f.close()
+            finally:
+                server.path_locks.release_read(key)
+        finally:
+            await self.close_data_channel(data_writer)
+        await self.reply(writer, b"226 Transfer complete.\r\n")
+
+    async def handle_store(self, writer, file_name, file_path="Uploads", offset=0, compression=None, size=None,
+                           user=None):
+        """Handle the STOR command to receive and store a file from the client, from a REST offset if given.
+
+        As in the threaded engine the data goes to a storage.Upload and a new
+        file only replaces the target once complete.
+        """
+        loop = asyncio.get_running_loop()
+        upload_dir = server.BASE_DIR / file_path
+        await loop.run_in_executor(None, lambda: upload_dir.mkdir(exist_ok=True))
+        file_path = upload_dir / file_name
+
+        current_size = await loop.run_in_executor(None, lambda: file_path.stat().st_size if file_path.is_file() else -1)
+        if offset and current_size < offset:
+            await self.reply(writer, b"554 Restart offset is beyond the end of the file.\r\n")
+            return
+
+        try:
+            upload = await loop.run_in_executor(None, Upload, file_path, offset, size, self.fsync_policy)
+        except OSError as e:
+            await self.reply(writer, f"452 Cannot store file: {e.strerror}\r\n".encode())
+            return
+
+        try:
+            data_reader, data_writer = await self.open_data_channel(writer)
+            if data_writer is None:
+                return
+            compression = self.select_compression(file_name, compression)
+            decompressor = Decompressor(compression[0]) if compression else None
+            await self.reply(writer, f"150 Opening data connection"
+                                 f"{announce(compression[0]) if compression else ''}.\r\n".encode())
+
+            try:
+                # A resumed upload writes into the file itself and locks it throughout
+                key = await loop.run_in_executor(None, server.path_locks.acquire_write, file_path) if offset else None
+                try:
+                    # A stalled upload raises TimeoutError instead of holding the session forever
+                    with self.shaped(user, size) as channel, metrics.transfer("STOR") as transfer:
+                        while data := await asyncio.wait_for(data_reader.read(TRANSFER_BUFFER_SIZE),
+                                                             DATA_IDLE_TIMEOUT):
+                            if decompressor:
+                                transfer.bytes += await loop.run_in_executor(
+                                    None, lambda: sum(map(upload.write, decompressor.iter_decompress(data))))
+                            else:
+                                transfer.bytes += await loop.run_in_executor(None, upload.write, data)
+                            await self.throttle(channel, len(data))
+                        if decompressor:
+                            decompressor.finish()
+                            self.compression_stats.record(decompressor)
+                        await loop.run_in_executor(None, upload.finish)
+                finally:
+                    if key is not None:
+                        server.path_locks.release_write(key)
+
+                def commit():
+                    upload.commit()
+                    invalidate_caches(file_path)
+
+                key = await loop.run_in_executor(None, server.path_locks.acquire_write, file_path)
+                try:
+                    await loop.run_in_executor(None, commit)
+                finally:
+                    server.path_locks.release_write(key)
+            except OSError as e:
+                await self.reply(writer, f"451 Upload aborted: {e}\r\n".encode())
+                return
+            finally:
+                await self.close_data_channel(data_writer)
+        finally:
+            await loop.run_in_executor(None, upload.discard)
+
+        await self.reply(writer, b"226 Transfer complete.\r\n")
+
+    async def handle_bulk_retrieve(self, writer, paths, user=None):
+        """Handle MRET: send files and whole directories as one archive on one data connection."""
+        loop = asyncio.get_running_loop()
+        entries = await loop.run_in_executor(None, collect_files, server.BASE_DIR, paths)
+        if not entries:
+            await self.reply(writer, b"550 No files found.\r\n")
+            return
+
+        data_reader, data_writer = await self.open_data_channel(writer)
+        if data_writer is None:
+            return
+        await self.reply(writer, f"150 Sending {len(entries)} files as an archive.\r\n".encode())
+
+        files = 0
+        total = 0
+        try:
+            with self.shaped(user) as channel, metrics.transfer("MRET") as transfer:
+                for file_path, name in entries:
+                    key = await loop.run_in_executor(None, server.path_locks.acquire_read, file_path)
+                    try:
+                        try:
+                            f = await loop.run_in_executor(None, open, file_path, "rb")
+                        except FileNotFoundError:
+                            continue  # removed since the list was made
+                        try:
+                            stats = os.fstat(f.fileno())
+                            await self.reply(data_writer, pack_entry(name, stats.st_size, stats.st_mtime_ns))
+                            remaining = stats.st_size
+                            while remaining:
+                                chunk = await loop.run_in_executor(None, f.read, min(TRANSFER_BUFFER_SIZE, remaining))
+                                if not chunk:
+                                    raise OSError(f"{name} shrank while it was being sent.")
+                                await self.reply(data_writer, chunk)
+                                await self.throttle(channel, len(chunk))
+                                remaining -= len(chunk)
+                        finally:
+                            f.close()
+                    finally:
+                        server.path_locks.release_read(key)
+                    files += 1
+                    total += stats.st_size
+                await self.reply(data_writer, END_OF_ARCHIVE)
+                transfer.bytes = total
+        finally:
+            await self.close_data_channel(data_writer)
+        await self.reply(writer, f"226 Transfer complete: {files} files, {total} bytes.\r\n".encode())
+
+    async def handle_bulk_store(self, writer, directory_path, user=None):
+        """Handle MSTR: unpack an archive from one data connection into a directory."""
+        loop = asyncio.get_running_loop()
+        target = server.BASE_DIR / directory_path
+        await loop.run_in_executor(None, lambda: target.mkdir(parents=True, exist_ok=True))
+
+        data_reader, data_writer = await self.open_data_channel(writer)
+        if data_writer is None:
+            return
+        await self.reply(writer, b"150 Ready to receive archive.\r\n")
+
+        try:
+            with self.shaped(user) as channel, metrics.transfer("MSTR") as transfer:
+                files, total = await self.read_archive(data_reader, target, channel)
+                transfer.bytes = total
+        except (asyncio.IncompleteReadError, OSError, ValueError) as e:
+            await self.reply(writer, f"451 Bulk transfer aborted: {e}\r\n".encode())
+            return
+        finally:
+            await self.close_data_channel(data_writer)
+            await loop.run_in_executor(None, lambda: invalidate_caches(target, subtree=True))
+        await self.reply(writer, f"226 Transfer complete: {files} files, {total} bytes.\r\n".encode())
+
+    async def read_archive(self, data_reader, root, channel):
+        """Unpack a bulk archive from a data stream below `root` as it arrives; return (files, bytes).
+
+        Each file goes through a storage.Upload, as in the threaded engine, and
+        only replaces its target once complete. The data is shaped on the
+        shaper `channel` of the transfer.
+        """
+        loop = asyncio.get_running_loop()
+        files = 0
+        total = 0
+        while True:
+            name_length, size, mtime_ns = HEADER.unpack(await data_reader.readexactly(HEADER.size))
+            if not name_length:
+                return files, total
+            file_path = destination(root, (await data_reader.readexactly(name_length)).decode())
+            await loop.run_in_executor(None, lambda: file_path.parent.mkdir(parents=True, exist_ok=True))
+
+            upload = await loop.run_in_executor(None, lambda: Upload(file_path, size=size,
+                                                                     fsync_policy=self.fsync_policy))
+            try:
+                remaining = size
+                while remaining:
+                    data = await asyncio.wait_for(data_reader.read(min(TRANSFER_BUFFER_SIZE, remaining)),
+                                                  DATA_IDLE_TIMEOUT)
+                    if not data:
+                        raise ConnectionError("Data stream truncated.")
+                    await loop.run_in_executor(None, upload.write, data)
+                    await self.throttle(channel, len(data))
+                    remaining -= len(data)
+                await loop.run_in_executor(None, upload.finish)
+
+                key = await loop.run_in_executor(None, server.path_locks.acquire_write, file_path)
+                try:
+                    await loop.run_in_executor(None, upload.commit)
+                    await loop.run_in_executor(None, lambda: os.utime(file_path, ns=(mtime_ns, mtime_ns)))
+                finally:
+                    server.path_locks.release_write(key)
+            finally:
+                await loop.run_in_executor(None, upload.discard)
+            files += 1
+            total += size
+
+    async def handle_signature(self, writer, file_path):
+        """Handle XSIG: send the block signature of a file, the first step of a delta upload."""
+        loop = asyncio.get_running_loop()
+        file_full_path = server.BASE_DIR / file_path
+        if not await loop.run_in_executor(None, file_full_path.is_file):
+            await self.reply(writer, b"550 File not found.\r\n")
+            return
+
+        data_reader, data_writer = await self.open_data_channel(writer)
+        if data_writer is None:
+            return
+        await self.reply(writer, b"150 Sending signature.\r\n")
+
+        def signature():
+            with server.path_locks.read(file_full_path):
+                with open(file_full_path, "rb") as f:
+                    return b"".join(iter_signature(f, block_size_for(os.fstat(f.fileno()).st_size)))
+
+        try:
+            await self.reply(data_writer, await loop.run_in_executor(None, signature))
+        finally:
+            await self.close_data_channel(data_writer)
+        await self.reply(writer, b"226 Transfer complete.\r\n")
+
+    async def handle_delta(self, writer, file_name, file_path):
+        """Handle XDLT: rebuild an existing file from a delta against its signature.
+
+        The rebuild runs in the executor and pulls the delta off the data
+        stream through the event loop.
+        """
+        loop = asyncio.get_running_loop()
+        file_full_path = server.BASE_DIR / file_path / file_name
+        if not await loop.run_in_executor(None, file_full_path.is_file):
+            await self.reply(writer, b"550 File not found.\r\n")
+            return
+
+        data_reader, data_writer = await self.open_data_channel(writer)
+        if data_writer is None:
+            return
+        await self.reply(writer, b"150 Ready to receive delta.\r\n")
+
+        def read_exactly(size):
+            transfer.bytes += size  # delta bytes on the wire, not the size of the rebuilt file
+            future = asyncio.run_coroutine_threadsafe(
+                asyncio.wait_for(data_reader.readexactly(size), DATA_IDLE_TIMEOUT), loop)
+            try:
+                return future.result()
+            except asyncio.IncompleteReadError:
+                raise ConnectionError("Data stream truncated.")
+
+        def rebuild():
+            with server.path_locks.write(file_full_path):
+                size = apply_delta(read_exactly, file_full_path)
+                invalidate_caches(file_full_path)
+                return size
+
+        try:
+            with metrics.transfer("XDLT") as transfer:
+                size = await loop.run_in_executor(None, rebuild)
+        except (ConnectionError, ValueError) as e:
+            await self.reply(writer, f"451 Delta upload aborted: {e}\r\n".encode())
+            return
+        finally:
+            await self.close_data_channel(data_writer)
+        await self.reply(writer, f"226 Transfer complete: {size} bytes.\r\n".encode())
+
+    async def handle_client(self, reader, writer):
+        loop = asyncio.get_running_loop()
+        client_address = writer.get_extra_info("peername")
+        set_nodelay(writer.get_extra_info("socket"))
+        if not self.admit_session():
+            writer.write(b"421 Too many connections, try again later.\r\n")
+            writer.close()
+            return
+        # Fields every log record of this session carries
+        context = {"session": new_session_id(), "peer": f"{client_address[0]}:{client_address[1]}"}
+        log.info("Connection opened", extra=context)
+        authenticated = False
+        current_user = None
+        restart = (0, None)
+        renaming = None
+        allocation = None
+        mode = "S"
+        compression = (DEFAULT_METHOD, DEFAULT_LEVELS[DEFAULT_METHOD])
+        hash_algorithm = DEFAULT_ALGORITHM
+
+        try:
+            await self.reply(writer, b"220 FTP Server Ready\r\n")
+            while True:
+                # Commands are CRLF-framed; pipelined commands wait in the stream buffer
+                try:
+                    line = await asyncio.wait_for(reader.readline(), CONTROL_IDLE_TIMEOUT)
+                except asyncio.TimeoutError:
+                    await self.reply(writer, b"421 Idle timeout, closing control connection.\r\n")
+                    break
+                if not line:
+                    break
+                command = line.decode().rstrip("\r\n")
+                started = loop.time()
+                verb = command.split(" ")[0].strip().upper()
+
+                # A REST/RANG restart point only applies to the command right after it
+                (offset, count), restart = restart, (0, None)
+                # Likewise the path an RNFR names is only kept for the RNTO right after it,
+                # and the size an ALLO announces for the STOR right after it
+                rename_from, renaming = renaming, None
+                size, allocation = allocation, None
+                # Compression for this command's transfer: None in stream mode
+                z = compression if mode == "Z" else None
+
+                if missing_arguments(verb, command):
+                    await self.reply(writer, f"501 Syntax error: missing arguments for {verb}.\r\n".encode())
+                elif verb == "USER":
+                    username = command.split(" ")[1]
+                    if username in user_data:
+                        current_user = username
+                        await self.reply(writer, b"331 Username accepted, please enter your password.\r\n")
+                    else:
+                        await self.reply(writer, b"530 Invalid username. Please try again.\r\n")
+                elif verb == "PASS":
+                    if current_user:
+                        password = command.split(" ", 1)[1].strip()
+                        user_info = user_data[current_user]
+                        if user_info["password"] == password:
+                            if not authenticated and not self.admit_user(writer, current_user):
+                                await self.reply(writer, b"421 Too many sessions for this user, try again later.\r\n")
+                                break
+                            role = user_info["role"]
+                            await self.reply(writer, f"230-Login successful.\r\n"
+                                                     f"230 You are logged in as {current_user} "
+                                                     f"with role {role}.\r\n".encode())
+                            authenticated = True
+                            context["user"] = current_user
+                        else:
+                            await self.reply(writer, b"530 Invalid password. Please try again.\r\n")
+                    else:
+                        await self.reply(writer, b"530 Please enter a valid username first.\r\n")
+                elif verb == "QUIT":
+                    await self.reply(writer, b"221 Goodbye.\r\n")
+                    break
+                elif verb not in COMMANDS:
+                    await self.reply(writer, b"502 Command not implemented.\r\n")
+                elif not authenticated:
+                    await self.reply(writer, b"530 Not logged in.\r\n")
+                elif not is_allowed(user_data[current_user]["role"], verb):
+                    await self.reply(writer, b"530 Not allowed.\r\n")
+                elif verb == "LIST":
+                    await self.handle_list(writer, command.split(" ")[1], compression=z)
+                elif verb == "REST":
+                    restart = (await self.run_blocking(writer, self.handle_rest, command[4:].strip()), None)
+                elif verb == "RANG":
+                    restart = await self.run_blocking(writer, self.handle_rang, command[4:].strip())
+                elif verb == "ALLO":
+                    allocation = await self.run_blocking(writer, self.handle_allo, command[4:].strip())
+                elif verb == "SIZE":
+                    await self.run_blocking(writer, self.handle_size, command[4:].strip())
+                elif verb == "MDTM":
+                    await self.run_blocking(writer, self.handle_mdtm, command[4:].strip())
+                elif verb == "MODE":
+                    mode = await self.run_blocking(writer, self.handle_mode, command[4:]) or mode
+                elif verb == "OPTS" and command[4:].strip().upper().startswith("HASH"):
+                    hash_algorithm = await self.run_blocking(writer, self.handle_opts_hash, command[4:].strip()[4:],
+                                                             hash_algorithm)
+                elif verb == "OPTS":
+                    compression = await self.run_blocking(writer, self.handle_opts, command[4:].strip(), compression)
+                elif verb == "HASH":
+                    await self.run_blocking(writer, self.handle_hash, command[4:].strip(), hash_algorithm,
+                                            offset, count)
+                elif verb in ("XCRC", "XMD5"):
+                    await self.run_blocking(writer, self.handle_xhash, "CRC32" if verb == "XCRC" else "MD5",
+                                            command[4:].strip())
+                elif verb == "MFMT":
+                    await self.run_blocking(writer, self.handle_mfmt, command[4:].strip())
+                elif verb == "MLSD":
+                    await self.handle_list(writer, command[4:].strip() or ".", machine=True, compression=z)
+                elif verb == "RETR":
+                    await self.handle_retrieve(writer, command.split(" ")[1], offset, count, z, current_user)
+                elif verb == "STOR":
+                    await self.handle_store(writer, command.split(" ")[1], command.split(" ")[2], offset, z, size,
+                                            current_user)
+                elif verb == "MRET":
+                    await self.handle_bulk_retrieve(writer, command.split(" ")[1:], current_user)
+                elif verb == "MSTR":
+                    await self.handle_bulk_store(writer, command[4:].strip() or ".", current_user)
+                elif verb == "SITE":
+                    await self.run_blocking(writer, self.handle_site, command[4:].strip())
+                elif verb == "STAT":
+                    await self.run_blocking(writer, self.handle_stat, command[4:].strip())
+                elif verb == "XSIG":
+                    await self.handle_signature(writer, command[4:].strip())
+                elif verb == "XDLT":
+                    await self.handle_delta(writer, command.split(" ")[1], command.split(" ")[2])
+                elif verb == "DELE":
+                    await self.run_blocking(writer, self.handle_delete, command.split(" ")[1])
+                elif verb == "MKD":
+                    await self.run_blocking(writer, self.handle_make_directory, command.split(" ")[1])
+                elif verb == "RMD":
+                    await self.run_blocking(writer, self.handle_remove_directory, command.split(" ")[1])
+                elif verb == "RNFR":
+                    renaming = await self.run_blocking(writer, self.handle_rnfr, command[4:].strip())
+                elif verb == "RNTO":
+                    await self.run_blocking(writer, self.handle_rnto, rename_from, command[4:].strip())
+                elif verb == "COPY":
+                    await self.run_blocking(writer, self.handle_copy, command[4:].strip())
+                elif verb == "CWD":
+                    await self.run_blocking(writer, self.handle_cwd, command.split(" ", 1)[1])
+                elif verb == "CDUP":
+                    await self.run_blocking(writer, self.handle_cdup)
+                elif verb == "PWD":
+                    await self.run_blocking(writer, self.handle_pwd)
+                self.record_command(command, loop.time() - started, context)
+        except (ConnectionError, ssl.SSLError, ValueError, asyncio.TimeoutError) as e:
+            log.warning("Connection error: %s", e, extra=context)
+        except Exception:
+            log.exception("Session failed", extra=context)
+        finally:
+            writer.close()
+            self.release_session(writer)
+            log.info("Connection closed", extra=context)
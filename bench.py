@@ -0,0 +1,441 @@
+import argparse
+import contextlib
+import json
+import math
+import os
+import platform
+import resource
+import shutil
+import signal
+import socket
+import ssl
+import subprocess
+import sys
+import tempfile
+import threading
+import time
+from concurrent.futures import ThreadPoolExecutor
+from pathlib import Path
+
+import client
+
+# Loopback benchmark: every cell of the workload matrix gets a fresh server
+# process on a throwaway root and certificate, so its CPU time and peak RSS
+# (from wait4) belong to that cell alone. Results are written as JSON and
+# can be compared against a saved baseline. POSIX only.
+
+FILE_SIZES = {
+    "1K": 1024,
+    "64K": 64 * 1024,
+    "1M": 1024 ** 2,
+    "16M": 16 * 1024 ** 2,
+    "256M": 256 * 1024 ** 2,
+    "1G": 1024 ** 3,
+}
+DEFAULT_SIZES = ("1K", "1M", "16M")
+# Entries per directory for the LIST workload
+DEFAULT_ENTRIES = (10, 1000)
+DEFAULT_CONCURRENCY = (1, 4)
+DEFAULT_OPERATIONS = ("RETR", "STOR", "LIST")
+
+# Operations per session: enough to move CELL_BYTES, within these bounds
+CELL_BYTES = 256 * 1024 ** 2
+MIN_OPS = 2
+MAX_OPS = 200
+# Cells whose files would need more disk than this in total are skipped
+MAX_DISK_BYTES = 8 * 1024 ** 3
+# A throughput or p99 latency this much worse than the baseline counts as a regression
+DEFAULT_THRESHOLD = 0.10
+
+SERVER_START_TIMEOUT = 10
+# Seconds the sessions of a cell may take to log in and warm up before the cell counts as failed
+SESSION_SETUP_TIMEOUT = 300
+USERNAME = "admin"
+PASSWORD = "admin123"
+BENCH_SESSIONS_PER_USER = 256
+
+
+def free_port():
+    """Ask the kernel for a free loopback port."""
+    with socket.socket() as s:
+        s.bind(("127.0.0.1", 0))
+        return s.getsockname()[1]
+
+
+def make_certificate(directory):
+    """Generate a throwaway self-signed certificate and key with openssl; return their paths."""
+    cert, key = directory / "cert.pem", directory / "key.pem"
+    subprocess.run(["openssl", "req", "-x509", "-newkey", "rsa:2048", "-nodes", "-days", "1",
+                    "-subj", "/CN=127.0.0.1", "-keyout", str(key), "-out", str(cert)],
+                   check=True, stdout=subprocess.DEVNULL, stderr=subprocess.DEVNULL)
+    return cert, key
+
+
+def write_file(path, size):
+    """Write `size` bytes of random data (one random block repeated, so large files are quick to make)."""
+    block = os.urandom(min(size, 16 * 1024 ** 2))
+    with open(path, "wb") as f:
+        remaining = size
+        while remaining:
+            remaining -= f.write(block[:remaining])
+
+
+def percentile(samples, q):
+    """Nearest-rank percentile of sorted samples."""
+    if not samples:
+        return 0.0
+    return samples[min(len(samples) - 1, max(0, math.ceil(q * len(samples)) - 1))]
+
+
+def serve(args):
+    """Run a server for one cell (the `serve` subcommand, started by run_cell)."""
+    import server
+    server.CERT_FILE, server.KEY_FILE = args.cert, args.key
+    server.BASE_DIR = Path(args.root)
+    server.MAX_SESSIONS_PER_USER = BENCH_SESSIONS_PER_USER
+    if args.engine == "asyncio":
+        import asyncio
+        from async_server import AsyncFTPServer
+        asyncio.run(AsyncFTPServer("127.0.0.1", args.port, metrics_port=0).start())
+    else:
+        server.FTPServer("127.0.0.1", args.port, metrics_port=0).start()
+
+
+class ServerProcess:
+    """A benchmark server in a child process; `stop` returns its CPU seconds and peak RSS in bytes."""
+
+    def __init__(self, workdir, cert, key, engine):
+        self.port = free_port()
+        command = [sys.executable, str(Path(__file__).resolve()), "serve", "--engine", engine,
+                   "--port", str(self.port), "--root", str(workdir / "root"), "--cert", str(cert), "--key", str(key)]
+        # The working directory keeps the digest index and server log out of the caller's tree
+        self.log = open(workdir / "server.log", "ab")
+        self.process = subprocess.Popen(command, cwd=workdir, stdout=self.log, stderr=self.log)
+        deadline = time.monotonic() + SERVER_START_TIMEOUT
+        while True:
+            try:
+                with socket.create_connection(("127.0.0.1", self.port), timeout=1) as probe:
+                    # A probe that got the port as its own source port is connected to itself, not the server
+                    if probe.getsockname() != probe.getpeername():
+                        break
+            except OSError:
+                pass
+            if self.process.poll() is not None or time.monotonic() > deadline:
+                raise RuntimeError(f"Benchmark server did not start; see {workdir / 'server.log'}")
+            time.sleep(0.05)
+
+    def stop(self):
+        peak = self.peak_rss()
+        # Not Popen.send_signal: it reaps a server that already exited, leaving nothing for wait4
+        os.kill(self.process.pid, signal.SIGTERM)
+        _, status, usage = os.wait4(self.process.pid, 0)
+        self.process.returncode = os.waitstatus_to_exitcode(status)
+        self.log.close()
+        if peak is None:
+            # ru_maxrss is in KiB on Linux and in bytes on macOS
+            peak = usage.ru_maxrss if sys.platform == "darwin" else usage.ru_maxrss * 1024
+        return usage.ru_utime + usage.ru_stime, peak
+
+    def peak_rss(self):
+        # On Linux a child's ru_maxrss starts at the parent's peak at fork time,
+        # so the benchmark's own growth would show up in it; VmHWM is the server's own
+        try:
+            with open(f"/proc/{self.process.pid}/status") as status:
+                for line in status:
+                    if line.startswith("VmHWM:"):
+                        return int(line.split()[1]) * 1024
+        except OSError:
+            pass
+        return None
+
+
+class Bench:
+    """Prepare the temporary tree, run the cells of the matrix and collect their results."""
+
+    def __init__(self, workdir, engine, ops=None):
+        self.workdir = workdir
+        self.engine = engine
+        self.ops = ops
+        self.root = workdir / "root"
+        self.local = workdir / "local"
+        self.downloads = workdir / "downloads"
+        for directory in (self.root, self.local, self.downloads, self.root / "uploads"):
+            directory.mkdir(parents=True, exist_ok=True)
+        self.cert, self.key = make_certificate(workdir)
+
+        client.CA_CERT = str(self.cert)
+        client.BASE_DIR = self.local
+        client.DOWNLOAD_DIR = self.downloads
+
+    def ops_per_session(self, size, concurrency):
+        if self.ops:
+            return self.ops
+        return max(MIN_OPS, min(MAX_OPS, math.ceil(CELL_BYTES / (size * concurrency))))
+
+    def prepare(self, operation, size, entries, concurrency):
+        """Create the files a cell needs and return the per-session operation and its expected byte count."""
+        if operation == "LIST":
+            directory = self.root / f"list-{entries}"
+            if not directory.is_dir():
+                directory.mkdir()
+                for index in range(entries):
+                    (directory / f"entry-{index:06d}.dat").touch()
+            return lambda session, worker: sum(1 for _ in session.iter_list(directory.name)), 0
+
+        # One file on disk; every session gets its own name for it (a hard link), so
+        # concurrent downloads and uploads never write to the same file
+        source = (self.root if operation == "RETR" else self.local) / f"{operation.lower()}-{size}.bin"
+        if not source.is_file() or source.stat().st_size != size:
+            write_file(source, size)
+        for worker in range(concurrency):
+            link = source.with_name(f"{source.stem}-w{worker}.bin")
+            if not link.exists():
+                os.link(source, link)
+
+        if operation == "RETR":
+            def retrieve(session, worker):
+                name = f"{source.stem}-w{worker}.bin"
+                session.retrieve_file(name)
+                return (self.downloads / name).stat().st_size
+            return retrieve, size
+
+        def store(session, worker):
+            name = f"{source.stem}-w{worker}.bin"
+            session.store_file(name, "uploads")
+            return (self.root / "uploads" / name).stat().st_size
+        return store, size
+
+    def run_cell(self, operation, size_name, entries, concurrency):
+        size = FILE_SIZES.get(size_name, 0)
+        run_op, expected = self.prepare(operation, size, entries, concurrency)
+        ops = self.ops_per_session(size or 1, concurrency)
+        server = ServerProcess(self.workdir, self.cert, self.key, self.engine)
+        latencies = []
+        failures = 0
+        lock = threading.Lock()
+        start = threading.Barrier(concurrency + 1, timeout=SESSION_SETUP_TIMEOUT)
+
+        def session_worker(worker):
+            nonlocal failures
+            try:
+                session = client.FTPClient("127.0.0.1", server.port)
+                session.read_reply()
+                session.login(USERNAME, PASSWORD)
+                session.cwd(str(self.root))
+                run_op(session, worker)  # warm-up: TLS session tickets, page cache, file cache admission
+            except BaseException:
+                # Release the main thread and the other sessions instead of leaving them at the barrier
+                start.abort()
+                raise
+            start.wait()
+            for _ in range(ops):
+                began = time.perf_counter()
+                try:
+                    moved = run_op(session, worker)
+                    ok = operation == "LIST" or moved == expected
+                except (OSError, ssl.SSLError):
+                    ok = False
+                elapsed = time.perf_counter() - began
+                with lock:
+                    latencies.append(elapsed)
+                    failures += not ok
+            session.quit()
+
+        cpu_before = resource.getrusage(resource.RUSAGE_SELF)
+        try:
+            with open(os.devnull, "w") as devnull, contextlib.redirect_stdout(devnull), \
+                    ThreadPoolExecutor(concurrency) as pool:
+                futures = [pool.submit(session_worker, worker) for worker in range(concurrency)]
+                try:
+                    start.wait()
+                except threading.BrokenBarrierError:
+                    # A session failed or hung before the measurement; killing the server
+                    # unblocks any still waiting on it, so the pool can shut down
+                    os.kill(server.process.pid, signal.SIGKILL)
+                    return self.failed_cell(operation, size_name, entries, concurrency, futures)
+                began = time.perf_counter()
+                for future in futures:
+                    future.result()
+                wall = time.perf_counter() - began
+        finally:
+            server_cpu, server_rss = server.stop()
+        cpu_after = resource.getrusage(resource.RUSAGE_SELF)
+
+        latencies.sort()
+        total_ops = len(latencies)
+        moved = expected * (total_ops - failures)
+        return {
+            "name": cell_name(operation, size_name, entries, concurrency),
+            "operation": operation,
+            "size": size,
+            "entries": entries,
+            "concurrency": concurrency,
+            "ops": total_ops,
+            "failures": failures,
+            "bytes": moved,
+            "seconds": round(wall, 4),
+            "ops_per_second": round(total_ops / wall, 2),
+            "throughput_mib_s": round(moved / wall / 1024 ** 2, 2),
+            "latency_ms": {
+                "p50": round(percentile(latencies, 0.50) * 1000, 3),
+                "p99": round(percentile(latencies, 0.99) * 1000, 3),
+                "mean": round(sum(latencies) / total_ops * 1000, 3),
+                "max": round(latencies[-1] * 1000, 3),
+            },
+            "server_cpu_seconds": round(server_cpu, 3),
+            "server_peak_rss_mib": round(server_rss / 1024 ** 2, 1),
+            "client_cpu_seconds": round(cpu_after.ru_utime + cpu_after.ru_stime
+                                        - cpu_before.ru_utime - cpu_before.ru_stime, 3),
+        }
+
+    @staticmethod
+    def failed_cell(operation, size_name, entries, concurrency, futures):
+        """The result of a cell whose sessions could not be set up, with the first error they raised."""
+        errors = [future.exception() for future in futures]
+        error = next((e for e in errors if e is not None and not isinstance(e, threading.BrokenBarrierError)), None)
+        return {
+            "name": cell_name(operation, size_name, entries, concurrency),
+            "operation": operation,
+            "size": FILE_SIZES.get(size_name, 0),
+            "entries": entries,
+            "concurrency": concurrency,
+            "error": repr(error) if error else f"sessions not ready after {SESSION_SETUP_TIMEOUT} s",
+        }
+
+
+def cell_name(operation, size_name, entries, concurrency):
+    target = f"entries={entries}" if operation == "LIST" else f"size={size_name}"
+    return f"{operation} {target} concurrency={concurrency}"
+
+
+def matrix(operations, sizes, entries, concurrency):
+    """Yield (operation, size name, entries, concurrency) for every cell."""
+    for operation in operations:
+        for level in concurrency:
+            if operation == "LIST":
+                for count in entries:
+                    yield operation, None, count, level
+            else:
+                for size in sizes:
+                    yield operation, size, None, level
+
+
+def compare(results, baseline, threshold):
+    """Compare cells with the same name; return lines describing the changes and whether any regressed.
+
+    A cell that failed to run counts as a regression.
+    """
+    previous = {cell["name"]: cell for cell in baseline["results"]}
+    lines = []
+    regressed = False
+    for cell in results:
+        if "error" in cell:
+            lines.append(f"FAILED {cell['name']}: {cell['error']}")
+            regressed = True
+            continue
+        old = previous.get(cell["name"])
+        if old is None or "error" in old:
+            continue
+        throughput = change(old["ops_per_second"], cell["ops_per_second"])
+        p99 = change(old["latency_ms"]["p99"], cell["latency_ms"]["p99"])
+        worse = throughput < -threshold or p99 > threshold
+        regressed |= worse
+        lines.append(f"{'REGRESSION ' if worse else ''}{cell['name']}: ops/s {throughput:+.1%}, p99 {p99:+.1%}")
+    return lines, regressed
+
+
+def change(old, new):
+    return (new - old) / old if old else 0.0
+
+
+def git_revision():
+    try:
+        return subprocess.run(["git", "rev-parse", "--short", "HEAD"], cwd=Path(__file__).parent,
+                              capture_output=True, text=True, check=True).stdout.strip()
+    except (OSError, subprocess.CalledProcessError):
+        return None
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Loopback benchmark of the FTP server and client")
+    subcommands = parser.add_subparsers(dest="command")
+    serve_parser = subcommands.add_parser("serve", help=argparse.SUPPRESS)
+    serve_parser.add_argument("--engine", default="threads")
+    serve_parser.add_argument("--port", type=int, required=True)
+    serve_parser.add_argument("--root", required=True)
+    serve_parser.add_argument("--cert", required=True)
+    serve_parser.add_argument("--key", required=True)
+
+    parser.add_argument("--engine", choices=["threads", "asyncio"], default="threads")
+    parser.add_argument("--operations", nargs="+", choices=DEFAULT_OPERATIONS, default=DEFAULT_OPERATIONS)
+    parser.add_argument("--sizes", nargs="+", choices=FILE_SIZES, default=DEFAULT_SIZES)
+    parser.add_argument("--entries", nargs="+", type=int, default=DEFAULT_ENTRIES,
+                        help="entries per directory for LIST")
+    parser.add_argument("--concurrency", nargs="+", type=int, default=DEFAULT_CONCURRENCY)
+    parser.add_argument("--ops", type=int, help="operations per session (default: enough for 256 MiB per cell)")
+    parser.add_argument("--output", help="write the JSON report here (default: stdout)")
+    parser.add_argument("--baseline", help="report to compare against; exits 1 on a regression")
+    parser.add_argument("--threshold", type=float, default=DEFAULT_THRESHOLD,
+                        help="relative drop in ops/s or rise in p99 that counts as a regression")
+    parser.add_argument("--keep", action="store_true", help="keep the temporary directory")
+    args = parser.parse_args()
+
+    if args.command == "serve":
+        serve(args)
+        return
+
+    workdir = Path(tempfile.mkdtemp(prefix="ftp-bench-"))
+    results = []
+    try:
+        bench = Bench(workdir, args.engine, args.ops)
+        for operation, size_name, entries, concurrency in matrix(args.operations, args.sizes, args.entries,
+                                                                args.concurrency):
+            name = cell_name(operation, size_name, entries, concurrency)
+            # Source file plus one downloaded or uploaded copy per session
+            if operation != "LIST" and FILE_SIZES[size_name] * (concurrency + 1) > MAX_DISK_BYTES:
+                print(f"skip  {name}: needs more than {MAX_DISK_BYTES >> 30} GiB of disk", file=sys.stderr)
+                continue
+            cell = bench.run_cell(operation, size_name, entries, concurrency)
+            results.append(cell)
+            if "error" in cell:
+                print(f"FAILED {cell['name']}: {cell['error']}", file=sys.stderr)
+                continue
+            print(f"{cell['name']}: {cell['ops_per_second']} ops/s, {cell['throughput_mib_s']} MiB/s, "
+                  f"p50 {cell['latency_ms']['p50']} ms, p99 {cell['latency_ms']['p99']} ms, "
+                  f"server CPU {cell['server_cpu_seconds']} s, RSS {cell['server_peak_rss_mib']} MiB"
+                  + (f", {cell['failures']} FAILED" if cell["failures"] else ""), file=sys.stderr)
+    finally:
+        if args.keep:
+            print(f"Kept {workdir}", file=sys.stderr)
+        else:
+            shutil.rmtree(workdir, ignore_errors=True)
+
+    report = {
+        "meta": {
+            "revision": git_revision(),
+            "engine": args.engine,
+            "python": platform.python_version(),
+            "platform": platform.platform(),
+            "cpus": os.cpu_count(),
+            "time": time.strftime("%Y-%m-%dT%H:%M:%SZ", time.gmtime()),
+        },
+        "results": results,
+    }
+    text = json.dumps(report, indent=2)
+    if args.output:
+        Path(args.output).write_text(text + "\n")
+    else:
+        print(text)
+
+    if args.baseline:
+        lines, regressed = compare(results, json.loads(Path(args.baseline).read_text()), args.threshold)
+        for line in lines:
+            print(line, file=sys.stderr)
+        if regressed:
+            sys.exit(1)
+    if any("error" in cell for cell in results):
+        sys.exit(1)
+
+
+if __name__ == "__main__":
+    main()
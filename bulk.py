@@ -0,0 +1,114 @@
+import os
+import struct
+from contextlib import nullcontext
+from pathlib import Path, PurePosixPath
+
+from storage import DEFAULT_FSYNC_POLICY, Upload
+from transfer import send_file, receive_file
+
+# Bulk archive: per file a header (name length, size, mtime in ns), the UTF-8
+# name ("/"-separated, relative) and `size` bytes of data. A header with a
+# zero name length ends the archive.
+HEADER = struct.Struct("!HQq")
+END_OF_ARCHIVE = HEADER.pack(0, 0, 0)
+
+
+def pack_entry(name, size, mtime_ns):
+    """Return the header and name that precede a file's data."""
+    encoded = name.encode()
+    return HEADER.pack(len(encoded), size, mtime_ns) + encoded
+
+
+def collect_files(base_dir, paths):
+    """Expand paths (files or directories, relative to `base_dir`) into (full path, archive name) pairs.
+
+    Names are relative to the parent of each given path, so a directory
+    keeps its own name and its layout inside the archive.
+    """
+    entries = []
+    for path in paths:
+        full_path = Path(base_dir) / path
+        if full_path.is_file():
+            entries.append((full_path, full_path.name))
+        elif full_path.is_dir():
+            for root, _, file_names in os.walk(full_path):
+                for file_name in sorted(file_names):
+                    file_path = Path(root) / file_name
+                    entries.append((file_path, file_path.relative_to(full_path.parent).as_posix()))
+    return entries
+
+
+def destination(root, name):
+    """Return where an archive entry goes below `root`; refuse names that would escape it."""
+    relative = PurePosixPath(name)
+    if not name or relative.is_absolute() or ".." in relative.parts:
+        raise ValueError(f"Unsafe name in archive: {name!r}")
+    return Path(root).joinpath(*relative.parts)
+
+
+def recv_exactly(sock, size):
+    """Read exactly `size` bytes from a socket."""
+    data = bytearray()
+    while len(data) < size:
+        chunk = sock.recv(size - len(data))
+        if not chunk:
+            raise ConnectionError("Data stream truncated.")
+        data += chunk
+    return bytes(data)
+
+
+def write_archive(sock, entries, buffer_size, lock=None, throttle=None):
+    """Stream (full path, name) entries to a socket as one archive; return (files, bytes).
+
+    `lock`, if given, is a context manager factory taken around each file;
+    `throttle` is passed on to send_file.
+    """
+    files = 0
+    total = 0
+    for file_path, name in entries:
+        with lock(file_path) if lock else nullcontext():
+            try:
+                f = open(file_path, "rb")
+            except FileNotFoundError:
+                continue  # removed since the list was made
+            with f:
+                stats = os.fstat(f.fileno())
+                sock.sendall(pack_entry(name, stats.st_size, stats.st_mtime_ns))
+                sent = send_file(sock, f, buffer_size, 0, stats.st_size, throttle=throttle) if stats.st_size else 0
+                if sent != stats.st_size:
+                    raise OSError(f"{name} shrank while it was being sent.")
+        files += 1
+        total += stats.st_size
+    sock.sendall(END_OF_ARCHIVE)
+    return files, total
+
+
+def read_archive(sock, root, buffer_size, lock=None, throttle=None, fsync_policy=DEFAULT_FSYNC_POLICY):
+    """Unpack an archive from a socket below `root` as it arrives; return (files, bytes).
+
+    Each file is received like a STOR (storage.Upload) and only replaces its
+    target once complete, with the size and mtime recorded in its header;
+    `lock` is taken around that swap. Raises ConnectionError if the stream
+    ends early and ValueError for unsafe names.
+    """
+    files = 0
+    total = 0
+    while True:
+        name_length, size, mtime_ns = HEADER.unpack(recv_exactly(sock, HEADER.size))
+        if not name_length:
+            return files, total
+        file_path = destination(root, recv_exactly(sock, name_length).decode())
+        file_path.parent.mkdir(parents=True, exist_ok=True)
+
+        upload = Upload(file_path, size=size, fsync_policy=fsync_policy)
+        try:
+            if receive_file(sock, upload, buffer_size, size, throttle=throttle) != size:
+                raise ConnectionError("Data stream truncated.")
+            upload.finish()
+            with lock(file_path) if lock else nullcontext():
+                upload.commit()
+                os.utime(file_path, ns=(mtime_ns, mtime_ns))
+        finally:
+            upload.discard()
+        files += 1
+        total += size
@@ -0,0 +1,189 @@
+import os
+import threading
+from collections import OrderedDict
+from pathlib import Path
+
+
+class ListingCache:
+    """LRU cache of formatted directory listings.
+
+    Entries are keyed by resolved directory and listing format, and remember the
+    directory's mtime when they were built: a lookup re-stats the directory and
+    treats a changed mtime as a miss, which catches changes made outside the
+    server. The server's own STOR/DELE/MKD/RMD invalidate entries directly.
+    """
+
+    def __init__(self, max_dirs, max_bytes, max_entry_bytes):
+        self.max_dirs = max_dirs
+        self.max_bytes = max_bytes
+        self.max_entry_bytes = max_entry_bytes
+        self._lock = threading.Lock()
+        self._entries = OrderedDict()  # (directory, machine) -> (mtime_ns, chunks, size)
+        self.resident_bytes = 0
+        self.hits = 0
+        self.misses = 0
+        self.stale = 0
+        self.invalidations = 0
+
+    @staticmethod
+    def _key(directory, machine):
+        return Path(directory).resolve(), machine
+
+    def get(self, directory, machine=False):
+        """Return (chunks, mtime_ns); chunks is None on a miss and mtime_ns is what to `put` with."""
+        key = self._key(directory, machine)
+        mtime_ns = os.stat(key[0]).st_mtime_ns
+        with self._lock:
+            entry = self._entries.get(key)
+            if entry is not None and entry[0] == mtime_ns:
+                self._entries.move_to_end(key)
+                self.hits += 1
+                return entry[1], mtime_ns
+            if entry is not None:
+                self.stale += 1
+                self._remove(key)
+            self.misses += 1
+        return None, mtime_ns
+
+    def put(self, directory, machine, mtime_ns, chunks):
+        """Store a listing built from the directory as it was at `mtime_ns`."""
+        size = sum(len(chunk) for chunk in chunks)
+        if size > self.max_entry_bytes:
+            return
+        key = self._key(directory, machine)
+        with self._lock:
+            self._remove(key)
+            self._entries[key] = (mtime_ns, chunks, size)
+            self.resident_bytes += size
+            while len(self._entries) > self.max_dirs or self.resident_bytes > self.max_bytes:
+                self._remove(next(iter(self._entries)))
+
+    def _remove(self, key):
+        entry = self._entries.pop(key, None)
+        if entry is not None:
+            self.resident_bytes -= entry[2]
+
+    def invalidate(self, path, subtree=False):
+        """Drop listings affected by a change to `path`: its parent, and the path itself if a directory.
+
+        With `subtree`, every listing below `path` is dropped too (RMD).
+        """
+        path = Path(path).resolve()
+        with self._lock:
+            for key in list(self._entries):
+                directory = key[0]
+                if directory == path or directory == path.parent or (subtree and path in directory.parents):
+                    self._remove(key)
+                    self.invalidations += 1
+
+    def stats(self):
+        """Return hit/miss counters and resident size."""
+        with self._lock:
+            lookups = self.hits + self.misses
+            return {
+                "entries": len(self._entries),
+                "resident_bytes": self.resident_bytes,
+                "hits": self.hits,
+                "misses": self.misses,
+                "stale": self.stale,
+                "invalidations": self.invalidations,
+                "hit_ratio": self.hits / lookups if lookups else 0.0,
+            }
+
+
+class FileCache:
+    """LRU cache of the contents of small, frequently downloaded files.
+
+    Entries hold the file's bytes and its size, mtime and inode when read; a
+    lookup re-stats the file and treats a changed identity as a miss, which
+    catches changes made outside the server. A file is only cached once it
+    has been requested `admit_after` times, so one-off downloads of large
+    trees do not churn the hot set. The server's own STOR/DELE/RNTO/RMD
+    invalidate entries directly.
+    """
+
+    def __init__(self, max_bytes, max_entry_bytes, admit_after=2, max_tracked=4096):
+        self.max_bytes = max_bytes
+        self.max_entry_bytes = max_entry_bytes
+        self.admit_after = admit_after
+        self.max_tracked = max_tracked
+        self._lock = threading.Lock()
+        self._entries = OrderedDict()  # path -> (identity, data)
+        self._requests = OrderedDict()  # path -> requests seen while not cached
+        self.resident_bytes = 0
+        self.hits = 0
+        self.misses = 0
+        self.stale = 0
+        self.invalidations = 0
+
+    @staticmethod
+    def _identity(stats):
+        return stats.st_size, stats.st_mtime_ns, stats.st_ino
+
+    def get(self, path, stats):
+        """Return the cached bytes of `path` if they match `stats` (from os.stat), else None."""
+        key = Path(path).resolve()
+        with self._lock:
+            entry = self._entries.get(key)
+            if entry is not None and entry[0] == self._identity(stats):
+                self._entries.move_to_end(key)
+                self.hits += 1
+                return entry[1]
+            if entry is not None:
+                self.stale += 1
+                self._remove(key)
+            self.misses += 1
+            return None
+
+    def wants(self, path, stats):
+        """Count a request for an uncached file; return True once it is hot and small enough to cache."""
+        if stats.st_size > self.max_entry_bytes:
+            return False
+        key = Path(path).resolve()
+        with self._lock:
+            requests = self._requests.pop(key, 0) + 1
+            self._requests[key] = requests
+            while len(self._requests) > self.max_tracked:
+                self._requests.popitem(last=False)
+            return requests >= self.admit_after
+
+    def put(self, path, stats, data):
+        """Store the contents of `path` read while it had `stats`."""
+        if len(data) != stats.st_size or len(data) > self.max_entry_bytes:
+            return
+        key = Path(path).resolve()
+        with self._lock:
+            self._requests.pop(key, None)
+            self._remove(key)
+            self._entries[key] = (self._identity(stats), data)
+            self.resident_bytes += len(data)
+            while self.resident_bytes > self.max_bytes:
+                self._remove(next(iter(self._entries)))
+
+    def _remove(self, key):
+        entry = self._entries.pop(key, None)
+        if entry is not None:
+            self.resident_bytes -= len(entry[1])
+
+    def invalidate(self, path, subtree=False):
+        """Drop the entry of a file, or of everything below a directory with `subtree`."""
+        path = Path(path).resolve()
+        with self._lock:
+            for key in list(self._entries):
+                if key == path or (subtree and path in key.parents):
+                    self._remove(key)
+                    self.invalidations += 1
+
+    def stats(self):
+        """Return hit/miss counters and resident size."""
+        with self._lock:
+            lookups = self.hits + self.misses
+            return {
+                "entries": len(self._entries),
+                "resident_bytes": self.resident_bytes,
+                "hits": self.hits,
+                "misses": self.misses,
+                "stale": self.stale,
+                "invalidations": self.invalidations,
+                "hit_ratio": self.hits / lookups if lookups else 0.0,
+            }
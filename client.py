@@ -1,19 +1,64 @@
+import codecs
+import logging
 import os
 import socket
 import ssl
+from concurrent.futures import ThreadPoolExecutor
+from datetime import datetime, timezone
 from pathlib import Path
 
+from bulk import collect_files, write_archive, read_archive
+from compression import DEFAULT_METHOD, DEFAULT_LEVELS, Compressor, Decompressor, CompressionStats, announced_method
+from delta import Signature, iter_delta
+from digests import DEFAULT_ALGORITHM, new_hasher, hash_file
+from logs import setup_logging
+from protocol import ControlChannel, set_nodelay
+from transfer import send_file, receive_file, send_compressed, receive_compressed
+
 SERVER_HOST = "127.0.0.1"
 SERVER_PORT = 2121
 BUFFER_SIZE = 1024
+# Buffer reused for every chunk of a RETR/STOR data transfer
+TRANSFER_BUFFER_SIZE = 256 * 1024
+
+# Segmented downloads: number of parallel sessions, and the smallest segment worth a session
+DOWNLOAD_SEGMENTS = 4
+MIN_SEGMENT_SIZE = 8 * 1024 * 1024
 
 BASE_DIR = Path(r"C:\Users\F\PycharmProjects\FTP")
 DOWNLOAD_DIR = BASE_DIR / "Downloads"  # Path to the download directory
 
 CA_CERT = 'cert.pem'
 
-BASE_DIR.mkdir(exist_ok=True)
-DOWNLOAD_DIR.mkdir(exist_ok=True)
+# Server replies are logged, not printed, so a slow terminal does not hold up transfers
+log = logging.getLogger("ftp.client")
+
+
+def download_dir():
+    """The download directory, created on first use rather than when the module is imported."""
+    DOWNLOAD_DIR.mkdir(parents=True, exist_ok=True)
+    return DOWNLOAD_DIR
+
+
+def create_client_context():
+    """Build the SSL context for the control and data channels."""
+    context = ssl.create_default_context(ssl.Purpose.SERVER_AUTH)
+    context.load_verify_locations(cafile=CA_CERT)
+    context.check_hostname = False
+    context.verify_mode = ssl.CERT_OPTIONAL
+    return context
+
+
+def parse_facts(line):
+    """Parse an MLSD line into a dict of its facts plus "name"."""
+    facts, _, name = line.partition(" ")
+    entry = {"name": name}
+    for fact in facts.rstrip(";").split(";"):
+        key, _, value = fact.partition("=")
+        entry[key.lower()] = value
+    if "size" in entry:
+        entry["size"] = int(entry["size"])
+    return entry
 
 
 class FTPClient:
@@ -22,79 +67,264 @@ class FTPClient:
         self.host = host
         self.port = port
         self.control_socket = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
+        set_nodelay(self.control_socket)
 
         # Data connection configuration using SSL protocol
-        self.context = ssl.create_default_context(ssl.Purpose.SERVER_AUTH)
-        self.context.load_verify_locations(cafile=CA_CERT)
-        self.context.check_hostname = False
-        self.context.verify_mode = ssl.CERT_OPTIONAL
+        self.context = create_client_context()
 
         # connect to server
         self.control_socket = self.context.wrap_socket(self.control_socket, server_hostname=SERVER_HOST)
         self.control_socket.connect((self.host, self.port))
 
+        # CRLF-framed commands and replies on the control connection
+        self.channel = ControlChannel(self.control_socket)
+
+        # Data channel handshakes, and how many resumed the control session
+        self.tls_counters = {"data_handshakes": 0, "data_resumed": 0}
+
         # checking user logged in
         self.authenticated = False
 
+        # Login and working directory, replayed by the extra sessions of a segmented download
+        self.credentials = None
+        self.current_dir = None
+
+        # Transfer mode (S or Z), the MODE Z method and level, and what compression saved
+        self.mode = "S"
+        self.compression = (DEFAULT_METHOD, DEFAULT_LEVELS[DEFAULT_METHOD])
+        self.compression_stats = CompressionStats()
+
+        # Algorithm the server's HASH command is set to
+        self.hash_algorithm = DEFAULT_ALGORITHM
+
+    def send_command(self, command):
+        """Send one command line on the control connection."""
+        self.channel.send_line(command)
+
+    def read_reply(self):
+        """Read the next reply, including every line of a multi-line reply."""
+        return self.channel.read_reply()
+
     def control_connection(self, command):
         """Send command to the server and return the server's response."""
-        self.control_socket.send(command.encode())
-        response = self.control_socket.recv(BUFFER_SIZE).decode()
-        print(f"Server response: {response}")
+        self.send_command(command)
+        response = self.read_reply()
+        log.info("Server response: %s", response)
         return response
 
+    def pipeline(self, commands):
+        """Send a batch of commands without waiting, then return their replies in order.
+
+        Only commands answered by a single reply belong here (DELE, MKD, RMD,
+        SIZE, ...), not transfers that open a data connection.
+        """
+        self.channel.send_lines(commands)
+        responses = [self.read_reply() for _ in commands]
+        for response in responses:
+            log.info("Server response: %s", response)
+        return responses
+
+    def delete_files(self, file_paths):
+        """Delete several files in one round trip."""
+        return self.pipeline([f"DELE {file_path}" for file_path in file_paths])
+
+    def make_directories(self, directory_paths):
+        """Create several directories in one round trip."""
+        return self.pipeline([f"MKD {directory_path}" for directory_path in directory_paths])
+
     def data_connection(self, port):
-        """Establish a data connection to the server."""
+        """Establish a data connection to the server, resuming the control channel's TLS session."""
         self.data_socket = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
+        set_nodelay(self.data_socket)
         self.data_socket.connect((SERVER_HOST, port))
-        self.data_socket = self.context.wrap_socket(self.data_socket, server_hostname=SERVER_HOST)
+        self.data_socket = self.context.wrap_socket(self.data_socket, server_hostname=SERVER_HOST,
+                                                    session=self.control_socket.session)
 
-    def list_files(self, path=" "):
-        """Request the list of files from the server."""
-        print(f"Requesting list of files from {path}")
-        self.control_socket.send(f"LIST {path}".encode())
+        self.tls_counters["data_handshakes"] += 1
+        if self.data_socket.session_reused:
+            self.tls_counters["data_resumed"] += 1
+
+    def tls_stats(self):
+        """Return data channel TLS session resumption counters."""
+        stats = dict(self.tls_counters)
+        stats["resumption_rate"] = stats["data_resumed"] / stats["data_handshakes"] if stats["data_handshakes"] else 0.0
+        return stats
+
+    def iter_lines(self, command):
+        """Send a listing command and yield the lines of its data connection as they arrive.
+
+        If the caller stops early the rest of the listing is still read, so the
+        control connection stays in step with the server.
+        """
+        self.send_command(command)
 
         # Wait for the server's response to enter passive mode
-        response = self.control_socket.recv(BUFFER_SIZE).decode()
-        print(f"Server response: {response}")
+        response = self.read_reply()
+        log.info("Server response: %s", response)
 
-        if response.startswith("227"):
-            print("Entering Passive Mode, waiting for data connection...")
-            # Extract the port from the PASV response
-            parts = response.split("(")[1].split(")")[0].split(",")
-            port = int(parts[4]) * 256 + int(parts[5])  # Extract the port
-            self.data_connection(port)  # Establish data connection
+        if not response.startswith("227"):
+            log.error("Listing failed: %s", response)
+            return
 
-            # Receive the file list from the data connection
-            file_list = ""
+        # Extract the port from the PASV response
+        parts = response.split("(")[1].split(")")[0].split(",")
+        port = int(parts[4]) * 256 + int(parts[5])  # Extract the port
+        self.data_connection(port)  # Establish data connection
+
+        decoder = codecs.getincrementaldecoder("utf-8")()
+        # In MODE Z listings are always compressed
+        decompressor = Decompressor(self.compression[0]) if self.mode == "Z" else None
+        pending = ""
+        buffer = bytearray(TRANSFER_BUFFER_SIZE)
+        view = memoryview(buffer)
+        try:
             while True:
-                data = self.data_socket.recv(BUFFER_SIZE)  # Use self.data_socket.recv() here
-                if not data:
+                read = self.data_socket.recv_into(view)
+                if not read:
                     break
-                file_list += data.decode()
-
-            # Print file list
-            print("Received file list:")
-            print(file_list)
+                for data in decompressor.iter_decompress(view[:read]) if decompressor else (view[:read],):
+                    # Only the incomplete last line is carried over to the next chunk
+                    lines = (pending + decoder.decode(data)).split("\r\n")
+                    pending = lines.pop()
+                    yield from lines
+            if decompressor:
+                decompressor.finish()
+                self.compression_stats.record(decompressor)
+            pending += decoder.decode(b"", final=True)
+            if pending:
+                yield pending
+        finally:
+            while self.data_socket.recv_into(view):
+                pass
 
             # Close the data connection
             self.data_socket.close()
 
             # Wait for server's final response
-            response = self.control_socket.recv(BUFFER_SIZE).decode()
-            print(f"Server response: {response}")
-        else:
-            print(f"Error receiving file list: {response}")
+            response = self.read_reply()
+            log.info("Server response: %s", response)
+
+    def iter_list(self, path=" "):
+        """Yield the lines of a LIST reply as they arrive."""
+        return self.iter_lines(f"LIST {path}")
 
-    def store_file(self, file_path, destination_path):
-        """Upload a file to the server."""
+    def iter_mlsd(self, path="."):
+        """Yield the entries of an MLSD reply as dicts of facts plus "name"."""
+        for line in self.iter_lines(f"MLSD {path}"):
+            yield parse_facts(line)
+
+    def list_files(self, path=" "):
+        """Request the list of files from the server."""
+        print(f"Requesting list of files from {path}")
+
+        # Print file list as it is received
+        print("Received file list:")
+        for line in self.iter_list(path):
+            print(line)
+
+    def size(self, path):
+        """Return the size of a remote file in bytes, or None if it does not exist."""
+        response = self.control_connection(f"SIZE {path}")
+        if response.startswith("213"):
+            return int(response[4:].strip())
+        return None
+
+    def mdtm(self, path):
+        """Return the modification time of a remote file as a UTC datetime, or None."""
+        response = self.control_connection(f"MDTM {path}")
+        if response.startswith("213"):
+            return datetime.strptime(response[4:].strip(), "%Y%m%d%H%M%S").replace(tzinfo=timezone.utc)
+        return None
+
+    def hash(self, path, algorithm=DEFAULT_ALGORITHM, offset=0, count=None):
+        """Return the server's digest of a remote file, or of `count` bytes from `offset`; None on error."""
+        if algorithm != self.hash_algorithm:
+            if not self.control_connection(f"OPTS HASH {algorithm}").startswith("200"):
+                return None
+            self.hash_algorithm = algorithm
+        if count is not None:
+            if not self.control_connection(f"RANG {offset} {offset + count - 1}").startswith("350"):
+                return None
+        elif offset and not self.restart_at(offset):
+            return None
+
+        # "213 <algorithm> <start>-<end> <digest> <path>"
+        response = self.control_connection(f"HASH {path}")
+        if response.startswith("213"):
+            return response.split()[3]
+        return None
+
+    def is_unchanged(self, local_path, remote_path):
+        """Check whether a local file and a remote file have the same size and digest."""
+        if not local_path.is_file() or self.size(remote_path) != local_path.stat().st_size:
+            return False
+        return hash_file(local_path, DEFAULT_ALGORITHM) == self.hash(remote_path)
+
+    def verify_transfer(self, remote_path, hasher, offset=0):
+        """Compare the digest of the bytes just transferred with the server's digest of the same range."""
+        if self.hash(remote_path, DEFAULT_ALGORITHM, offset) == hasher.hexdigest():
+            log.info("Verified '%s' (%s %s).", remote_path, DEFAULT_ALGORITHM, hasher.hexdigest())
+            return True
+        log.error("'%s' does not match the server's digest.", remote_path)
+        return False
+
+    def set_mode(self, mode):
+        """Switch the transfer mode: "Z" compresses data connections, "S" sends them as they are."""
+        if self.control_connection(f"MODE {mode}").startswith("200"):
+            self.mode = mode.upper()
+        return self.mode
+
+    def set_compression(self, method=None, level=None):
+        """Choose the MODE Z method (zlib, or zstd where installed) and level; return what is in effect."""
+        options = ""
+        if method is not None:
+            options += f" METHOD {method}"
+        if level is not None:
+            options += f" LEVEL {level}"
+        response = self.control_connection(f"OPTS MODE Z{options}")
+        if response.startswith("200"):
+            # "200 MODE Z uses <method> level <level>."
+            words = response.rstrip(".").split()
+            self.compression = (words[4], int(words[6]))
+        return self.compression
+
+    def restart_at(self, offset):
+        """Send REST so the next RETR/STOR starts at `offset`; return the offset the server accepted."""
+        if offset and self.control_connection(f"REST {offset}").startswith("350"):
+            return offset
+        return 0
+
+    def store_file(self, file_path, destination_path, resume=False, skip_unchanged=False, verify=False):
+        """Upload a file to the server.
+
+        With `resume`, an existing partial copy on the server is kept and
+        only the bytes after its current size are sent. With `skip_unchanged`,
+        nothing is sent if the server already has a file with the same digest.
+        With `verify`, the data is hashed as it is sent and compared with the
+        server's digest afterwards; the result (True/False) is returned.
+        """
         file_name = file_path.split("\\")[-1]
         # Send command to server
         file_path = BASE_DIR / file_path
+        remote_path = f"{destination_path}/{file_name}"
+        if skip_unchanged and self.is_unchanged(file_path, remote_path):
+            log.info("'%s' is unchanged, skipped.", remote_path)
+            return True
+        hasher = new_hasher(DEFAULT_ALGORITHM) if verify else None
         if file_path.is_file():
-            response = self.control_connection(f"STOR {file_name} {destination_path}")
+            offset = 0
+            if resume:
+                remote_size = self.size(f"{destination_path}/{file_name}")
+                if remote_size is not None and remote_size <= file_path.stat().st_size:
+                    offset = self.restart_at(remote_size)
+            if offset:
+                response = self.control_connection(f"STOR {file_name} {destination_path}")
+            else:
+                # Announce the size so the server can preallocate; pipelined, so no extra round trip
+                response = self.pipeline([f"ALLO {file_path.stat().st_size}",
+                                          f"STOR {file_name} {destination_path}"])[1]
         else:
-            print("File not found")
+            log.error("'%s' not found.", file_path)
             return
 
         if response.startswith("227"):
@@ -104,46 +334,201 @@ class FTPClient:
 
             # Data connection
             self.data_connection(port)
-            response = self.control_socket.recv(BUFFER_SIZE).decode()
-            print(response)
+            response = self.read_reply()
+            log.info("Server response: %s", response)
 
             if response.startswith("150"):
                 try:
                     # opening file and start uploading
 
                     with open(file_path, "rb") as f:
-                        while chunk := f.read(BUFFER_SIZE):
-                            self.data_socket.send(chunk)
-
-                    print(f"File uploaded successfully.")
+                        # The server's 150 says whether it expects compressed data
+                        method = announced_method(response)
+                        if method:
+                            level = self.compression[1] if method == self.compression[0] else None
+                            compressor = Compressor(method, level)
+                            send_compressed(self.data_socket, f, TRANSFER_BUFFER_SIZE, compressor, offset,
+                                            hasher=hasher)
+                            self.compression_stats.record(compressor)
+                        else:
+                            send_file(self.data_socket, f, TRANSFER_BUFFER_SIZE, offset, hasher=hasher)
+
+                    # Send close_notify and wait for the server to finish reading;
+                    # closing with unread TLS records would reset the connection
+                    # and drop data still queued on the server side
+                    try:
+                        self.data_socket.unwrap()
+                    except (ssl.SSLError, OSError):
+                        pass
 
                 except FileNotFoundError:
-                    print(f"Error: File not found.")
-                    self.control_socket.send("550".encode())
+                    log.error("'%s' not found.", file_path)
 
                 except Exception as e:
-                    print(f"Error during file upload: {e}")
-                    self.control_socket.send("550".encode())
+                    log.error("Upload of '%s' failed: %s", file_path, e)
 
                 finally:
                     # closing data connection
                     self.data_socket.close()
-                    print("Data connection closed.")
 
                 # final server response
-                response = self.control_socket.recv(BUFFER_SIZE).decode()
-                print(f"Server response: {response}")
+                response = self.read_reply()
+                log.info("Server response: %s", response)
+                if verify and response.startswith("226"):
+                    return self.verify_transfer(remote_path, hasher, offset)
         else:
-            print(f"Error: {response}")
+            log.error("Upload of '%s' refused: %s", file_path, response)
+
+    def open_bulk_transfer(self, command):
+        """Send MRET/MSTR/XSIG/XDLT and open its data connection; return True once the server is ready (150)."""
+        response = self.control_connection(command)
+        if not response.startswith("227"):
+            log.error("%s refused: %s", command.split(" ")[0], response)
+            return False
+
+        parts = response.split("(")[1].split(")")[0].split(",")
+        self.data_connection(int(parts[4]) * 256 + int(parts[5]))
+        response = self.read_reply()
+        log.info("Server response: %s", response)
+        if not response.startswith("150"):
+            self.data_socket.close()
+            return False
+        return True
+
+    def retrieve_files(self, paths):
+        """Download files and whole directories in one archive over a single data connection.
+
+        Each entry is unpacked into the download directory as it arrives, with
+        its name and mtime. Returns (files, bytes) received.
+        """
+        if not self.open_bulk_transfer(f"MRET {' '.join(paths)}"):
+            return 0, 0
+        try:
+            files, size = read_archive(self.data_socket, download_dir(), TRANSFER_BUFFER_SIZE, fsync_policy="none")
+        finally:
+            self.data_socket.close()
+
+        response = self.read_reply()
+        log.info("Server response: %s", response)
+        return files, size
+
+    def store_files(self, paths, destination_path="Uploads"):
+        """Upload files and whole directories (relative to the base directory) in one archive.
+
+        Returns (files, bytes) sent.
+        """
+        entries = collect_files(BASE_DIR, paths)
+        if not entries:
+            log.error("No files found.")
+            return 0, 0
+        if not self.open_bulk_transfer(f"MSTR {destination_path}"):
+            return 0, 0
+        try:
+            files, size = write_archive(self.data_socket, entries, TRANSFER_BUFFER_SIZE)
+            # As in store_file: let the server read everything before closing
+            try:
+                self.data_socket.unwrap()
+            except (ssl.SSLError, OSError):
+                pass
+        finally:
+            self.data_socket.close()
+
+        response = self.read_reply()
+        log.info("Server response: %s", response)
+        return files, size
+
+    def store_file_delta(self, file_path, destination_path):
+        """Upload a new version of a file the server already has, sending only what changed.
+
+        The server's block signature of its copy is fetched first; the upload
+        then carries references to matching blocks plus the bytes in between.
+        Falls back to a plain STOR when the server has no copy or the delta is
+        refused (e.g. the file changed in between). Returns a dict with the
+        bytes "matched" from the server's copy and sent as "literal" data.
+        """
+        file_name = file_path.split("\\")[-1]
+        local_path = BASE_DIR / file_path
+        if not local_path.is_file():
+            log.error("'%s' not found.", local_path)
+            return None
+
+        if not self.open_bulk_transfer(f"XSIG {destination_path}/{file_name}"):
+            self.store_file(file_path, destination_path)
+            return {"matched": 0, "literal": local_path.stat().st_size}
+        try:
+            chunks = []
+            while chunk := self.data_socket.recv(TRANSFER_BUFFER_SIZE):
+                chunks.append(chunk)
+        finally:
+            self.data_socket.close()
+        response = self.read_reply()
+        log.info("Server response: %s", response)
+        if not response.startswith("226"):
+            return None
+        signature = Signature(b"".join(chunks))
+
+        stats = {}
+        if not self.open_bulk_transfer(f"XDLT {file_name} {destination_path}"):
+            return None
+        try:
+            with open(local_path, "rb") as f:
+                for chunk in iter_delta(f, signature, stats):
+                    self.data_socket.sendall(chunk)
+            # As in store_file: let the server read everything before closing
+            self.data_socket.unwrap()
+        except (ssl.SSLError, OSError) as e:
+            # The server closes the data connection early when it refuses the delta
+            log.warning("Delta upload of '%s' interrupted: %s", file_path, e)
+        finally:
+            self.data_socket.close()
+
+        response = self.read_reply()
+        log.info("Server response: %s", response)
+        if not response.startswith("226"):
+            self.store_file(file_path, destination_path)
+            return {"matched": 0, "literal": local_path.stat().st_size}
+        return stats
+
+    def rename(self, from_path, to_path):
+        """Rename or move a file or directory on the server (RNFR/RNTO) in one round trip."""
+        return self.pipeline([f"RNFR {from_path}", f"RNTO {to_path}"])
+
+    def copy(self, source_path, destination_path):
+        """Copy a file on the server; the data never crosses the network."""
+        return self.control_connection(f"COPY {source_path} {destination_path}")
+
+    def site(self, argument):
+        """Send a SITE command, e.g. "LIMIT USER user1 1M" or "LIMITS"; return the reply."""
+        return self.control_connection(f"SITE {argument}")
+
+    def status(self):
+        """Send STAT; return the server's summary of sessions, transfers and command latencies."""
+        return self.control_connection("STAT")
 
     def remove_directory(self, directory_path):
         """Send the RMD command to the server to remove a directory."""
-        response = self.control_connection(f"RMD {directory_path}")
-        print(response)
+        return self.control_connection(f"RMD {directory_path}")
+
+    def retrieve_file(self, file_path, resume=False, skip_unchanged=False, verify=False):
+        """Retrieve a file from the server and save it in the download directory.
 
-    def retrieve_file(self, file_path):
-        """Retrieve a file from the server and save it in the download directory."""
+        With `resume`, a partial download already in the directory is kept and
+        only the rest of the file is fetched. With `skip_unchanged`, nothing is
+        fetched if the local copy has the server's digest. With `verify`, the
+        data is hashed as it arrives and compared with the server's digest
+        afterwards; the result (True/False) is returned.
+        """
         file_name = file_path.split("\\")[-1]
+        # Construct the full path to save the file
+        destination_path = download_dir() / file_name
+        if skip_unchanged and self.is_unchanged(destination_path, file_path):
+            log.info("'%s' is unchanged, skipped.", file_path)
+            return True
+        hasher = new_hasher(DEFAULT_ALGORITHM) if verify else None
+
+        offset = 0
+        if resume and destination_path.is_file():
+            offset = self.restart_at(destination_path.stat().st_size)
         response = self.control_connection(f"RETR {file_path}")
 
         if response.startswith("227"):
@@ -155,41 +540,125 @@ class FTPClient:
             self.data_connection(port)
 
             # Receive the file
-            response = self.control_socket.recv(BUFFER_SIZE).decode()
-            print(f"Server response: {response}")
+            response = self.read_reply()
+            log.info("Server response: %s", response)
 
             if response.startswith("150"):
-                # Construct the full path to save the file
-                destination_path = DOWNLOAD_DIR / file_name
-                print(f"Downloading to: {destination_path}")
-
-                with open(destination_path, "wb") as f:
-                    while True:
-                        data = self.data_socket.recv(BUFFER_SIZE)
-                        if not data:
-                            break
-                        f.write(data)
+                with open(destination_path, "r+b" if offset else "wb") as f:
+                    f.seek(offset)
+                    method = announced_method(response)
+                    if method:
+                        decompressor = Decompressor(method)
+                        receive_compressed(self.data_socket, f, TRANSFER_BUFFER_SIZE, decompressor, hasher)
+                        self.compression_stats.record(decompressor)
+                    else:
+                        receive_file(self.data_socket, f, TRANSFER_BUFFER_SIZE, hasher=hasher)
+                    f.truncate()
 
                 # Close the data connection
                 self.data_socket.close()
 
                 # Wait for final response
-                response = self.control_socket.recv(BUFFER_SIZE).decode()
-                print(f"Server response: {response}")
+                response = self.read_reply()
+                log.info("Server response: %s", response)
 
                 if response.startswith("226"):
-                    print(f"File '{file_path}' downloaded successfully to {destination_path}")
+                    log.info("'%s' downloaded to %s", file_path, destination_path)
+                    if verify:
+                        return self.verify_transfer(file_path, hasher, offset)
                 else:
-                    print(f"Unexpected response after transfer: {response}")
+                    log.error("Download of '%s' failed: %s", file_path, response)
             else:
-                print("Error: File transfer could not be started.")
+                log.error("Download of '%s' could not be started: %s", file_path, response)
         else:
-            print(f"Error: {response}")
+            log.error("Download of '%s' refused: %s", file_path, response)
+
+    def retrieve_file_segmented(self, file_path, segments=DOWNLOAD_SEGMENTS):
+        """Download a file as byte ranges fetched over several parallel sessions.
+
+        The destination is preallocated and every segment is written at its
+        own offset. Returns True once the size of each segment and of the
+        whole file, and the remote modification time, check out, and the
+        assembled file matches the server's digest. A server that does not
+        answer HASH leaves only the size and modification time checked.
+        """
+        file_name = file_path.split("\\")[-1]
+        destination_path = download_dir() / file_name
+
+        size = self.size(file_path)
+        if size is None:
+            log.error("'%s' not found on the server.", file_path)
+            return False
+        modified = self.mdtm(file_path)
+
+        # Split into equal ranges, the last one taking the remainder
+        count = max(1, min(segments, size // MIN_SEGMENT_SIZE))
+        segment_size = size // count
+        ranges = [(i * segment_size, size if i == count - 1 else (i + 1) * segment_size) for i in range(count)]
+
+        with open(destination_path, "wb") as f:
+            f.truncate(size)
+            if size and hasattr(os, "posix_fallocate"):
+                os.posix_fallocate(f.fileno(), 0, size)
+
+        log.info("Downloading %s (%s bytes) in %s segments to %s", file_path, size, count, destination_path)
+        with ThreadPoolExecutor(max_workers=count) as pool:
+            received = list(pool.map(lambda r: self.retrieve_segment(file_path, destination_path, *r), ranges))
+
+        complete = all(got == end - start for got, (start, end) in zip(received, ranges))
+        complete = complete and destination_path.stat().st_size == size and self.mdtm(file_path) == modified
+        if complete:
+            digest = self.hash(file_path)
+            if digest is None:
+                log.warning("No digest for '%s' from the server; checked its size and modification time only.",
+                            file_path)
+            else:
+                complete = hash_file(destination_path, DEFAULT_ALGORITHM) == digest
+        if complete:
+            log.info("'%s' downloaded to %s", file_path, destination_path)
+        else:
+            log.error("Segmented download of '%s' is incomplete, corrupt, or the file changed on the server.",
+                      file_path)
+        return complete
+
+    def retrieve_segment(self, file_path, destination_path, start, end):
+        """Fetch bytes [start, end) of a remote file on a new session into the same range of a local file."""
+        if start == end:
+            return 0
+
+        session = FTPClient(self.host, self.port)
+        try:
+            session.read_reply()
+            if not session.login(*self.credentials):
+                return 0
+            if self.current_dir:
+                session.cwd(self.current_dir)
+
+            if not session.control_connection(f"RANG {start} {end - 1}").startswith("350"):
+                return 0
+            response = session.control_connection(f"RETR {file_path}")
+            if not response.startswith("227"):
+                return 0
+
+            parts = response.split("(")[1].split(")")[0].split(",")
+            session.data_connection(int(parts[4]) * 256 + int(parts[5]))
+            response = session.read_reply()
+            if not response.startswith("150"):
+                session.data_socket.close()
+                return 0
+
+            with open(destination_path, "r+b") as f:
+                f.seek(start)
+                received = receive_file(session.data_socket, f, TRANSFER_BUFFER_SIZE, end - start)
+            session.data_socket.close()
+
+            response = session.read_reply()
+            return received if response.startswith("226") else 0
+        finally:
+            session.quit()
 
     def delete_file(self, file_path):
-        self.control_socket.send(f"DELE {file_path}".encode())
-        response = self.control_socket.recv(BUFFER_SIZE).decode()
-        print(response)
+        return self.control_connection(f"DELE {file_path}")
 
     def quit(self):
         """Send the QUIT command to the server and close the connection."""
@@ -197,42 +666,42 @@ class FTPClient:
         self.control_socket.close()
 
     def make_directory(self, directory_path):
-        self.control_socket.send(f"MKD {directory_path}".encode())
-        response = self.control_socket.recv(BUFFER_SIZE).decode()
-        print(response)
+        return self.control_connection(f"MKD {directory_path}")
 
     def cdup(self):
-        self.control_socket.send("CDUP".encode())
-        print(self.control_socket.recv(BUFFER_SIZE).decode())
+        return self.control_connection("CDUP")
 
     def pwd(self):
-        self.control_socket.send("PWD".encode())
-        print(self.control_socket.recv(BUFFER_SIZE).decode())
+        return self.control_connection("PWD")
 
     def cwd(self, new_path):
-        self.control_socket.send(f"CWD {new_path}".encode())
-        print(self.control_socket.recv(BUFFER_SIZE).decode())
-
-    def user(self, usrnme):
-        self.control_socket.send(f"USER {usrnme}".encode())
-        response = self.control_socket.recv(BUFFER_SIZE).decode()
+        response = self.control_connection(f"CWD {new_path}")
+        if response.startswith("250"):
+            self.current_dir = new_path
+        return response
 
-        print(response)
+    def login(self, usrnme, password=None):
+        """Log in as `usrnme`, prompting for the password if none is given; return True on success."""
+        response = self.control_connection(f"USER {usrnme}")
         if response.startswith("331"):
-            password = input("PASS ")
-            self.control_socket.send(f"PASS {password}".encode())
-            response = self.control_socket.recv(BUFFER_SIZE).decode()
-            print(response)
+            if password is None:
+                password = input("PASS ")
+            response = self.control_connection(f"PASS {password}")
             if response.startswith("230"):
-                response = self.control_socket.recv(BUFFER_SIZE).decode()
-                print(response)
                 self.authenticated = True
+                self.credentials = (usrnme, password)
+        return self.authenticated
+
+    def user(self, usrnme):
+        self.login(usrnme)
 
 
 # Example usage
 if __name__ == "__main__":
+    setup_logging(json_format=False)
+    BASE_DIR.mkdir(exist_ok=True)
     client = FTPClient(SERVER_HOST, SERVER_PORT)
-    print(client.control_socket.recv(BUFFER_SIZE).decode())
+    print(client.read_reply())
     while not client.authenticated:
         # Login
         username = input("USER ")
@@ -257,6 +726,32 @@ if __name__ == "__main__":
         elif option.startswith("STOR"):
             if len(option.split(" ")) > 2:
                 client.store_file(option.split(" ")[1], option.split(" ")[2])
+        elif option.startswith("XDLT"):
+            # XDLT <path> <destination>: delta upload of a file the server already has
+            if len(option.split(" ")) > 2:
+                print(client.store_file_delta(option.split(" ")[1], option.split(" ")[2]))
+        elif option.startswith("MODE"):
+            if len(option.split(" ")) > 1:
+                client.set_mode(option.split(" ")[1])
+        elif option.startswith("MRET"):
+            if len(option.split(" ")) > 1:
+                client.retrieve_files(option.split(" ")[1:])
+        elif option.startswith("MSTR"):
+            # MSTR <destination> <path> [<path> ...]
+            if len(option.split(" ")) > 2:
+                client.store_files(option.split(" ")[2:], option.split(" ")[1])
+        elif option.startswith("RNFR"):
+            # RNFR <from> <to>
+            if len(option.split(" ")) > 2:
+                client.rename(option.split(" ")[1], option.split(" ")[2])
+        elif option.startswith("COPY"):
+            if len(option.split(" ")) > 2:
+                client.copy(option.split(" ")[1], option.split(" ")[2])
+        elif option.startswith("SITE"):
+            if len(option.split(" ")) > 1:
+                print(client.site(option.split(" ", 1)[1]))
+        elif option == "STAT":
+            print(client.status())
         elif option.startswith("DELE"):
             if len(option.split(" ")) > 1:
                 client.delete_file(option.split(" ")[1])
@@ -0,0 +1,158 @@
+import threading
+import time
+import zlib
+from pathlib import PurePath
+
+try:
+    import zstandard
+except ImportError:  # zstd is optional; MODE Z falls back to zlib only
+    zstandard = None
+
+# Compression methods for MODE Z and their accepted levels
+LEVELS = {"zlib": range(0, 10)}
+if zstandard is not None:
+    LEVELS["zstd"] = range(1, 23)
+DEFAULT_METHOD = "zlib"
+DEFAULT_LEVELS = {"zlib": 6, "zstd": 3}
+
+# Most output one piece of decompressed data may hold (zlib), and how much compressed input
+# zstd, which has no output limit, is given at a time: at most a few MiB can come out of it
+MAX_DECOMPRESSED_PIECE = 1024 * 1024
+ZSTD_INPUT_SLICE = 256
+
+# File types that are already compressed and are sent as they are even in MODE Z
+COMPRESSED_SUFFIXES = {
+    ".gz", ".tgz", ".bz2", ".xz", ".zst", ".lz4", ".zip", ".7z", ".rar",
+    ".jpg", ".jpeg", ".png", ".gif", ".webp", ".mp3", ".mp4", ".mkv", ".webm", ".avi", ".mov", ".pdf",
+}
+
+
+def is_compressed(file_name):
+    """Check whether a file's type is already compressed."""
+    return PurePath(str(file_name)).suffix.lower() in COMPRESSED_SUFFIXES
+
+
+def announce(method):
+    """Text a 150 reply carries when the data that follows is compressed."""
+    return f" in MODE Z ({method})"
+
+
+def announced_method(reply):
+    """Return the compression method a 150 reply announces, or None for plain data."""
+    if " in MODE Z (" not in reply:
+        return None
+    return reply.split(" in MODE Z (")[1].split(")")[0]
+
+
+class Compressor:
+    """Streaming compressor that counts bytes in and out and the CPU time it spends."""
+
+    def __init__(self, method=DEFAULT_METHOD, level=None):
+        level = DEFAULT_LEVELS[method] if level is None else level
+        if method == "zstd":
+            self._stream = zstandard.ZstdCompressor(level=level).compressobj()
+        else:
+            self._stream = zlib.compressobj(level)
+        self.method = method
+        self.raw_bytes = 0
+        self.wire_bytes = 0
+        self.cpu_time = 0.0
+
+    def compress(self, data):
+        started = time.thread_time()
+        out = self._stream.compress(data)
+        self.cpu_time += time.thread_time() - started
+        self.raw_bytes += len(data)
+        self.wire_bytes += len(out)
+        return out
+
+    def flush(self):
+        started = time.thread_time()
+        out = self._stream.flush()
+        self.cpu_time += time.thread_time() - started
+        self.wire_bytes += len(out)
+        return out
+
+
+class Decompressor:
+    """Streaming decompressor, the counterpart of Compressor.
+
+    Output comes in bounded pieces, so a small upload that expands enormously
+    (a decompression bomb) never sits in memory at once. A corrupt stream
+    raises ConnectionError, like a truncated one.
+    """
+
+    def __init__(self, method=DEFAULT_METHOD):
+        if method == "zstd":
+            self._stream = zstandard.ZstdDecompressor().decompressobj()
+            self._errors = (zstandard.ZstdError,)
+        else:
+            self._stream = zlib.decompressobj()
+            self._errors = (zlib.error,)
+        self.method = method
+        self.raw_bytes = 0
+        self.wire_bytes = 0
+        self.cpu_time = 0.0
+
+    def iter_decompress(self, data):
+        """Yield the decompressed output of `data` in pieces of at most a few MiB."""
+        self.wire_bytes += len(data)
+        pending = memoryview(data)
+        while pending:
+            started = time.thread_time()
+            try:
+                if self.method == "zstd":
+                    out = self._stream.decompress(pending[:ZSTD_INPUT_SLICE])
+                    pending = pending[ZSTD_INPUT_SLICE:]
+                else:
+                    # Stops after MAX_DECOMPRESSED_PIECE bytes; the rest of the input waits in unconsumed_tail
+                    out = self._stream.decompress(pending, MAX_DECOMPRESSED_PIECE)
+                    pending = self._stream.unconsumed_tail
+            except self._errors as e:
+                raise ConnectionError(f"Corrupt {self.method} stream: {e}") from e
+            finally:
+                self.cpu_time += time.thread_time() - started
+            if out:
+                self.raw_bytes += len(out)
+                yield out
+
+    def finish(self):
+        """Check that the compressed stream ended properly; raises ConnectionError if it was cut short."""
+        if not getattr(self._stream, "eof", True):
+            raise ConnectionError("Compressed stream truncated.")
+
+
+class CompressionStats:
+    """Totals over MODE Z transfers: bytes before and after compression and CPU time spent."""
+
+    def __init__(self):
+        self._lock = threading.Lock()
+        self.transfers = 0
+        self.skipped = 0
+        self.raw_bytes = 0
+        self.wire_bytes = 0
+        self.cpu_time = 0.0
+
+    def record(self, codec):
+        """Add a finished transfer's Compressor or Decompressor."""
+        with self._lock:
+            self.transfers += 1
+            self.raw_bytes += codec.raw_bytes
+            self.wire_bytes += codec.wire_bytes
+            self.cpu_time += codec.cpu_time
+
+    def record_skipped(self):
+        """Count a MODE Z transfer sent uncompressed because the file already was."""
+        with self._lock:
+            self.skipped += 1
+
+    def stats(self):
+        with self._lock:
+            return {
+                "transfers": self.transfers,
+                "skipped": self.skipped,
+                "raw_bytes": self.raw_bytes,
+                "wire_bytes": self.wire_bytes,
+                "ratio": self.raw_bytes / self.wire_bytes if self.wire_bytes else 0.0,
+                "cpu_time": self.cpu_time,
+            }
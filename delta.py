@@ -0,0 +1,249 @@
+import hashlib
+import math
+import os
+import struct
+import tempfile
+import zlib
+from contextlib import contextmanager
+from pathlib import Path
+
+# rsync-style delta uploads. The server describes its copy of a file as a
+# signature: per full block a weak rolling checksum (Adler-32) and a strong
+# one (BLAKE2b). The client slides a window over its new version, rolling
+# the weak checksum a byte at a time, and sends a delta: references to
+# blocks the server already has plus literal data for everything else.
+
+MIN_BLOCK_SIZE = 2 * 1024
+MAX_BLOCK_SIZE = 128 * 1024
+STRONG_DIGEST_SIZE = 16
+# Literal data is sent in ops of at most this size
+MAX_LITERAL = 1024 * 1024
+# The new file is read in chunks of this size while the delta is computed
+READ_SIZE = 4 * 1024 * 1024
+
+ADLER_MOD = 65521
+
+# Signature: header (block size, file size, mtime in ns), then per block (weak, strong)
+SIGNATURE_HEADER = struct.Struct("!IQq")
+SIGNATURE_BLOCK = struct.Struct(f"!I{STRONG_DIGEST_SIZE}s")
+
+# Delta: header (block size, basis size, basis mtime in ns) naming the signature it was made
+# against, then ops. "C" copies `count` basis blocks from `index`, "L" carries literal data,
+# "E" ends the delta with the SHA-256 and size of the new file.
+DELTA_HEADER = SIGNATURE_HEADER
+COPY = struct.Struct("!cII")
+LITERAL = struct.Struct("!cI")
+END = struct.Struct("!c32sQ")
+
+
+def block_size_for(size):
+    """Pick a block size of about sqrt(size).
+
+    Small enough to localise changes, large enough to keep signatures small.
+    """
+    return min(MAX_BLOCK_SIZE, max(MIN_BLOCK_SIZE, 1 << math.isqrt(size).bit_length()))
+
+
+def strong_digest(data):
+    return hashlib.blake2b(data, digest_size=STRONG_DIGEST_SIZE).digest()
+
+
+def iter_signature(f, block_size):
+    """Yield the signature of an open file: its header, then one packed entry per full block."""
+    stats = os.fstat(f.fileno())
+    yield SIGNATURE_HEADER.pack(block_size, stats.st_size, stats.st_mtime_ns)
+    f.seek(0)
+    while len(block := f.read(block_size)) == block_size:
+        yield SIGNATURE_BLOCK.pack(zlib.adler32(block), strong_digest(block))
+
+
+class Signature:
+    """A parsed signature: block size, identity of the server's copy and its block checksums."""
+
+    def __init__(self, data):
+        self.block_size, self.size, self.mtime_ns = SIGNATURE_HEADER.unpack_from(data)
+        self.blocks = {}  # weak -> {strong: first block index}
+        for index, (weak, strong) in enumerate(SIGNATURE_BLOCK.iter_unpack(data[SIGNATURE_HEADER.size:])):
+            self.blocks.setdefault(weak, {}).setdefault(strong, index)
+
+    def header(self):
+        return DELTA_HEADER.pack(self.block_size, self.size, self.mtime_ns)
+
+
+def iter_matches(f, block_size, blocks, new_hash):
+    """Yield ("C", block index) for each window of `f` found in the basis and ("L", data) for the bytes between."""
+    buf = bytearray()
+    pos = lit = 0  # window start, and start of the pending literal, in buf
+    a = b = None   # Adler-32 halves of the window, None when it has to be recomputed
+    eof = False
+    while True:
+        # Keep a full window plus the byte that rolls into it
+        if len(buf) - pos <= block_size and not eof:
+            if lit < pos:
+                yield "L", buf[lit:pos]
+            del buf[:pos]
+            pos = lit = 0
+            chunk = f.read(READ_SIZE)
+            new_hash.update(chunk)
+            eof = not chunk
+            buf += chunk
+            a = None
+            continue
+
+        end = pos + block_size
+        if end > len(buf):
+            break
+        if a is None:
+            weak = zlib.adler32(buf[pos:end])
+            a, b = weak & 0xffff, weak >> 16
+
+        candidates = blocks.get((b << 16) | a)
+        if candidates is not None:
+            index = candidates.get(strong_digest(buf[pos:end]))
+            if index is not None:
+                if lit < pos:
+                    yield "L", buf[lit:pos]
+                yield "C", index
+                pos = lit = end
+                a = None
+                continue
+
+        if end == len(buf):
+            break  # end of file: nothing left to roll in
+
+        # Slide the window one byte
+        out_byte, in_byte = buf[pos], buf[end]
+        a = (a - out_byte + in_byte) % ADLER_MOD
+        b = (b - block_size * out_byte + a - 1) % ADLER_MOD
+        pos += 1
+
+    if lit < len(buf):
+        yield "L", buf[lit:]
+
+
+def iter_delta(f, signature, stats=None):
+    """Yield the packed delta that turns the signature's file into the contents of `f`.
+
+    `stats`, if given, is a dict that receives "matched" and "literal" byte counts.
+    """
+    new_hash = hashlib.sha256()
+    matched = literal = 0
+    copy_from = copy_count = 0
+
+    yield signature.header()
+    for kind, value in iter_matches(f, signature.block_size, signature.blocks, new_hash):
+        if kind == "C":
+            matched += signature.block_size
+            # Runs of consecutive blocks go out as one op
+            if copy_count and copy_from + copy_count == value:
+                copy_count += 1
+                continue
+            if copy_count:
+                yield COPY.pack(b"C", copy_from, copy_count)
+            copy_from, copy_count = value, 1
+        else:
+            if copy_count:
+                yield COPY.pack(b"C", copy_from, copy_count)
+                copy_count = 0
+            literal += len(value)
+            for start in range(0, len(value), MAX_LITERAL):
+                chunk = value[start:start + MAX_LITERAL]
+                yield LITERAL.pack(b"L", len(chunk)) + chunk
+    if copy_count:
+        yield COPY.pack(b"C", copy_from, copy_count)
+
+    if stats is not None:
+        stats.update(matched=matched, literal=literal)
+    yield END.pack(b"E", new_hash.digest(), matched + literal)
+
+
+class DeltaWriter:
+    """Rebuild a file from a basis and delta ops into a temporary file next to it.
+
+    `commit` checks the result against the delta's SHA-256 and size and moves
+    it over the target with os.replace, so readers see the old or the new
+    version, never a mix.
+    """
+
+    def __init__(self, basis_path, block_size):
+        self.basis_path = Path(basis_path)
+        self.block_size = block_size
+        self.basis = open(basis_path, "rb")
+        fd, self.temp_path = tempfile.mkstemp(dir=self.basis_path.parent, prefix=f".{self.basis_path.name}.",
+                                              suffix=".delta")
+        self.out = os.fdopen(fd, "wb")
+        self.hash = hashlib.sha256()
+        self.size = 0
+
+    def copy(self, index, count):
+        self.basis.seek(index * self.block_size)
+        remaining = count * self.block_size
+        while remaining:
+            data = self.basis.read(min(remaining, MAX_LITERAL))
+            if not data:
+                raise ValueError("Delta refers past the end of the basis file.")
+            self.literal(data)
+            remaining -= len(data)
+
+    def literal(self, data):
+        self.out.write(data)
+        self.hash.update(data)
+        self.size += len(data)
+
+    def commit(self, digest, size):
+        """Replace the basis with the rebuilt file; raises ValueError if it does not match the delta."""
+        self.out.close()
+        self.basis.close()
+        if digest != self.hash.digest() or size != self.size:
+            raise ValueError("Rebuilt file does not match the delta.")
+        os.chmod(self.temp_path, os.stat(self.basis_path).st_mode & 0o7777)
+        os.replace(self.temp_path, self.basis_path)
+
+    def discard(self):
+        self.out.close()
+        self.basis.close()
+        try:
+            os.remove(self.temp_path)
+        except FileNotFoundError:
+            pass
+
+
+@contextmanager
+def rebuild(basis_path, block_size):
+    """A DeltaWriter whose temporary file is removed unless it was committed."""
+    writer = DeltaWriter(basis_path, block_size)
+    try:
+        yield writer
+    finally:
+        if os.path.exists(writer.temp_path):
+            writer.discard()
+
+
+def apply_delta(read_exactly, basis_path):
+    """Read a delta with `read_exactly(n)` and rebuild `basis_path` from it; return the new size.
+
+    Raises ValueError if the basis changed since its signature was taken or
+    the result does not match, leaving the basis untouched.
+    """
+    block_size, basis_size, basis_mtime_ns = DELTA_HEADER.unpack(read_exactly(DELTA_HEADER.size))
+    stats = os.stat(basis_path)
+    if (stats.st_size, stats.st_mtime_ns) != (basis_size, basis_mtime_ns):
+        raise ValueError("File changed since its signature was sent.")
+
+    with rebuild(basis_path, block_size) as writer:
+        while True:
+            op = read_exactly(1)
+            if op == b"C":
+                index, count = COPY.unpack(op + read_exactly(COPY.size - 1))[1:]
+                writer.copy(index, count)
+            elif op == b"L":
+                length = LITERAL.unpack(op + read_exactly(LITERAL.size - 1))[1]
+                if length > MAX_LITERAL:
+                    raise ValueError("Literal too long.")
+                writer.literal(read_exactly(length))
+            elif op == b"E":
+                digest, size = END.unpack(op + read_exactly(END.size - 1))[1:]
+                writer.commit(digest, size)
+                return size
+            else:
+                raise ValueError(f"Unknown delta op {op!r}.")
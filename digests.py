@@ -0,0 +1,139 @@
+import hashlib
+import os
+import sqlite3
+import threading
+import zlib
+from pathlib import Path
+
+# Buffer reused while hashing a file
+HASH_BUFFER_SIZE = 256 * 1024
+
+
+class Crc32:
+    """CRC-32 with the hashlib update/hexdigest interface."""
+
+    name = "crc32"
+
+    def __init__(self):
+        self.value = 0
+
+    def update(self, data):
+        self.value = zlib.crc32(data, self.value)
+
+    def hexdigest(self):
+        return f"{self.value:08x}"
+
+
+# Digest algorithms by their FTP HASH names
+ALGORITHMS = {
+    "SHA-256": hashlib.sha256,
+    "SHA-512": hashlib.sha512,
+    "SHA-1": hashlib.sha1,
+    "MD5": hashlib.md5,
+    "CRC32": Crc32,
+}
+DEFAULT_ALGORITHM = "SHA-256"
+
+
+def new_hasher(algorithm):
+    return ALGORITHMS[algorithm]()
+
+
+def hash_file(path, algorithm, offset=0, count=None, buffer_size=HASH_BUFFER_SIZE):
+    """Return the hex digest of `count` bytes (or the rest) of a file from `offset`."""
+    hasher = new_hasher(algorithm)
+    buffer = bytearray(buffer_size)
+    view = memoryview(buffer)
+    hashed = 0
+    with open(path, "rb") as f:
+        f.seek(offset)
+        while count is None or hashed < count:
+            size = buffer_size if count is None else min(buffer_size, count - hashed)
+            read = f.readinto(view[:size])
+            if not read:
+                break
+            hasher.update(view[:read])
+            hashed += read
+    return hasher.hexdigest()
+
+
+class DigestIndex:
+    """Persistent cache of file digests in an SQLite database.
+
+    Each digest is stored with the size, mtime and inode the file had when
+    it was hashed; a lookup re-stats the file and ignores a digest whose
+    identity no longer matches, so changes made outside the server are
+    caught. The server's own STOR/DELE/RMD drop entries directly.
+
+    The database connection is opened lazily and reopened after a fork, so
+    supervisor workers share the index file but never a connection.
+    """
+
+    def __init__(self, path):
+        self.path = Path(path)
+        self._lock = threading.Lock()
+        self._db = None
+        self._pid = None
+        self.hits = 0
+        self.misses = 0
+
+    def _connection(self):
+        if self._db is None or self._pid != os.getpid():
+            self._db = sqlite3.connect(self.path, check_same_thread=False, timeout=30)
+            self._db.execute("PRAGMA journal_mode=WAL")
+            self._db.execute(
+                "CREATE TABLE IF NOT EXISTS digests ("
+                "path TEXT, algorithm TEXT, start INTEGER, count INTEGER, "
+                "size INTEGER, mtime_ns INTEGER, inode INTEGER, digest TEXT, "
+                "PRIMARY KEY (path, algorithm, start, count))")
+            self._pid = os.getpid()
+        return self._db
+
+    @staticmethod
+    def _identity(stats):
+        return stats.st_size, stats.st_mtime_ns, stats.st_ino
+
+    def digest(self, path, algorithm=DEFAULT_ALGORITHM, offset=0, count=None):
+        """Return the digest of a file or byte range, from the index or by hashing the file."""
+        key = str(Path(path).resolve())
+        stats = os.stat(key)
+        stored_count = -1 if count is None else count
+        with self._lock:
+            row = self._connection().execute(
+                "SELECT size, mtime_ns, inode, digest FROM digests "
+                "WHERE path = ? AND algorithm = ? AND start = ? AND count = ?",
+                (key, algorithm, offset, stored_count)).fetchone()
+            if row is not None and tuple(row[:3]) == self._identity(stats):
+                self.hits += 1
+                return row[3]
+            self.misses += 1
+
+        digest = hash_file(key, algorithm, offset, count)
+
+        # Only keep the digest if the file did not change while it was hashed
+        if self._identity(os.stat(key)) == self._identity(stats):
+            with self._lock, self._connection() as db:
+                db.execute("INSERT OR REPLACE INTO digests VALUES (?, ?, ?, ?, ?, ?, ?, ?)",
+                           (key, algorithm, offset, stored_count, *self._identity(stats), digest))
+        return digest
+
+    def invalidate(self, path, subtree=False):
+        """Drop the digests of a file, or of everything below a directory with `subtree`."""
+        key = str(Path(path).resolve())
+        with self._lock, self._connection() as db:
+            db.execute("DELETE FROM digests WHERE path = ?", (key,))
+            if subtree:
+                prefix = key.rstrip(os.sep) + os.sep
+                db.execute("DELETE FROM digests WHERE substr(path, 1, ?) = ?", (len(prefix), prefix))
+
+    def stats(self):
+        """Return hit/miss counters and the number of stored digests."""
+        with self._lock:
+            entries = self._connection().execute("SELECT COUNT(*) FROM digests").fetchone()[0]
+            lookups = self.hits + self.misses
+            return {
+                "entries": entries,
+                "hits": self.hits,
+                "misses": self.misses,
+                "hit_ratio": self.hits / lookups if lookups else 0.0,
+            }
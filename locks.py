@@ -0,0 +1,266 @@
+import hashlib
+import os
+import threading
+import time
+from contextlib import contextmanager, ExitStack
+from pathlib import Path
+
+import metrics
+
+try:
+    import fcntl
+except ImportError:  # Windows: only the in-process PathLockManager is available
+    fcntl = None
+
+# Paths whose lock waits are tracked individually; the least contended is dropped for a new one
+CONTENTION_PATHS = 64
+
+
+@contextmanager
+def lock_paths(manager, reads=(), writes=()):
+    """Hold read locks on `reads` and write locks on `writes` together (RNTO, COPY).
+
+    The locks are taken in path order, so two sessions locking the same pair
+    the other way round cannot deadlock. The paths must not contain one another.
+    """
+    requests = [(Path(path).resolve(), manager.read) for path in reads]
+    requests += [(Path(path).resolve(), manager.write) for path in writes]
+    with ExitStack() as stack:
+        for path, lock in sorted(requests, key=lambda request: str(request[0])):
+            stack.enter_context(lock(path))
+        yield
+
+
+class ContentionStats:
+    """Wait counts and times for the CONTENTION_PATHS paths that waited longest."""
+
+    def __init__(self, size=CONTENTION_PATHS):
+        self.size = size
+        self._lock = threading.Lock()
+        self._paths = {}  # path -> {"waits", "wait_time", "max_wait"}
+
+    def record(self, path, waited, mode):
+        with self._lock:
+            stats = self._paths.get(path)
+            if stats is None:
+                if len(self._paths) >= self.size:
+                    del self._paths[min(self._paths, key=lambda key: self._paths[key]["wait_time"])]
+                stats = self._paths[path] = {"waits": 0, "wait_time": 0.0, "max_wait": 0.0}
+            stats["waits"] += 1
+            stats["wait_time"] += waited
+            stats["max_wait"] = max(stats["max_wait"], waited)
+        metrics.lock_waits.observe(waited, mode)
+
+    def snapshot(self):
+        with self._lock:
+            return {str(path): dict(stats) for path, stats in self._paths.items()}
+
+
+class PathLockManager:
+    """Reader/writer locks keyed on resolved paths.
+
+    Any number of readers may hold a path at once; a writer is exclusive.
+    A write lock covers the whole subtree below its path, so taking one on a
+    directory (RMD) waits for every reader and writer inside it, and blocks
+    new ones until it is released.
+    """
+
+    def __init__(self):
+        self._cond = threading.Condition()
+        self._readers = {}          # path -> number of active readers
+        self._writers = set()       # paths with an active writer
+        self._waiting_writers = {}  # path -> number of queued writers
+        self._contention = ContentionStats()
+
+    @staticmethod
+    def _key(path):
+        return Path(path).resolve()
+
+    @staticmethod
+    def _covers(parent, child):
+        """Return True if `child` is `parent` or lies below it."""
+        return parent == child or parent in child.parents
+
+    def _can_read(self, path):
+        # Blocked by a writer on the path or on any directory above it, and
+        # by a queued writer on the same path so writers are not starved.
+        if any(self._covers(w, path) for w in self._writers):
+            return False
+        return not self._waiting_writers.get(path)
+
+    def _can_write(self, path):
+        if any(self._covers(w, path) or self._covers(path, w) for w in self._writers):
+            return False
+        return not any(self._covers(path, r) for r in self._readers)
+
+    def acquire_read(self, path):
+        key = self._key(path)
+        with self._cond:
+            if not self._can_read(key):
+                started = time.monotonic()
+                self._cond.wait_for(lambda: self._can_read(key))
+                self._contention.record(key, time.monotonic() - started, "read")
+            self._readers[key] = self._readers.get(key, 0) + 1
+        return key
+
+    def release_read(self, key):
+        with self._cond:
+            self._readers[key] -= 1
+            if not self._readers[key]:
+                del self._readers[key]
+            self._cond.notify_all()
+
+    def acquire_write(self, path):
+        key = self._key(path)
+        with self._cond:
+            if not self._can_write(key):
+                started = time.monotonic()
+                self._waiting_writers[key] = self._waiting_writers.get(key, 0) + 1
+                try:
+                    self._cond.wait_for(lambda: self._can_write(key))
+                finally:
+                    self._waiting_writers[key] -= 1
+                    if not self._waiting_writers[key]:
+                        del self._waiting_writers[key]
+                self._contention.record(key, time.monotonic() - started, "write")
+            self._writers.add(key)
+        return key
+
+    def release_write(self, key):
+        with self._cond:
+            self._writers.discard(key)
+            self._cond.notify_all()
+
+    @contextmanager
+    def read(self, path):
+        """Hold a shared lock on `path` for the duration of the block."""
+        key = self.acquire_read(path)
+        try:
+            yield key
+        finally:
+            self.release_read(key)
+
+    @contextmanager
+    def write(self, path):
+        """Hold an exclusive lock on `path` (and its subtree) for the block."""
+        key = self.acquire_write(path)
+        try:
+            yield key
+        finally:
+            self.release_write(key)
+
+    def contention_stats(self):
+        """Return wait counts and wait times of the most contended paths."""
+        return self._contention.snapshot()
+
+
+class InterProcessLockManager:
+    """Path locks shared by several worker processes, built on flock(2) lock files.
+
+    Every path maps to a lock file in `lock_dir`. An operation takes shared
+    locks on the lock files of all the directories above its path, from the
+    root down, and then a shared (read) or exclusive (write) lock on the path
+    itself. An exclusive lock on a directory therefore waits for everything
+    happening inside it, the same subtree rule as PathLockManager, and the
+    fixed root-first order rules out deadlocks.
+
+    The last holder of a lock file deletes it on release, so the directory only
+    holds files for paths in use. A process that opened a file just before it
+    was deleted finds it unlinked once it gets the lock, and tries again.
+    """
+
+    def __init__(self, lock_dir):
+        if fcntl is None:
+            raise RuntimeError("Inter-process path locks need fcntl.flock (POSIX only).")
+        self.lock_dir = Path(lock_dir)
+        self.lock_dir.mkdir(parents=True, exist_ok=True)
+        self._contention = ContentionStats()
+
+    def _lock_file(self, path):
+        return self.lock_dir / hashlib.sha1(str(path).encode()).hexdigest()
+
+    def _lock(self, path, mode):
+        """Open and flock the lock file of `path`; return (fd, lock file)."""
+        lock_file = self._lock_file(path)
+        while True:
+            fd = os.open(lock_file, os.O_RDWR | os.O_CREAT, 0o600)
+            try:
+                try:
+                    fcntl.flock(fd, mode | fcntl.LOCK_NB)
+                except BlockingIOError:
+                    started = time.monotonic()
+                    fcntl.flock(fd, mode)
+                    self._contention.record(path, time.monotonic() - started,
+                                            "write" if mode == fcntl.LOCK_EX else "read")
+                # Locked the file a releasing holder has just deleted: start over with the new one
+                current = os.stat(lock_file).st_ino
+            except FileNotFoundError:
+                current = None
+            except BaseException:
+                os.close(fd)
+                raise
+            if current == os.fstat(fd).st_ino:
+                return fd, lock_file
+            os.close(fd)
+
+    def _acquire(self, path, exclusive):
+        key = Path(path).resolve()
+        locked = []
+        try:
+            for lock_path in [*reversed(key.parents), key]:
+                mode = fcntl.LOCK_EX if exclusive and lock_path == key else fcntl.LOCK_SH
+                locked.append(self._lock(lock_path, mode))
+        except BaseException:
+            self._release(locked)
+            raise
+        return locked
+
+    @staticmethod
+    def _release(locked):
+        for fd, lock_file in reversed(locked):
+            # Only a holder that can make its lock exclusive is the last one and may delete the file
+            try:
+                fcntl.flock(fd, fcntl.LOCK_EX | fcntl.LOCK_NB)
+            except BlockingIOError:
+                pass
+            else:
+                try:
+                    os.unlink(lock_file)
+                except FileNotFoundError:
+                    pass
+            fcntl.flock(fd, fcntl.LOCK_UN)
+            os.close(fd)
+
+    def acquire_read(self, path):
+        return self._acquire(path, exclusive=False)
+
+    def release_read(self, handle):
+        self._release(handle)
+
+    def acquire_write(self, path):
+        return self._acquire(path, exclusive=True)
+
+    def release_write(self, handle):
+        self._release(handle)
+
+    @contextmanager
+    def read(self, path):
+        """Hold a shared lock on `path` for the duration of the block."""
+        handle = self.acquire_read(path)
+        try:
+            yield handle
+        finally:
+            self.release_read(handle)
+
+    @contextmanager
+    def write(self, path):
+        """Hold an exclusive lock on `path` (and its subtree) for the block."""
+        handle = self.acquire_write(path)
+        try:
+            yield handle
+        finally:
+            self.release_write(handle)
+
+    def contention_stats(self):
+        """Return this process's wait counts and wait times of the most contended paths."""
+        return self._contention.snapshot()
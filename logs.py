@@ -0,0 +1,150 @@
+import atexit
+import itertools
+import json
+import logging
+import logging.handlers
+import os
+import queue
+import sys
+import time
+
+import metrics
+
+# Records waiting for the writer thread; when it falls this far behind, new records are dropped
+LOG_QUEUE_SIZE = 10000
+DEFAULT_LEVEL = "INFO"
+# Logger whose records (one per control command) are sampled, keeping one in LOG_COMMAND_SAMPLE
+COMMAND_LOGGER = "ftp.command"
+LOG_COMMAND_SAMPLE = 1
+
+# Fields passed with `extra` that the formatters write out
+CONTEXT_FIELDS = ("session", "peer", "user", "command", "duration_ms", "sample_rate")
+
+dropped_records = metrics.registry.counter("ftp_log_records_dropped_total",
+                                           "Log records dropped because the log writer fell behind.")
+
+_session_ids = itertools.count(1)
+_listener = None  # (QueueListener, pid of the process that started it)
+_settings = None  # arguments of the last setup_logging call
+
+
+def new_session_id():
+    """Return a number identifying a session in its log records."""
+    return next(_session_ids)
+
+
+class JsonFormatter(logging.Formatter):
+    """One JSON object per line: time, level, logger, process, message and any context fields set on the record."""
+
+    def format(self, record):
+        entry = {
+            "time": time.strftime("%Y-%m-%dT%H:%M:%S", time.gmtime(record.created)) + f".{int(record.msecs):03d}Z",
+            "level": record.levelname,
+            "logger": record.name,
+            "pid": record.process,  # session numbers restart in every worker process
+            "message": record.getMessage(),
+        }
+        for field in CONTEXT_FIELDS:
+            value = getattr(record, field, None)
+            if value is not None:
+                entry[field] = value
+        if record.exc_info:
+            entry["exception"] = self.formatException(record.exc_info)
+        return json.dumps(entry, default=str)
+
+
+class TextFormatter(logging.Formatter):
+    """Plain lines for a terminal, with the context fields appended as key=value."""
+
+    def __init__(self):
+        super().__init__("%(asctime)s %(levelname)s %(name)s: %(message)s")
+
+    def format(self, record):
+        line = super().format(record)
+        context = " ".join(f"{field}={getattr(record, field)}" for field in CONTEXT_FIELDS
+                           if getattr(record, field, None) is not None)
+        return f"{line} [{context}]" if context else line
+
+
+class SamplingFilter(logging.Filter):
+    """Pass one in `rate` records of each sampled logger; warnings and errors always pass.
+
+    `rates` maps logger names to rates. Kept records carry `sample_rate` so
+    counts taken from the log can be scaled back up.
+    """
+
+    def __init__(self, rates):
+        super().__init__()
+        self.rates = {name: rate for name, rate in rates.items() if rate > 1}
+        self.counters = {name: itertools.count() for name in self.rates}
+
+    def filter(self, record):
+        rate = self.rates.get(record.name)
+        if rate is None or record.levelno >= logging.WARNING:
+            return True
+        if next(self.counters[record.name]) % rate:
+            return False
+        record.sample_rate = rate
+        return True
+
+
+class DroppingQueueHandler(logging.handlers.QueueHandler):
+    """QueueHandler that never waits: when the queue is full the record is dropped and counted."""
+
+    def enqueue(self, record):
+        try:
+            self.queue.put_nowait(record)
+        except queue.Full:
+            dropped_records.inc()
+
+
+class _Writer(logging.handlers.QueueListener):
+    def enqueue_sentinel(self):
+        # Wait for room instead of put_nowait: on a full queue stop() must not fail
+        self.queue.put(self._sentinel)
+
+
+def setup_logging(level=DEFAULT_LEVEL, json_format=True, command_sample=LOG_COMMAND_SAMPLE, stream=None):
+    """Send the "ftp" loggers through a queue to a writer thread.
+
+    Threads that log only format the message and put the record on a
+    bounded queue, so a slow terminal or pipe never stalls a session; the
+    writer thread turns records into JSON (or text) lines on `stream`
+    (stderr by default). Calling it again, e.g. in a forked worker,
+    replaces the previous setup.
+    """
+    global _listener, _settings
+    _flush()
+    _settings = {"level": level, "json_format": json_format, "command_sample": command_sample, "stream": stream}
+
+    output = logging.StreamHandler(stream or sys.stderr)
+    output.setFormatter(JsonFormatter() if json_format else TextFormatter())
+    records = queue.Queue(LOG_QUEUE_SIZE)
+    listener = _Writer(records, output)
+    listener.start()
+    _listener = (listener, os.getpid())
+
+    handler = DroppingQueueHandler(records)
+    handler.addFilter(SamplingFilter({COMMAND_LOGGER: command_sample}))
+    logger = logging.getLogger("ftp")
+    for old in list(logger.handlers):
+        logger.removeHandler(old)
+    logger.addHandler(handler)
+    logger.setLevel(level)
+    logger.propagate = False
+
+
+def after_fork():
+    """Give a forked worker its own writer thread; the parent's does not exist in the child."""
+    if _settings is not None:
+        setup_logging(**_settings)
+
+
+@atexit.register
+def _flush():
+    # Write out whatever is still queued and stop the writer thread (only
+    # the process that started it has the thread; a forked child does not)
+    global _listener
+    if _listener is not None and _listener[1] == os.getpid():
+        _listener[0].stop()
+    _listener = None
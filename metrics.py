@@ -0,0 +1,246 @@
+import bisect
+import logging
+import threading
+import time
+from contextlib import contextmanager
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+
+# Upper bounds of the histogram buckets: seconds, bytes and bytes per second
+LATENCY_BUCKETS = (0.0005, 0.001, 0.0025, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10, 30, 60)
+SIZE_BUCKETS = tuple(1024 * 4 ** n for n in range(12))  # 1 KiB .. 4 GiB
+THROUGHPUT_BUCKETS = tuple(64 * 1024 * 2 ** n for n in range(14))  # 64 KiB/s .. 512 MiB/s
+
+PROMETHEUS_CONTENT_TYPE = "text/plain; version=0.0.4; charset=utf-8"
+
+log = logging.getLogger("ftp.metrics")
+
+_LABEL_ESCAPES = str.maketrans({"\\": "\\\\", '"': '\\"', "\n": "\\n"})
+
+
+def _format_labels(names, values, extra=""):
+    # Label values such as paths may hold quotes, backslashes or newlines
+    pairs = [f'{name}="{str(value).translate(_LABEL_ESCAPES)}"' for name, value in zip(names, values)]
+    if extra:
+        pairs.append(extra)
+    return "{" + ",".join(pairs) + "}" if pairs else ""
+
+
+def _format_value(value):
+    if value == float("inf"):
+        return "+Inf"
+    return repr(float(value)) if isinstance(value, float) else str(value)
+
+
+class Counter:
+    """A count that only goes up, one per combination of label values."""
+
+    kind = "counter"
+
+    def __init__(self, name, help, labels=()):
+        self.name = name
+        self.help = help
+        self.labels = labels
+        self._lock = threading.Lock()
+        self._values = {}
+
+    def inc(self, amount=1, *label_values):
+        with self._lock:
+            self._values[label_values] = self._values.get(label_values, 0) + amount
+
+    def get(self, *label_values):
+        with self._lock:
+            return self._values.get(label_values, 0)
+
+    def samples(self):
+        with self._lock:
+            return [(self.name, self.labels, values, value) for values, value in sorted(self._values.items())]
+
+
+class Gauge(Counter):
+    """A value that goes up and down, such as the number of open data channels."""
+
+    kind = "gauge"
+
+    def dec(self, amount=1, *label_values):
+        self.inc(-amount, *label_values)
+
+    def set(self, value, *label_values):
+        with self._lock:
+            self._values[label_values] = value
+
+
+class Histogram:
+    """Observations counted into fixed buckets, plus their sum, one set per combination of label values.
+
+    Observing is a bisect and three additions under a lock, cheap enough for every command.
+    """
+
+    kind = "histogram"
+
+    def __init__(self, name, help, labels=(), buckets=LATENCY_BUCKETS):
+        self.name = name
+        self.help = help
+        self.labels = labels
+        self.buckets = tuple(buckets)
+        self._lock = threading.Lock()
+        self._series = {}  # label values -> [per-bucket counts (last one is +Inf), sum]
+
+    def observe(self, value, *label_values):
+        index = bisect.bisect_left(self.buckets, value)
+        with self._lock:
+            series = self._series.get(label_values)
+            if series is None:
+                series = self._series[label_values] = [[0] * (len(self.buckets) + 1), 0.0]
+            series[0][index] += 1
+            series[1] += value
+
+    def summary(self):
+        """Return {label values: (count, sum, p50, p95, p99)}, the quantiles estimated from the buckets."""
+        with self._lock:
+            series = {values: (list(counts), total) for values, (counts, total) in self._series.items()}
+        return {values: (sum(counts), total, *(self._quantile(counts, q) for q in (0.5, 0.95, 0.99)))
+                for values, (counts, total) in series.items()}
+
+    def _quantile(self, counts, q):
+        rank = q * sum(counts)
+        seen = 0
+        for index, count in enumerate(counts):
+            if count and seen + count >= rank:
+                if index == len(self.buckets):
+                    return self.buckets[-1]  # past the last bound: report that bound
+                low = self.buckets[index - 1] if index else 0.0
+                return low + (self.buckets[index] - low) * (rank - seen) / count
+            seen += count
+        return 0.0
+
+    def samples(self):
+        with self._lock:
+            series = sorted((values, list(counts), total) for values, (counts, total) in self._series.items())
+        samples = []
+        for values, counts, total in series:
+            cumulative = 0
+            for bound, count in zip((*self.buckets, float("inf")), counts):
+                cumulative += count
+                samples.append((f"{self.name}_bucket", self.labels, values, cumulative, f'le="{_format_value(bound)}"'))
+            samples.append((f"{self.name}_sum", self.labels, values, total))
+            samples.append((f"{self.name}_count", self.labels, values, cumulative))
+        return samples
+
+
+class Registry:
+    """The metrics of one server process, rendered in the Prometheus text format.
+
+    Besides its own metrics it asks collectors, functions registered with
+    `collect`, for values that other objects already keep (session counts,
+    cache statistics); they are only read when the metrics are rendered.
+    """
+
+    def __init__(self):
+        self._metrics = []
+        self._collectors = []
+
+    def _add(self, metric):
+        self._metrics.append(metric)
+        return metric
+
+    def counter(self, name, help, labels=()):
+        return self._add(Counter(name, help, labels))
+
+    def gauge(self, name, help, labels=()):
+        return self._add(Gauge(name, help, labels))
+
+    def histogram(self, name, help, labels=(), buckets=LATENCY_BUCKETS):
+        return self._add(Histogram(name, help, labels, buckets))
+
+    def collect(self, collector):
+        """Register a function returning [(name, kind, help, {((label, value), ...): sample value})]."""
+        self._collectors.append(collector)
+
+    def render(self):
+        """Return every metric in the Prometheus text exposition format."""
+        lines = []
+        for metric in self._metrics:
+            lines += [f"# HELP {metric.name} {metric.help}", f"# TYPE {metric.name} {metric.kind}"]
+            for name, labels, values, value, *extra in metric.samples():
+                lines.append(f"{name}{_format_labels(labels, values, *extra)} {_format_value(value)}")
+        for collector in self._collectors:
+            for name, kind, help, values in collector():
+                lines += [f"# HELP {name} {help}", f"# TYPE {name} {kind}"]
+                for labels, value in values.items():
+                    label_names = [label for label, _ in labels]
+                    label_values = [label_value for _, label_value in labels]
+                    lines.append(f"{name}{_format_labels(label_names, label_values)} {_format_value(value)}")
+        return "\n".join(lines) + "\n"
+
+
+class TransferRecord:
+    """Filled in by the code inside a `transfer` block with the bytes it moved."""
+
+    __slots__ = ("bytes",)
+
+    def __init__(self):
+        self.bytes = 0
+
+
+registry = Registry()
+
+commands = registry.histogram("ftp_command_duration_seconds", "Time from receiving a command to finishing its reply.",
+                              ("command",))
+transfer_bytes = registry.counter("ftp_transfer_bytes_total", "File data moved over data channels.", ("command",))
+transfer_size = registry.histogram("ftp_transfer_size_bytes", "Bytes moved per completed transfer.", ("command",),
+                                   SIZE_BUCKETS)
+transfer_duration = registry.histogram("ftp_transfer_duration_seconds", "Duration of completed transfers.",
+                                       ("command",))
+transfer_throughput = registry.histogram("ftp_transfer_throughput_bytes_per_second",
+                                         "Throughput of completed transfers.", ("command",), THROUGHPUT_BUCKETS)
+transfer_failures = registry.counter("ftp_transfer_failures_total", "Transfers aborted by an error.", ("command",))
+data_channels = registry.gauge("ftp_data_channels_active", "Open data connections.")
+lock_waits = registry.histogram("ftp_lock_wait_seconds", "Time spent waiting for a contended path lock.", ("mode",))
+tls_handshakes = registry.histogram("ftp_tls_handshake_seconds", "Duration of TLS handshakes.", ("channel",))
+
+
+@contextmanager
+def transfer(command):
+    """Time a data transfer; the block sets `record.bytes`. Counts a failure if the block raises."""
+    record = TransferRecord()
+    started = time.perf_counter()
+    try:
+        yield record
+    except BaseException:
+        transfer_failures.inc(1, command)
+        raise
+    elapsed = time.perf_counter() - started
+    transfer_bytes.inc(record.bytes, command)
+    transfer_size.observe(record.bytes, command)
+    transfer_duration.observe(elapsed, command)
+    if elapsed > 0:
+        transfer_throughput.observe(record.bytes / elapsed, command)
+
+
+class _MetricsRequestHandler(BaseHTTPRequestHandler):
+    def do_GET(self):
+        if self.path.split("?")[0] != "/metrics":
+            self.send_error(404)
+            return
+        body = registry.render().encode()
+        self.send_response(200)
+        self.send_header("Content-Type", PROMETHEUS_CONTENT_TYPE)
+        self.send_header("Content-Length", str(len(body)))
+        self.end_headers()
+        self.wfile.write(body)
+
+    def log_message(self, format, *args):
+        pass  # scrapes every few seconds would drown the server log
+
+
+def serve_metrics(host, port):
+    """Serve GET /metrics on a background thread; return the HTTP server, or None if the port is taken."""
+    try:
+        httpd = ThreadingHTTPServer((host, port), _MetricsRequestHandler)
+    except OSError as e:
+        log.warning("Metrics endpoint not started on %s:%s: %s", host, port, e)
+        return None
+    httpd.daemon_threads = True
+    threading.Thread(target=httpd.serve_forever, name="ftp-metrics", daemon=True).start()
+    log.info("Metrics at http://%s:%s/metrics", host, port)
+    return httpd
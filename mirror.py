@@ -0,0 +1,152 @@
+import asyncio
+import calendar
+import os
+import ssl
+import time
+from pathlib import Path
+
+from async_client import FTPError
+
+# Errors that fail a single file of a mirror/sync without stopping the rest
+TRANSFER_ERRORS = (FTPError, ConnectionError, OSError, ssl.SSLError, asyncio.TimeoutError)
+
+
+def remote_join(directory, name):
+    return f"{directory.rstrip('/')}/{name}" if name else directory
+
+
+async def walk_remote(pool, remote_dir, relative=""):
+    """Walk a remote tree with MLSD, listing subdirectories concurrently over the pool.
+
+    Returns (directories, files): relative paths, and {relative path: (size, mtime)}.
+    """
+    async with pool.session() as session:
+        entries = await session.mlsd(remote_join(remote_dir, relative))
+
+    directories = []
+    files = {}
+    subdirectories = []
+    for entry in entries:
+        path = remote_join(relative, entry["name"]) if relative else entry["name"]
+        if entry.get("type") == "dir":
+            directories.append(path)
+            subdirectories.append(path)
+        elif entry.get("type") == "file":
+            mtime = calendar.timegm(time.strptime(entry["modify"], "%Y%m%d%H%M%S"))
+            files[path] = (entry["size"], mtime)
+
+    for sub_directories, sub_files in await asyncio.gather(
+            *(walk_remote(pool, remote_dir, path) for path in subdirectories)):
+        directories += sub_directories
+        files.update(sub_files)
+    return directories, files
+
+
+def walk_local(local_dir):
+    """Walk a local tree; same result shape as walk_remote, with "/"-separated paths."""
+    local_dir = Path(local_dir)
+    directories = []
+    files = {}
+    for root, dir_names, file_names in os.walk(local_dir):
+        relative = Path(root).relative_to(local_dir).as_posix()
+        prefix = "" if relative == "." else relative + "/"
+        directories += [prefix + name for name in dir_names]
+        for name in file_names:
+            stats = os.stat(os.path.join(root, name))
+            files[prefix + name] = (stats.st_size, int(stats.st_mtime))
+    return directories, files
+
+
+async def run_jobs(pool, jobs, job):
+    """Run `job` over `jobs` with one worker per pool session."""
+    jobs = iter(jobs)
+
+    async def worker():
+        for item in jobs:
+            await job(item)
+
+    await asyncio.gather(*(worker() for _ in range(pool.size)))
+
+
+def new_report():
+    return {"transferred": 0, "skipped": 0, "bytes": 0, "failed": []}
+
+
+async def mirror(pool, remote_dir, local_dir):
+    """Download the tree under `remote_dir` into `local_dir`, transferring files concurrently.
+
+    A file whose local size and mtime already match the server's is skipped;
+    downloaded files get the remote mtime, so a rerun over an unchanged tree
+    only costs the listings. Returns counters and the list of failed files.
+    """
+    loop = asyncio.get_running_loop()
+    local_dir = Path(local_dir)
+    report = new_report()
+
+    directories, remote_files = await walk_remote(pool, remote_dir)
+    _, local_files = await loop.run_in_executor(None, walk_local, local_dir)
+    for directory in [""] + directories:
+        (local_dir / directory).mkdir(parents=True, exist_ok=True)
+
+    async def download(path):
+        size, mtime = remote_files[path]
+        if local_files.get(path) == (size, mtime):
+            report["skipped"] += 1
+            return
+        destination = local_dir / path
+        try:
+            async with pool.session() as session:
+                transfer = await session.retrieve(remote_join(remote_dir, path), destination)
+            await loop.run_in_executor(None, os.utime, destination, (mtime, mtime))
+        except TRANSFER_ERRORS as e:
+            report["failed"].append((path, str(e)))
+            return
+        report["transferred"] += 1
+        report["bytes"] += transfer.size
+
+    await run_jobs(pool, remote_files, download)
+    return report
+
+
+async def sync(pool, local_dir, remote_dir):
+    """Upload the tree under `local_dir` into `remote_dir`, transferring files concurrently.
+
+    The counterpart of `mirror`: files whose remote size and mtime match are
+    skipped, and uploaded files get the local mtime with MFMT.
+    """
+    loop = asyncio.get_running_loop()
+    report = new_report()
+
+    directories, local_files = await loop.run_in_executor(None, walk_local, local_dir)
+    try:
+        remote_directories, remote_files = await walk_remote(pool, remote_dir)
+    except FTPError:
+        # No such remote directory yet
+        remote_directories, remote_files = None, {}
+
+    # Parents before children
+    missing = sorted(set(directories) - set(remote_directories or ()), key=lambda path: path.count("/"))
+    if remote_directories is None:
+        missing.insert(0, "")
+    async with pool.session() as session:
+        for directory in missing:
+            await session.mkdir(remote_join(remote_dir, directory))
+
+    async def upload(path):
+        size, mtime = local_files[path]
+        if remote_files.get(path) == (size, mtime):
+            report["skipped"] += 1
+            return
+        directory = path.rpartition("/")[0]
+        try:
+            async with pool.session() as session:
+                transfer = await session.store(Path(local_dir) / path, remote_join(remote_dir, directory))
+                await session.mfmt(remote_join(remote_dir, path), mtime)
+        except TRANSFER_ERRORS as e:
+            report["failed"].append((path, str(e)))
+            return
+        report["transferred"] += 1
+        report["bytes"] += transfer.size
+
+    await run_jobs(pool, local_files, upload)
+    return report
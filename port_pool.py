@@ -0,0 +1,104 @@
+import socket
+import threading
+from collections import deque
+
+
+class PassivePortPool:
+    """Passive-mode data listeners bound once up front and leased per transfer.
+
+    Every port in the range is bound and listening from startup, so a transfer
+    only has to take a listener from the pool instead of probing for a free
+    port and binding it again (which could race with other clients).
+    """
+
+    def __init__(self, host, ports):
+        self.host = host
+        self._cond = threading.Condition()
+        self._free = deque()
+        for port in ports:
+            listener = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
+            listener.setsockopt(socket.SOL_SOCKET, socket.SO_REUSEADDR, 1)
+            try:
+                listener.bind((host, port))
+            except OSError:
+                # Port taken by another program; run with the rest of the range
+                listener.close()
+                continue
+            listener.listen(1)
+            self._free.append(listener)
+
+        self.size = len(self._free)
+        self.leases = 0
+        self.exhaustions = 0
+        self.rejected = 0
+        self.peak_in_use = 0
+
+    def lease(self, timeout=None):
+        """Take a listener from the pool, waiting up to `timeout` seconds; None if exhausted."""
+        with self._cond:
+            if not self._cond.wait_for(lambda: self._free, timeout):
+                self.exhaustions += 1
+                return None
+            listener = self._free.popleft()
+            self.leases += 1
+            self.peak_in_use = max(self.peak_in_use, self.size - len(self._free))
+
+        self._drop_stale(listener)
+        return listener
+
+    def release(self, listener):
+        """Give a leased listener back to the pool."""
+        listener.setblocking(True)
+        with self._cond:
+            self._free.append(listener)
+            self._cond.notify()
+
+    def _drop_stale(self, listener):
+        """Close connections left in the backlog by a client of an earlier lease."""
+        listener.setblocking(False)
+        try:
+            while True:
+                conn, _ = listener.accept()
+                conn.close()
+        except (BlockingIOError, InterruptedError):
+            pass
+        finally:
+            listener.setblocking(True)
+
+    def is_session_peer(self, address, peer_host):
+        """Check that a data connection comes from the host of the leasing session.
+
+        Only the host is compared: another session from the same address (any
+        client on loopback, or behind the same NAT) that guesses the announced
+        port during the accept window is not told apart from the leaseholder.
+        """
+        if address[0] == peer_host:
+            return True
+        with self._cond:
+            self.rejected += 1
+        return False
+
+    def accept(self, listener, peer_host, timeout=None):
+        """Accept the data connection of the session that leased `listener`.
+
+        Raises TimeoutError if it does not arrive within `timeout` seconds.
+        """
+        listener.settimeout(timeout)
+        while True:
+            conn, address = listener.accept()
+            if self.is_session_peer(address, peer_host):
+                return conn
+            conn.close()
+
+    def stats(self):
+        """Return pool size, usage and exhaustion counters."""
+        with self._cond:
+            return {
+                "size": self.size,
+                "free": len(self._free),
+                "in_use": self.size - len(self._free),
+                "peak_in_use": self.peak_in_use,
+                "leases": self.leases,
+                "exhaustions": self.exhaustions,
+                "rejected_peers": self.rejected,
+            }
@@ -0,0 +1,69 @@
+import socket
+
+RECV_SIZE = 4096
+# Longest control line accepted before the peer is considered broken
+MAX_LINE_LENGTH = 64 * 1024
+
+
+def set_nodelay(sock):
+    """Send small writes at once instead of holding them for the peer's delayed ACK (Nagle).
+
+    Without it every short command/reply exchange on loopback stalls for about 40 ms.
+    """
+    sock.setsockopt(socket.IPPROTO_TCP, socket.TCP_NODELAY, 1)
+
+
+class ControlChannel:
+    """CRLF-framed reader/writer for the control connection.
+
+    Reads are buffered, so several commands or replies arriving in one
+    segment are split correctly and the leftovers wait for the next read;
+    this is what lets a peer pipeline commands without waiting for replies.
+    """
+
+    def __init__(self, sock):
+        self.sock = sock
+        self._buffer = bytearray()
+
+    def read_line(self):
+        """Return the next line without its line ending, or None once the peer has closed."""
+        while True:
+            end = self._buffer.find(b"\n")
+            if end >= 0:
+                line = bytes(self._buffer[:end])
+                del self._buffer[:end + 1]
+                return line.rstrip(b"\r").decode()
+            if len(self._buffer) > MAX_LINE_LENGTH:
+                raise ConnectionError("Control line too long.")
+
+            data = self.sock.recv(RECV_SIZE)
+            if not data:
+                return None
+            self._buffer += data
+
+    def read_reply(self):
+        """Read one reply, following RFC 959 multi-line replies ("123-..." up to "123 ...").
+
+        Returns the reply text with its lines joined by newlines.
+        """
+        line = self.read_line()
+        if line is None:
+            raise ConnectionError("Control connection closed.")
+
+        lines = [line]
+        if line[3:4] == "-":
+            last = line[:3] + " "
+            while not line.startswith(last):
+                line = self.read_line()
+                if line is None:
+                    raise ConnectionError("Control connection closed.")
+                lines.append(line)
+        return "\n".join(lines)
+
+    def send_line(self, line):
+        """Send one CRLF-terminated line."""
+        self.sock.sendall(f"{line}\r\n".encode())
+
+    def send_lines(self, lines):
+        """Send several lines in a single write."""
+        self.sock.sendall("".join(f"{line}\r\n" for line in lines).encode())
@@ -1,24 +1,122 @@
+import argparse
+import asyncio
+import calendar
+import errno
+import io
+import logging
+from contextlib import nullcontext
 import os
 import shutil
 import socket
 import ssl
+import stat
+import tempfile
+import time
 from pathlib import Path
 import threading
+from concurrent.futures import ThreadPoolExecutor
 from datetime import datetime
 
+from bulk import collect_files, write_archive, read_archive, recv_exactly
+from cache import ListingCache, FileCache
+from compression import LEVELS, DEFAULT_METHOD, DEFAULT_LEVELS, Compressor, Decompressor, CompressionStats, \
+    is_compressed, announce
+from delta import block_size_for, iter_signature, apply_delta
+from digests import ALGORITHMS, DEFAULT_ALGORITHM, DigestIndex
+from locks import PathLockManager, lock_paths
+from logs import COMMAND_LOGGER, DEFAULT_LEVEL, LOG_COMMAND_SAMPLE, new_session_id, setup_logging
+import metrics
+from port_pool import PassivePortPool
+from protocol import ControlChannel, set_nodelay
+from shaping import Shaper, parse_rate
+from storage import FSYNC_POLICIES, DEFAULT_FSYNC_POLICY, Upload
+from transfer import send_file, send_buffer, receive_file, send_compressed, receive_compressed, copy_file
+
 SERVER_HOST = "127.0.0.1"
 SERVER_PORT = 2121
 BUFFER_SIZE = 1024
+# Buffer reused for every chunk of a RETR/STOR data transfer
+TRANSFER_BUFFER_SIZE = 256 * 1024
+# Directory listings are streamed to the data socket in chunks of about this size
+LIST_CHUNK_SIZE = 64 * 1024
+# Formatted listings kept in memory: directories, total bytes, and the largest single listing
+LIST_CACHE_MAX_DIRS = 256
+LIST_CACHE_MAX_BYTES = 32 * 1024 * 1024
+LIST_CACHE_MAX_ENTRY_BYTES = 4 * 1024 * 1024
+# Hot-file cache for RETR: total and per-file size, and how many requests make a file hot
+FILE_CACHE_MAX_BYTES = 256 * 1024 * 1024
+FILE_CACHE_MAX_ENTRY_BYTES = 16 * 1024 * 1024
+FILE_CACHE_ADMIT_AFTER = 2
+
+# Data transfer limits in bytes per second (0: unlimited), changeable at runtime with
+# SITE LIMIT, and each role's share of the global limit relative to the others (default 1)
+GLOBAL_RATE_LIMIT = 0
+ROLE_RATE_LIMITS = {}
+USER_RATE_LIMITS = {}
+ROLE_WEIGHTS = {}
+
+# Passive data ports bound up front, and how long a transfer waits for a free one
+PASV_PORT_RANGE = range(50000, 50100)
+PASV_LEASE_TIMEOUT = 5
+
+# Admission control: session worker threads, concurrent sessions (overall and per user) and
+# the listen backlog. Clients beyond the limits get 421. Under --workers the per-user limit
+# holds across all workers; the others are per worker process. The asyncio engine keeps
+# sessions as coroutines rather than threads, so it has a limit of its own.
+MAX_WORKERS = 64
+MAX_SESSIONS = MAX_WORKERS
+ASYNC_MAX_SESSIONS = 10000
+MAX_SESSIONS_PER_USER = 8
+LISTEN_BACKLOG = 128
+# Rejected clients waiting for their 421 (each needs a TLS handshake); beyond this they are
+# disconnected at once so a connection flood cannot pile up open sockets
+MAX_PENDING_REJECTIONS = 32
+# Pause after accept() fails for lack of file descriptors, to let sessions finish and free some
+ACCEPT_ERROR_BACKOFF = 0.5
+# Seconds before a stuck session is reaped: TLS handshake, idle control connection,
+# client not connecting to the passive port, and a stalled data transfer
+HANDSHAKE_TIMEOUT = 10
+CONTROL_IDLE_TIMEOUT = 300
+DATA_ACCEPT_TIMEOUT = 30
+DATA_IDLE_TIMEOUT = 60
+
+# Local HTTP port serving GET /metrics in the Prometheus text format (0: off)
+METRICS_PORT = 9121
+
+log = logging.getLogger("ftp.server")
+# One record per control command, sampled; see logs.SamplingFilter
+command_log = logging.getLogger(COMMAND_LOGGER)
 
 # Server Root directory
 BASE_DIR = Path(r"/.")
 BASE_DIR.mkdir(exist_ok=True)
 
-file_lock = threading.Lock()
+# Per-path reader/writer locks shared by all client threads
+path_locks = PathLockManager()
+
+# Logins per user across all worker processes under --workers (a supervisor.SharedUserSessions), else None
+shared_user_sessions = None
+
+# Whether SITE LIMIT may change the bandwidth limits; off under --workers, where every worker
+# has its own shaper and the command would only reach the one serving the session
+runtime_limits = True
+
+# Listings shared by all sessions, invalidated by STOR/DELE/MKD/RMD
+listing_cache = ListingCache(LIST_CACHE_MAX_DIRS, LIST_CACHE_MAX_BYTES, LIST_CACHE_MAX_ENTRY_BYTES)
+
+# Contents of frequently downloaded files, checked against size, mtime and inode
+file_cache = FileCache(FILE_CACHE_MAX_BYTES, FILE_CACHE_MAX_ENTRY_BYTES, FILE_CACHE_ADMIT_AFTER)
+
+# Persistent digests for HASH/XCRC/XMD5, keyed by path and checked against size, mtime and inode
+DIGEST_INDEX_FILE = 'digests.sqlite3'
+digest_index = DigestIndex(DIGEST_INDEX_FILE)
 
 CERT_FILE = 'cert.pem'
 KEY_FILE = 'private.key'
 
+# TLS 1.3 session tickets issued per handshake, so data channels can resume the control session
+TLS_SESSION_TICKETS = 4
+
 user_data = {
     "admin": {"password": "admin123", "role": "admin"},
     "user1": {"password": "user123", "role": "user_lvl1"},
@@ -26,84 +124,477 @@ user_data = {
     "user3": {"password": "user789", "role": "user_lvl3"},
 }
 
+# Roles refused for each restricted command; ADMIN_COMMANDS are admin only
+DENIED_ROLES = {
+    "RETR": {"user_lvl3"},
+    "MRET": {"user_lvl3"},
+    "HASH": {"user_lvl3"},
+    "XCRC": {"user_lvl3"},
+    "XMD5": {"user_lvl3"},
+    "XSIG": {"user_lvl3"},
+    "STOR": {"user_lvl2", "user_lvl3"},
+    "MSTR": {"user_lvl2", "user_lvl3"},
+    "XDLT": {"user_lvl2", "user_lvl3"},
+    "MKD": {"user_lvl2", "user_lvl3"},
+    "MFMT": {"user_lvl2", "user_lvl3"},
+    "COPY": {"user_lvl2", "user_lvl3"},
+}
+# RNTO can replace an existing file, so renaming is as privileged as deleting
+ADMIN_COMMANDS = {"DELE", "RMD", "RNFR", "RNTO", "SITE"}
+
+# Commands answered once logged in; anything else gets 502
+COMMANDS = {"LIST", "MLSD", "REST", "RANG", "SIZE", "MDTM", "MFMT", "RETR", "STOR", "MRET", "MSTR", "DELE", "MKD",
+            "RMD", "CWD", "CDUP", "PWD", "MODE", "OPTS", "HASH", "XCRC", "XMD5", "XSIG", "XDLT",
+            "RNFR", "RNTO", "COPY", "ALLO", "SITE", "STAT"}
+
+# Space-separated arguments a command needs at least; with fewer it gets 501
+REQUIRED_ARGUMENTS = {"USER": 1, "PASS": 1, "LIST": 1, "RETR": 1, "STOR": 2, "XDLT": 2, "DELE": 1, "MKD": 1,
+                      "RMD": 1, "CWD": 1}
+
+
+def missing_arguments(verb, command):
+    """Check whether `command` has fewer arguments than `verb` needs (see REQUIRED_ARGUMENTS)."""
+    return len(command.split(" ")) <= REQUIRED_ARGUMENTS.get(verb, 0)
+
+
+def is_allowed(role, command):
+    """Check whether a role may run the given command."""
+    if command in ADMIN_COMMANDS:
+        return role == "admin"
+    return role not in DENIED_ROLES.get(command, ())
+
+
+def command_label(command):
+    """The verb a command's latency is recorded under; unknown verbs share one so clients cannot add labels."""
+    verb = command.split(" ")[0].strip().upper()
+    return verb if verb in COMMANDS or verb in ("USER", "PASS", "QUIT") else "OTHER"
+
+
+def create_server_context():
+    """Build the SSL context shared by the control and data channels."""
+    context = ssl.create_default_context(ssl.Purpose.CLIENT_AUTH)
+    context.load_cert_chain(certfile=CERT_FILE, keyfile=KEY_FILE)
+    context.check_hostname = False
+    context.verify_mode = ssl.CERT_NONE  # disable checkin client certification
+
+    # Issue session tickets (TLS 1.3) and keep the session cache (TLS 1.2) so
+    # data connections resume the control session instead of a full handshake
+    context.num_tickets = TLS_SESSION_TICKETS
+
+    # Let the kernel do TLS where supported, so RETR can use sendfile
+    if hasattr(ssl, "OP_ENABLE_KTLS"):
+        context.options |= ssl.OP_ENABLE_KTLS
+    return context
+
 
 class FTPServer:
-    def __init__(self, host, port):
+    def __init__(self, host, port, reuse_port=False, pasv_ports=PASV_PORT_RANGE, fsync_policy=DEFAULT_FSYNC_POLICY,
+                 metrics_port=METRICS_PORT):
         self.host = host
         self.port = port
-        self.control_socket = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
-        self.control_socket.bind((self.host, self.port))
-        self.control_socket.listen(5)
-        print(f"Server started at {self.host}:{self.port}")
+        # Several worker processes accept on the same port; the kernel spreads connections
+        self.reuse_port = reuse_port
+        # When uploads are forced to disk: "none", "close" or "periodic"
+        self.fsync_policy = fsync_policy
+        self.metrics_port = metrics_port
+        self.control_socket = None  # listening socket, bound by start()
 
         # SSL configuration
-        self.context = ssl.create_default_context(ssl.Purpose.CLIENT_AUTH)
-        self.context.load_cert_chain(certfile=CERT_FILE, keyfile=KEY_FILE)
-        self.context.check_hostname = False
-        self.context.verify_mode = ssl.CERT_NONE  # disable checkin client certification
-
-    def find_free_port(self):
-        """Find a free port for data connection."""
-        with socket.socket(socket.AF_INET, socket.SOCK_STREAM) as s:
-            s.bind((SERVER_HOST, 0))  # Bind to a free port
-            return s.getsockname()[1]  # Return the port number
-
-    def format_file_info(self, file_path):
+        self.context = create_server_context()
+
+        # Passive data listeners leased per transfer
+        self.data_ports = PassivePortPool(SERVER_HOST, pasv_ports)
+
+        # Data channel handshakes, and how many of them resumed a session
+        self.stats_lock = threading.Lock()
+        self.tls_counters = {"data_handshakes": 0, "data_resumed": 0}
+
+        # Bytes and CPU time of MODE Z transfers
+        self.compression_stats = CompressionStats()
+
+        # Bandwidth limits shared by all data transfers
+        self.shaper = Shaper(GLOBAL_RATE_LIMIT, ROLE_RATE_LIMITS, USER_RATE_LIMITS, ROLE_WEIGHTS)
+
+        # Threaded engine: bounded pool of session threads, plus two threads that turn away
+        # clients over the limit; created by start()
+        self.workers = None
+        self.rejecter = None
+
+        # Active sessions overall and per logged-in user
+        self.session_lock = threading.Lock()
+        self.sessions = 0
+        self.user_sessions = {}
+        self.session_users = {}  # control socket (or stream writer) -> logged-in user
+        self.rejected_sessions = 0
+        self.pending_rejections = 0
+
+        # Counters kept above are read into the metrics when they are scraped
+        metrics.registry.collect(self.collect_metrics)
+
+    def session_limit(self):
+        """Concurrent sessions this engine admits: each one takes a pool thread."""
+        return min(MAX_SESSIONS, MAX_WORKERS)
+
+    def admit_session(self):
+        """Reserve a session slot; False when the server is saturated."""
+        with self.session_lock:
+            if self.sessions >= self.session_limit():
+                self.rejected_sessions += 1
+                return False
+            self.sessions += 1
+            return True
+
+    def admit_user(self, control_socket, username):
+        """Count a login against the user's session limit; False if the user already has too many."""
+        with self.session_lock:
+            shared = shared_user_sessions
+            if self.user_sessions.get(username, 0) >= MAX_SESSIONS_PER_USER or (
+                    shared is not None and not shared.admit(username, MAX_SESSIONS_PER_USER)):
+                self.rejected_sessions += 1
+                return False
+            self.user_sessions[username] = self.user_sessions.get(username, 0) + 1
+            self.session_users[control_socket] = username
+            return True
+
+    def release_session(self, control_socket):
+        """Free the session slot (and user slot) held by a finished session."""
+        with self.session_lock:
+            self.sessions -= 1
+            username = self.session_users.pop(control_socket, None)
+            if username is not None:
+                if shared_user_sessions is not None:
+                    shared_user_sessions.release(username)
+                self.user_sessions[username] -= 1
+                if not self.user_sessions[username]:
+                    del self.user_sessions[username]
+
+    def session_stats(self):
+        """Return active and rejected session counts."""
+        with self.session_lock:
+            return {"active": self.sessions, "per_user": dict(self.user_sessions), "rejected": self.rejected_sessions}
+
+    def record_data_handshake(self, ssl_object):
+        """Count a data channel handshake and whether it resumed a session."""
+        with self.stats_lock:
+            self.tls_counters["data_handshakes"] += 1
+            if ssl_object.session_reused:
+                self.tls_counters["data_resumed"] += 1
+
+    def tls_stats(self):
+        """Return TLS session resumption counters for the data channels and the whole context."""
+        with self.stats_lock:
+            stats = dict(self.tls_counters)
+        stats["resumption_rate"] = stats["data_resumed"] / stats["data_handshakes"] if stats["data_handshakes"] else 0.0
+        stats["context"] = self.context.session_stats()
+        return stats
+
+    @staticmethod
+    def record_command(command, elapsed, context):
+        """Record a handled command's latency in the metrics and, sampled, in the command log."""
+        label = command_label(command)
+        metrics.commands.observe(elapsed, label)
+        if command_log.isEnabledFor(logging.INFO):
+            command_log.info("PASS ****" if label == "PASS" else command,
+                             extra={**context, "command": label, "duration_ms": round(elapsed * 1000, 3)})
+
+    def collect_metrics(self):
+        """Session, passive port, TLS, shaping, compression, cache and lock counters.
+
+        Returned in metrics.Registry.collect form.
+        """
+        sessions = self.session_stats()
+        tls = self.tls_stats()
+        shaping = self.shaper.stats()
+        compression = self.compression_stats.stats()
+        caches = {"listing": listing_cache.stats(), "file": file_cache.stats(), "digest": digest_index.stats()}
+        contention = path_locks.contention_stats()
+        ports = self.data_ports.stats()
+
+        def per_cache(key):
+            return {(("cache", name),): stats[key] for name, stats in caches.items() if key in stats}
+
+        return [
+            ("ftp_sessions_active", "gauge", "Open control connections.", {(): sessions["active"]}),
+            ("ftp_user_sessions_active", "gauge", "Logged-in sessions per user.",
+             {(("user", user),): count for user, count in sessions["per_user"].items()}),
+            ("ftp_sessions_rejected_total", "counter", "Sessions turned away by the session limits.",
+             {(): sessions["rejected"]}),
+            ("ftp_pasv_ports", "gauge", "Passive data ports in the pool.", {(): ports["size"]}),
+            ("ftp_pasv_ports_in_use", "gauge", "Passive data ports leased to transfers.", {(): ports["in_use"]}),
+            ("ftp_pasv_ports_peak_in_use", "gauge", "Most passive data ports leased at once.",
+             {(): ports["peak_in_use"]}),
+            ("ftp_pasv_exhaustions_total", "counter", "Transfers refused because no passive port was free.",
+             {(): ports["exhaustions"]}),
+            ("ftp_pasv_rejected_peers_total", "counter", "Data connections refused for coming from another host.",
+             {(): ports["rejected_peers"]}),
+            ("ftp_tls_data_handshakes_total", "counter", "TLS handshakes on data channels.",
+             {(): tls["data_handshakes"]}),
+            ("ftp_tls_data_resumed_total", "counter", "Data channel handshakes that resumed the control session.",
+             {(): tls["data_resumed"]}),
+            ("ftp_shaping_active_transfers", "gauge", "Transfers registered with the shaper.",
+             {(): shaping["active_transfers"]}),
+            ("ftp_shaping_throttled_seconds_total", "counter", "Time transfers spent waiting on bandwidth limits.",
+             {(): shaping["throttled_time"]}),
+            ("ftp_compression_raw_bytes_total", "counter", "MODE Z data before compression.",
+             {(): compression["raw_bytes"]}),
+            ("ftp_compression_wire_bytes_total", "counter", "MODE Z data on the wire.",
+             {(): compression["wire_bytes"]}),
+            ("ftp_compression_cpu_seconds_total", "counter", "CPU time spent compressing and decompressing.",
+             {(): compression["cpu_time"]}),
+            ("ftp_cache_entries", "gauge", "Entries held per cache.", per_cache("entries")),
+            ("ftp_cache_resident_bytes", "gauge", "Memory held per cache.", per_cache("resident_bytes")),
+            ("ftp_cache_hits_total", "counter", "Cache lookups answered from the cache.", per_cache("hits")),
+            ("ftp_cache_misses_total", "counter", "Cache lookups that had to go to disk.", per_cache("misses")),
+            ("ftp_lock_path_waits_total", "counter", "Contended lock acquisitions on the most contended paths.",
+             {(("path", path),): stats["waits"] for path, stats in contention.items()}),
+            ("ftp_lock_path_wait_seconds_total", "counter", "Time spent waiting for locks on the most contended paths.",
+             {(("path", path),): stats["wait_time"] for path, stats in contention.items()}),
+        ]
+
+    def open_data_channel(self, control_socket):
+        """Lease a passive port, announce it and accept the client's TLS data connection.
+
+        Returns the data connection, or None when no passive port is free or the
+        client does not connect within DATA_ACCEPT_TIMEOUT. The listener goes back
+        to the pool as soon as the connection is accepted.
+        """
+        listener = self.data_ports.lease(PASV_LEASE_TIMEOUT)
+        if listener is None:
+            control_socket.send(b"425 Can't open data connection: no passive ports free.\r\n")
+            return None
+
+        try:
+            # Send Passive Mode response with the leased port
+            port = listener.getsockname()[1]
+            control_socket.send(f"227 Entering Passive Mode (127,0,0,1,{port // 256},{port % 256})\r\n".encode())
+
+            # Wait for this session's client to connect to the data port
+            data_conn = self.data_ports.accept(listener, control_socket.getpeername()[0], DATA_ACCEPT_TIMEOUT)
+        except TimeoutError:
+            control_socket.send(b"425 Can't open data connection: timed out waiting for the client.\r\n")
+            return None
+        finally:
+            self.data_ports.release(listener)
+
+        set_nodelay(data_conn)
+        # A stalled transfer raises TimeoutError instead of holding the session forever
+        data_conn.settimeout(DATA_IDLE_TIMEOUT)
+        # An upload has to end with the client's TLS close_notify; a bare EOF means it was cut short
+        started = time.perf_counter()
+        data_conn = self.context.wrap_socket(data_conn, server_side=True, suppress_ragged_eofs=False)
+        metrics.tls_handshakes.observe(time.perf_counter() - started, "data")
+        self.record_data_handshake(data_conn)
+        metrics.data_channels.inc()
+        return data_conn
+
+    def close_data_channel(self, data_conn):
+        """Close the data connection."""
+        data_conn.close()
+        metrics.data_channels.dec()
+
+    def shaped(self, user, size=None):
+        """Register a transfer of `size` bytes by `user` with the shaper; see Shaper.channel."""
+        return self.shaper.channel(user, user_data[user]["role"] if user else None, size)
+
+    @staticmethod
+    def format_file_info(file_path, stats=None):
         """Format file information (name, size, permissions, creation date)."""
-        stats = os.stat(file_path)
+        stats = stats or os.stat(file_path)
         file_size = stats.st_size
         permissions = oct(stats.st_mode)[-3:]
         creation_time = datetime.fromtimestamp(stats.st_ctime).strftime("%Y-%m-%d %H:%M:%S")
         file_name = file_path.name
         return f"{file_name}\t\t{file_size} bytes\t\tPermissions: {permissions}\t\tCreated: {creation_time}"
 
-    def handle_list(self, control_socket, path=" "):
-        """Handle the LIST command to list files with detailed information."""
-        port = self.find_free_port()
+    @staticmethod
+    def format_facts(file_name, stats):
+        """Format an MLSD entry: fixed facts in a fixed order, then the name."""
+        file_type = "dir" if stat.S_ISDIR(stats.st_mode) else "file"
+        modify = time.strftime("%Y%m%d%H%M%S", time.gmtime(stats.st_mtime))
+        mode = stat.S_IMODE(stats.st_mode)
+        return f"type={file_type};size={stats.st_size};modify={modify};unix.mode={mode:04o}; {file_name}"
 
-        # Create the data connection
-        data_socket = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
-        data_socket = self.context.wrap_socket(data_socket, server_side=True)
-        data_socket.bind((SERVER_HOST, port))
-        data_socket.listen(1)
+    def iter_listing(self, direction, machine=False):
+        """Yield the LIST (or MLSD) output of a directory in chunks of about LIST_CHUNK_SIZE bytes."""
+        lines = []
+        size = 0
+        found = False
+        with os.scandir(direction) as entries:
+            for entry in entries:
+                try:
+                    stats = entry.stat()
+                except FileNotFoundError:
+                    continue  # removed while we were listing
+                found = True
+                if machine:
+                    line = self.format_facts(entry.name, stats) + "\r\n"
+                else:
+                    line = self.format_file_info(entry, stats) + "\r\n"
+                lines.append(line)
+                size += len(line)
+                if size >= LIST_CHUNK_SIZE:
+                    yield "".join(lines).encode()
+                    lines = []
+                    size = 0
+
+        if lines:
+            yield "".join(lines).encode()
+        elif not found and not machine:
+            yield b"No files found.\r\n"
+
+    def cached_listing(self, direction, machine=False):
+        """Yield listing chunks from the cache, or stream them from disk and cache the result."""
+        chunks, mtime_ns = listing_cache.get(direction, machine)
+        if chunks is not None:
+            yield from chunks
+            return
+
+        # Keep a copy only while it stays small enough to be cached
+        kept = []
+        kept_size = 0
+        for chunk in self.iter_listing(direction, machine):
+            if kept is not None:
+                kept.append(chunk)
+                kept_size += len(chunk)
+                if kept_size > LIST_CACHE_MAX_ENTRY_BYTES:
+                    kept = None
+            yield chunk
+
+        if kept is not None:
+            listing_cache.put(direction, machine, mtime_ns, kept)
+
+    @staticmethod
+    def hot_file(file_path):
+        """Return the contents of `file_path` from the file cache, reading them in if it just became hot, or None.
 
-        # Send Passive Mode response with the free port
-        control_socket.send(f"227 Entering Passive Mode (127,0,0,1,{port // 256},{port % 256})\r\n".encode())
+        The caller holds the file's read lock.
+        """
+        stats = os.stat(file_path)
+        data = file_cache.get(file_path, stats)
+        if data is None and file_cache.wants(file_path, stats):
+            with open(file_path, "rb") as f:
+                stats = os.fstat(f.fileno())
+                data = f.read()
+            file_cache.put(file_path, stats, data)
+        return data
+
+    def select_compression(self, file_name, compression):
+        """Return the (method, level) for a MODE Z transfer of `file_name`, or None to send it as is.
+
+        Files of an already-compressed type are not compressed again.
+        """
+        if compression is None:
+            return None
+        if is_compressed(file_name):
+            self.compression_stats.record_skipped()
+            return None
+        return compression
+
+    def handle_mode(self, control_socket, mode):
+        """Handle the MODE command; return the transfer mode now in effect (S or Z)."""
+        mode = mode.strip().upper()
+        if mode not in ("S", "Z"):
+            control_socket.send(b"504 Only MODE S and MODE Z are supported.\r\n")
+            return None
+        control_socket.send(f"200 Mode set to {mode}.\r\n".encode())
+        return mode
 
-        # Wait for the client to connect to the data port
-        data_conn, _ = data_socket.accept()
+    def handle_opts(self, control_socket, options, compression):
+        """Handle OPTS MODE Z [METHOD <name>] [LEVEL <n>]; return the (method, level) now in effect."""
+        words = options.split()
+        if [word.upper() for word in words[:2]] != ["MODE", "Z"] or len(words) % 2:
+            control_socket.send(b"501 Usage: OPTS MODE Z [METHOD <name>] [LEVEL <n>].\r\n")
+            return compression
+
+        method, level = compression
+        settings = {key.upper(): value for key, value in zip(words[2::2], words[3::2])}
+        if "METHOD" in settings:
+            method = settings["METHOD"].lower()
+            level = DEFAULT_LEVELS.get(method)
+        if "LEVEL" in settings:
+            level = int(settings["LEVEL"]) if settings["LEVEL"].lstrip("-").isdigit() else None
+        if method not in LEVELS or level not in LEVELS[method]:
+            supported = ", ".join(f"{name} {levels.start}-{levels.stop - 1}" for name, levels in LEVELS.items())
+            control_socket.send(f"501 Supported methods and levels: {supported}.\r\n".encode())
+            return compression
+        control_socket.send(f"200 MODE Z uses {method} level {level}.\r\n".encode())
+        return method, level
+
+    def handle_list(self, control_socket, path=" ", machine=False, compression=None):
+        """Handle the LIST command to list files with detailed information."""
         direction = BASE_DIR / path
+        if machine and not direction.is_dir():
+            control_socket.send(b"550 Directory not found.\r\n")
+            return
 
-        if direction.is_dir():
-            file_details = []
-            for item in os.listdir(direction):
-                item_path = direction / item
-                file_details.append(self.format_file_info(item_path))
+        # Create the data connection
+        data_conn = self.open_data_channel(control_socket)
+        if data_conn is None:
+            return
 
-            # Send to the client
-            if file_details:
-                data_conn.send("\r\n".join(file_details).encode())
+        try:
+            compressor = Compressor(*compression) if compression else None
+            if direction.is_dir():
+                # Stream to the client as the directory is read
+                for chunk in self.cached_listing(direction, machine):
+                    data_conn.sendall(compressor.compress(chunk) if compressor else chunk)
             else:
-                data_conn.send(b"No files found.\r\n")
-        else:
-            print("Couldn't find this path")
-
-        # Close the data connection
-        data_conn.close()
+                log.info("LIST of missing path %s", direction)
+            if compressor:
+                data_conn.sendall(compressor.flush())
+                self.compression_stats.record(compressor)
+        finally:
+            # Close the data connection
+            self.close_data_channel(data_conn)
         control_socket.send(b"226 Transfer complete.\r\n")
-        data_socket.close()
+
+    def handle_mlsd(self, control_socket, path=".", compression=None):
+        """Handle the MLSD command: a machine-readable listing with one set of facts per entry."""
+        self.handle_list(control_socket, path, machine=True, compression=compression)
 
     def handle_client(self, control_socket, client_address):
-        print(f"Connection from {client_address}")
+        # Fields every log record of this session carries
+        context = {"session": new_session_id(), "peer": f"{client_address[0]}:{client_address[1]}"}
+        log.info("Connection opened", extra=context)
         control_socket.send(b"220 FTP Server Ready\r\n")
         authenticated = False
         current_user = None
+        restart = (0, None)
+        renaming = None
+        allocation = None
+        mode = "S"
+        compression = (DEFAULT_METHOD, DEFAULT_LEVELS[DEFAULT_METHOD])
+        hash_algorithm = DEFAULT_ALGORITHM
 
+        # Commands are CRLF-framed; pipelined commands wait in the channel's buffer
+        channel = ControlChannel(control_socket)
         while True:
-            command = control_socket.recv(BUFFER_SIZE).decode()
-            print(f"Received command: {command}")
+            try:
+                command = channel.read_line()
+            except TimeoutError:
+                control_socket.send(b"421 Idle timeout, closing control connection.\r\n")
+                command = None
+            except (ConnectionError, ssl.SSLError):
+                command = None
+            if command is None:
+                log.info("Connection closed", extra=context)
+                break
+            started = time.perf_counter()
+
+            # A REST/RANG restart point only applies to the command right after it
+            (offset, count), restart = restart, (0, None)
+            # Likewise the path an RNFR names is only kept for the RNTO right after it,
+            # and the size an ALLO announces for the STOR right after it
+            rename_from, renaming = renaming, None
+            size, allocation = allocation, None
+            # Compression for this command's transfer: None in stream mode
+            z = compression if mode == "Z" else None
+            # The verb as the branches below match it, to check its arguments first
+            verb = next((name for name in REQUIRED_ARGUMENTS if command.startswith(name)), None)
 
-            if command.startswith("USER"):
+            if missing_arguments(verb, command):
+                control_socket.send(f"501 Syntax error: missing arguments for {verb}.\r\n".encode())
+            elif command.startswith("USER"):
                 username = command.split(" ")[1]
                 if username in user_data:
                     current_user = username
@@ -115,44 +606,106 @@ class FTPServer:
                     password = command.split(" ", 1)[1].strip()
                     user_info = user_data[current_user]
                     if user_info["password"] == password:
-                        control_socket.send(b"230 Login successful.\r\n")
+                        if not authenticated and not self.admit_user(control_socket, current_user):
+                            control_socket.send(b"421 Too many sessions for this user, try again later.\r\n")
+                            break
                         role = user_info["role"]
-                        control_socket.send(f"250 You are logged in as {current_user} with role {role}.\r\n".encode())
+                        control_socket.send(f"230-Login successful.\r\n"
+                                            f"230 You are logged in as {current_user} with role {role}.\r\n".encode())
                         authenticated = True
+                        context["user"] = current_user
                     else:
                         control_socket.send(b"530 Invalid password. Please try again.\r\n")
                 else:
                     control_socket.send(b"530 Please enter a valid username first.\r\n")
             elif command.startswith("LIST"):
                 if authenticated:
-                    self.handle_list(control_socket, command.split(" ")[1])
+                    self.handle_list(control_socket, command.split(" ")[1], compression=z)
+                else:
+                    control_socket.send(b"530 Not logged in.\r\n")
+            elif command.startswith("REST"):
+                if authenticated:
+                    restart = (self.handle_rest(control_socket, command[4:].strip()), None)
+                else:
+                    control_socket.send(b"530 Not logged in.\r\n")
+            elif command.startswith("RANG"):
+                if authenticated:
+                    restart = self.handle_rang(control_socket, command[4:].strip())
+                else:
+                    control_socket.send(b"530 Not logged in.\r\n")
+            elif command.startswith("ALLO"):
+                if authenticated:
+                    allocation = self.handle_allo(control_socket, command[4:].strip())
+                else:
+                    control_socket.send(b"530 Not logged in.\r\n")
+            elif command.startswith("SIZE"):
+                if authenticated:
+                    self.handle_size(control_socket, command[4:].strip())
+                else:
+                    control_socket.send(b"530 Not logged in.\r\n")
+            elif command.startswith("MDTM"):
+                if authenticated:
+                    self.handle_mdtm(control_socket, command[4:].strip())
+                else:
+                    control_socket.send(b"530 Not logged in.\r\n")
+            elif command.startswith("MODE"):
+                if authenticated:
+                    mode = self.handle_mode(control_socket, command[4:]) or mode
+                else:
+                    control_socket.send(b"530 Not logged in.\r\n")
+            elif command.startswith("OPTS"):
+                if authenticated:
+                    options = command[4:].strip()
+                    if options.upper().startswith("HASH"):
+                        hash_algorithm = self.handle_opts_hash(control_socket, options[4:], hash_algorithm)
+                    else:
+                        compression = self.handle_opts(control_socket, options, compression)
+                else:
+                    control_socket.send(b"530 Not logged in.\r\n")
+            elif command.startswith("HASH") or command.startswith("XCRC") or command.startswith("XMD5"):
+                verb = command[:4]
+                if authenticated:
+                    if not is_allowed(user_data[current_user]["role"], verb):
+                        control_socket.send(b"530 Not allowed.\r\n")
+                    elif verb == "HASH":
+                        self.handle_hash(control_socket, command[4:].strip(), hash_algorithm, offset, count)
+                    else:
+                        self.handle_xhash(control_socket, "CRC32" if verb == "XCRC" else "MD5", command[4:].strip())
+                else:
+                    control_socket.send(b"530 Not logged in.\r\n")
+            elif command.startswith("MFMT"):
+                if authenticated:
+                    if is_allowed(user_data[current_user]["role"], "MFMT"):
+                        self.handle_mfmt(control_socket, command[4:].strip())
+                    else:
+                        control_socket.send(b"530 Not allowed.\r\n")
+                else:
+                    control_socket.send(b"530 Not logged in.\r\n")
+            elif command.startswith("MLSD"):
+                if authenticated:
+                    path = command[4:].strip() or "."
+                    self.handle_mlsd(control_socket, path, z)
                 else:
                     control_socket.send(b"530 Not logged in.\r\n")
             elif command.startswith("RETR"):
-                user_info = user_data[current_user]
-                role = user_info["role"]
                 if authenticated:
-                    if role != "user_lvl3":
-                        self.handle_retrieve(control_socket, command.split(" ")[1])
+                    if is_allowed(user_data[current_user]["role"], "RETR"):
+                        self.handle_retrieve(control_socket, command.split(" ")[1], offset, count, z, current_user)
                     else:
                         control_socket.send(b"530 Not allowed.\r\n")
                 else:
                     control_socket.send(b"530 Not logged in.\r\n")
             elif command.startswith("DELE"):
-                user_info = user_data[current_user]
-                role = user_info["role"]
                 if authenticated:
-                    if role == "admin":
+                    if is_allowed(user_data[current_user]["role"], "DELE"):
                         self.handle_delete(control_socket, command.split(" ")[1])
                     else:
                         control_socket.send(b"530 Not allowed.\r\n")
                 else:
                     control_socket.send(b"530 Not logged in.\r\n")
             elif command.startswith("MKD"):
-                user_info = user_data[current_user]
-                role = user_info["role"]
                 if authenticated:
-                    if role != "user_lvl3" and role != "user_lvl2":
+                    if is_allowed(user_data[current_user]["role"], "MKD"):
                         self.handle_make_directory(control_socket, command.split(" ")[1])
                     else:
                         control_socket.send(b"530 Not allowed.\r\n")
@@ -169,20 +722,65 @@ class FTPServer:
                 else:
                     control_socket.send(b"530 Not logged in.\r\n")
             elif command.startswith("STOR"):
-                user_info = user_data[current_user]
-                role = user_info["role"]
                 if authenticated:
-                    if role != "user_lvl3" and role != "user_lvl2":
-                        self.handle_store(control_socket, command.split(" ")[1], command.split(" ")[2])
+                    if is_allowed(user_data[current_user]["role"], "STOR"):
+                        self.handle_store(control_socket, command.split(" ")[1], command.split(" ")[2], offset, z,
+                                          size, current_user)
                     else:
                         control_socket.send(b"530 Not allowed.\r\n")
                 else:
                     control_socket.send(b"530 Not logged in.\r\n")
+            elif command.startswith("MRET") or command.startswith("MSTR"):
+                verb = command[:4]
+                if authenticated:
+                    if not is_allowed(user_data[current_user]["role"], verb):
+                        control_socket.send(b"530 Not allowed.\r\n")
+                    elif verb == "MRET":
+                        self.handle_bulk_retrieve(control_socket, command.split(" ")[1:], current_user)
+                    else:
+                        self.handle_bulk_store(control_socket, command[4:].strip() or ".", current_user)
+                else:
+                    control_socket.send(b"530 Not logged in.\r\n")
+            elif command.startswith("RNFR") or command.startswith("RNTO") or command.startswith("COPY"):
+                verb = command[:4]
+                if authenticated:
+                    if not is_allowed(user_data[current_user]["role"], verb):
+                        control_socket.send(b"530 Not allowed.\r\n")
+                    elif verb == "RNFR":
+                        renaming = self.handle_rnfr(control_socket, command[4:].strip())
+                    elif verb == "RNTO":
+                        self.handle_rnto(control_socket, rename_from, command[4:].strip())
+                    else:
+                        self.handle_copy(control_socket, command[4:].strip())
+                else:
+                    control_socket.send(b"530 Not logged in.\r\n")
+            elif command.startswith("XSIG") or command.startswith("XDLT"):
+                verb = command[:4]
+                if authenticated:
+                    if not is_allowed(user_data[current_user]["role"], verb):
+                        control_socket.send(b"530 Not allowed.\r\n")
+                    elif verb == "XSIG":
+                        self.handle_signature(control_socket, command[4:].strip())
+                    else:
+                        self.handle_delta(control_socket, command.split(" ")[1], command.split(" ")[2])
+                else:
+                    control_socket.send(b"530 Not logged in.\r\n")
+            elif command.startswith("SITE"):
+                if authenticated:
+                    if is_allowed(user_data[current_user]["role"], "SITE"):
+                        self.handle_site(control_socket, command[4:].strip())
+                    else:
+                        control_socket.send(b"530 Not allowed.\r\n")
+                else:
+                    control_socket.send(b"530 Not logged in.\r\n")
+            elif command.startswith("STAT"):
+                if authenticated:
+                    self.handle_stat(control_socket, command[4:].strip())
+                else:
+                    control_socket.send(b"530 Not logged in.\r\n")
             elif command.startswith("RMD"):
-                user_info = user_data[current_user]
-                role = user_info["role"]
                 if authenticated:
-                    if role == "admin":
+                    if is_allowed(user_data[current_user]["role"], "RMD"):
                         self.handle_remove_directory(control_socket, command.split(" ")[1])
                     else:
                         control_socket.send(b"530 Not allowed.\r\n")
@@ -194,35 +792,179 @@ class FTPServer:
                 else:
                     control_socket.send(b"530 Not logged in.\r\n")
             elif command.startswith("QUIT"):
-                self.handle_quit(control_socket, client_address)
+                self.handle_quit(control_socket, context)
                 break
+            else:
+                control_socket.send(b"502 Command not implemented.\r\n")
+            self.record_command(command, time.perf_counter() - started, context)
 
         control_socket.close()
 
     def start(self):
         """Start the FTP server and handle multiple client connections."""
+        self.control_socket = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
+        if self.reuse_port:
+            self.control_socket.setsockopt(socket.SOL_SOCKET, socket.SO_REUSEPORT, 1)
+        self.control_socket.bind((self.host, self.port))
+        self.control_socket.listen(LISTEN_BACKLOG)
+        log.info("Server started at %s:%s", self.host, self.port)
+        if self.metrics_port:
+            metrics.serve_metrics(SERVER_HOST, self.metrics_port)
+        self.workers = ThreadPoolExecutor(max_workers=MAX_WORKERS, thread_name_prefix="ftp-session")
+        self.rejecter = ThreadPoolExecutor(max_workers=2, thread_name_prefix="ftp-reject")
         while True:
-            client_socket, client_address = self.control_socket.accept()
+            try:
+                client_socket, client_address = self.control_socket.accept()
+            except OSError as e:
+                # Out of file descriptors (EMFILE/ENFILE) or a connection reset before it was
+                # accepted: keep the accept loop alive
+                log.warning("accept() failed: %s", e)
+                if e.errno in (errno.EMFILE, errno.ENFILE, errno.ENOBUFS, errno.ENOMEM):
+                    time.sleep(ACCEPT_ERROR_BACKOFF)
+                continue
+            if self.admit_session():
+                self.workers.submit(self.serve_session, client_socket, client_address)
+            elif self.queue_rejection():
+                self.rejecter.submit(self.reject_session, client_socket)
+            else:
+                client_socket.close()
+
+    def queue_rejection(self):
+        """Reserve a place in the rejection backlog; False when MAX_PENDING_REJECTIONS are already waiting."""
+        with self.session_lock:
+            if self.pending_rejections >= MAX_PENDING_REJECTIONS:
+                return False
+            self.pending_rejections += 1
+            return True
+
+    def serve_session(self, client_socket, client_address):
+        """Run one client session on a pool thread: TLS handshake, then the command loop."""
+        try:
+            set_nodelay(client_socket)
+            client_socket.settimeout(HANDSHAKE_TIMEOUT)
+            started = time.perf_counter()
             client_socket = self.context.wrap_socket(client_socket, server_side=True)
-            client_thread = threading.Thread(target=self.handle_client, args=(client_socket, client_address))
-            client_thread.start()
+            metrics.tls_handshakes.observe(time.perf_counter() - started, "control")
+            client_socket.settimeout(CONTROL_IDLE_TIMEOUT)
+            self.handle_client(client_socket, client_address)
+        except (OSError, ssl.SSLError) as e:
+            log.warning("Session ended: %s", e, extra={"peer": f"{client_address[0]}:{client_address[1]}"})
+        except Exception:
+            # The pool discards the Future, so this is the only trace a bug in a handler leaves
+            log.exception("Session failed", extra={"peer": f"{client_address[0]}:{client_address[1]}"})
+        finally:
+            client_socket.close()
+            self.release_session(client_socket)
+
+    def reject_session(self, client_socket):
+        """Tell a client over the session limit to come back later."""
+        try:
+            client_socket.settimeout(HANDSHAKE_TIMEOUT)
+            client_socket = self.context.wrap_socket(client_socket, server_side=True)
+            client_socket.send(b"421 Too many connections, try again later.\r\n")
+        except (OSError, ssl.SSLError):
+            pass
+        finally:
+            client_socket.close()
+            with self.session_lock:
+                self.pending_rejections -= 1
 
     def handle_delete(self, control_socket, file_path):
         """Handle the DELE command to delete a file."""
         # Resolve the full file path
         file_full_path = BASE_DIR / file_path
 
-        with file_lock:
+        with path_locks.write(file_full_path):
             # Check if file exist
             if file_full_path.exists() and file_full_path.is_file():
                 try:
                     os.remove(file_full_path)  # Delete the file
+                    listing_cache.invalidate(file_full_path)
+                    digest_index.invalidate(file_full_path)
+                    file_cache.invalidate(file_full_path)
                     control_socket.send(b"250 File deleted successfully.\r\n")
                 except Exception as e:
                     control_socket.send(f"550 Access denied: {str(e)}\r\n".encode())
             else:
                 control_socket.send(b"550 File not found.\r\n")
 
+    def handle_rnfr(self, control_socket, path):
+        """Handle RNFR <path>: name the file or directory to rename; returns its full path for RNTO."""
+        full_path = BASE_DIR / path
+        if not full_path.exists():
+            control_socket.send(b"550 File not found.\r\n")
+            return None
+        control_socket.send(b"350 Ready for RNTO.\r\n")
+        return full_path
+
+    def handle_rnto(self, control_socket, source, path):
+        """Handle RNTO <path>: move the RNFR path there with os.replace.
+
+        The rename is atomic: a file already at the destination is replaced
+        in one step, and nothing is copied.
+        """
+        if source is None:
+            control_socket.send(b"503 RNFR required first.\r\n")
+            return
+        target = BASE_DIR / path
+        source_key, target_key = source.resolve(), target.resolve()
+        if source_key == target_key or source_key in target_key.parents or target_key in source_key.parents:
+            control_socket.send(b"553 Source and destination overlap.\r\n")
+            return
+
+        with lock_paths(path_locks, writes=(source, target)):
+            try:
+                os.replace(source, target)
+            except OSError as e:
+                control_socket.send(f"550 Rename failed: {e.strerror}\r\n".encode())
+                return
+            for changed in (source, target):
+                listing_cache.invalidate(changed, subtree=True)
+                digest_index.invalidate(changed, subtree=True)
+                file_cache.invalidate(changed, subtree=True)
+        control_socket.send(b"250 Rename successful.\r\n")
+
+    def handle_copy(self, control_socket, argument):
+        """Handle COPY <source> <destination>: copy a file on the server without sending it over the network.
+
+        The copy is a reflink or a kernel copy where the filesystem allows
+        (see transfer.copy_file), written to a temporary file and moved into
+        place, so the destination never holds a partial copy.
+        """
+        try:
+            source_path, target_path = argument.split(" ")
+        except ValueError:
+            control_socket.send(b"501 Syntax: COPY <source> <destination>\r\n")
+            return
+        source = BASE_DIR / source_path
+        target = BASE_DIR / target_path
+        if not source.is_file():
+            control_socket.send(b"550 File not found.\r\n")
+            return
+        if target.is_dir():
+            target = target / source.name
+        if source.resolve() == target.resolve():
+            control_socket.send(b"553 Source and destination are the same file.\r\n")
+            return
+
+        with lock_paths(path_locks, reads=(source,), writes=(target,)):
+            temp_path = None
+            try:
+                fd, temp_path = tempfile.mkstemp(dir=target.parent, prefix=f".{target.name}.", suffix=".copy")
+                with open(source, "rb") as src, os.fdopen(fd, "wb") as dst:
+                    size, method = copy_file(src, dst, TRANSFER_BUFFER_SIZE)
+                    os.chmod(temp_path, os.fstat(src.fileno()).st_mode & 0o7777)
+                os.replace(temp_path, target)
+            except OSError as e:
+                if temp_path and os.path.exists(temp_path):
+                    os.remove(temp_path)
+                control_socket.send(f"550 Copy failed: {e.strerror}\r\n".encode())
+                return
+            listing_cache.invalidate(target)
+            digest_index.invalidate(target)
+            file_cache.invalidate(target)
+        control_socket.send(f"250 Copied {size} bytes ({method}).\r\n".encode())
+
     def handle_make_directory(self, control_socket, directory_path):
         """Handle the MKD command to make directory."""
         # Resolve the directory path
@@ -230,88 +972,428 @@ class FTPServer:
 
         try:
             os.mkdir(full_path)
-            control_socket.send("257 Directory created successfully".encode())
+            listing_cache.invalidate(full_path)
+            control_socket.send(b"257 Directory created successfully.\r\n")
         except Exception as e:
             control_socket.send(f"550 Access denied: {str(e)}\r\n".encode())
 
-    def handle_store(self, control_socket, file_name, file_path="Uploads"):
-        """Handle the STOR command to receive and store a file from the client."""
+    def handle_rest(self, control_socket, offset):
+        """Handle the REST command; return the offset for the next RETR or STOR."""
+        if not offset.isdigit():
+            control_socket.send(b"501 REST requires a non-negative byte offset.\r\n")
+            return 0
+        control_socket.send(f"350 Restarting at {offset}. Send STOR or RETR to initiate transfer.\r\n".encode())
+        return int(offset)
+
+    def handle_rang(self, control_socket, byte_range):
+        """Handle the RANG command; return (offset, count) so the next RETR sends only that byte range."""
+        bounds = byte_range.split()
+        if len(bounds) != 2 or not all(bound.isdigit() for bound in bounds) or int(bounds[0]) > int(bounds[1]):
+            control_socket.send(b"501 RANG requires a start and an inclusive end byte offset.\r\n")
+            return 0, None
+        start, end = int(bounds[0]), int(bounds[1])
+        control_socket.send(f"350 Restarting at {start}. Ending at {end}.\r\n".encode())
+        return start, end - start + 1
+
+    def handle_allo(self, control_socket, argument):
+        """Handle ALLO <size> [R <record size>]: note the size of the next upload; returns it."""
+        try:
+            size = int(argument.split(" ")[0])
+        except ValueError:
+            control_socket.send(b"501 Syntax: ALLO <size>\r\n")
+            return None
+        if size < 0:
+            control_socket.send(b"501 Syntax: ALLO <size>\r\n")
+            return None
+        control_socket.send(f"200 ALLO {size} bytes noted.\r\n".encode())
+        return size
+
+    def handle_size(self, control_socket, file_path):
+        """Handle the SIZE command to return a file's size in bytes."""
+        file_full_path = BASE_DIR / file_path
+        if file_full_path.is_file():
+            control_socket.send(f"213 {file_full_path.stat().st_size}\r\n".encode())
+        else:
+            control_socket.send(b"550 File not found.\r\n")
+
+    def handle_mdtm(self, control_socket, file_path):
+        """Handle the MDTM command to return a file's modification time (UTC)."""
+        file_full_path = BASE_DIR / file_path
+        if file_full_path.is_file():
+            modify = time.strftime("%Y%m%d%H%M%S", time.gmtime(file_full_path.stat().st_mtime))
+            control_socket.send(f"213 {modify}\r\n".encode())
+        else:
+            control_socket.send(b"550 File not found.\r\n")
+
+    def handle_hash(self, control_socket, file_path, algorithm=DEFAULT_ALGORITHM, offset=0, count=None):
+        """Handle the HASH command: the digest of a file, or of the REST/RANG byte range before it.
+
+        Replies "213 <algorithm> <start>-<end> <digest> <path>".
+        """
+        file_full_path = BASE_DIR / file_path
+        if not file_full_path.is_file():
+            control_socket.send(b"550 File not found.\r\n")
+            return
+
+        with path_locks.read(file_full_path):
+            size = file_full_path.stat().st_size
+            if offset > size:
+                control_socket.send(b"554 Range starts beyond the end of the file.\r\n")
+                return
+            digest = digest_index.digest(file_full_path, algorithm, offset, count)
+
+        end = size if count is None else min(offset + count, size)
+        control_socket.send(f"213 {algorithm} {offset}-{max(offset, end - 1)} {digest} {file_path}\r\n".encode())
+
+    def handle_xhash(self, control_socket, algorithm, argument):
+        """Handle XCRC/XMD5 <path> [<start> [<end>]]: the older digest commands, with an inclusive end."""
+        parts = argument.split()
+        if not 1 <= len(parts) <= 3 or not all(part.isdigit() for part in parts[1:]):
+            control_socket.send(b"501 Usage: <path> [<start> [<end>]].\r\n")
+            return
+        offset = int(parts[1]) if len(parts) > 1 else 0
+        count = int(parts[2]) - offset + 1 if len(parts) > 2 else None
+        if count is not None and count < 0:
+            control_socket.send(b"501 The end of the range comes before its start.\r\n")
+            return
+
+        file_full_path = BASE_DIR / parts[0]
+        if not file_full_path.is_file():
+            control_socket.send(b"550 File not found.\r\n")
+            return
+        with path_locks.read(file_full_path):
+            digest = digest_index.digest(file_full_path, algorithm, offset, count)
+        control_socket.send(f"250 {digest}\r\n".encode())
+
+    def handle_opts_hash(self, control_socket, name, algorithm):
+        """Handle OPTS HASH [<algorithm>]; return the HASH algorithm now in effect."""
+        name = name.strip().upper()
+        if not name:
+            control_socket.send(f"200 {algorithm}\r\n".encode())
+            return algorithm
+        if name not in ALGORITHMS:
+            control_socket.send(f"501 Supported algorithms: {', '.join(ALGORITHMS)}.\r\n".encode())
+            return algorithm
+        control_socket.send(f"200 {name}\r\n".encode())
+        return name
+
+    def handle_mfmt(self, control_socket, argument):
+        """Handle the MFMT command ("MFMT YYYYMMDDHHMMSS path") to set a file's modification time (UTC)."""
+        modify, _, file_path = argument.partition(" ")
+        file_full_path = BASE_DIR / file_path
+        try:
+            mtime = calendar.timegm(time.strptime(modify, "%Y%m%d%H%M%S"))
+        except ValueError:
+            control_socket.send(b"501 MFMT requires a YYYYMMDDHHMMSS time and a path.\r\n")
+            return
+        if not file_full_path.is_file():
+            control_socket.send(b"550 File not found.\r\n")
+            return
+
+        os.utime(file_full_path, (mtime, mtime))
+        listing_cache.invalidate(file_full_path)
+        control_socket.send(f"213 Modify={modify}; {file_path}\r\n".encode())
+
+    def handle_store(self, control_socket, file_name, file_path="Uploads", offset=0, compression=None, size=None,
+                     user=None):
+        """Handle the STOR command to receive and store a file from the client.
+
+        The file is received into a temporary file (preallocated to `size`
+        from ALLO) and only replaces the target once complete; see
+        storage.Upload. With a REST offset the existing file is kept up to
+        `offset` and the upload is written into it from there on. In MODE Z
+        the 150 reply tells the client whether to compress. The transfer is
+        shaped under `user`'s limits.
+        """
         # Resolve the upload directory
         upload_dir = BASE_DIR / file_path
         upload_dir.mkdir(exist_ok=True)  # Ensure the directory exists
         # Construct the full file path
         file_path = upload_dir / file_name
 
-        # Find a free port for data transfer
-        port = self.find_free_port()
-
-        # Set up the data connection
-        data_socket = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
-        data_socket = self.context.wrap_socket(data_socket, server_side=True)
-        data_socket.bind((SERVER_HOST, port))
-        data_socket.listen(1)
-
-        # Send Passive Mode response with the free port
-        control_socket.send(f"227 Entering Passive Mode (127,0,0,1,{port // 256},{port % 256})\r\n".encode())
+        if offset and (not file_path.is_file() or file_path.stat().st_size < offset):
+            control_socket.send(b"554 Restart offset is beyond the end of the file.\r\n")
+            return
 
-        # Wait for the client to connect to the data port
-        data_conn, _ = data_socket.accept()
+        try:
+            upload = Upload(file_path, offset, size, self.fsync_policy)
+        except OSError as e:
+            control_socket.send(f"452 Cannot store file: {e.strerror}\r\n".encode())
+            return
 
-        # Send status code 150 to indicate transfer start
-        control_socket.send(b"150 Opening data connection.\r\n")
+        try:
+            # Set up the data connection
+            data_conn = self.open_data_channel(control_socket)
+            if data_conn is None:
+                return
 
-        # Open the file for writing and receive data
-        with file_lock:
-            with open(file_path, "wb") as f:
-                while True:
-                    data = data_conn.recv(BUFFER_SIZE)
-                    if not data:
-                        break
-                    f.write(data)
+            # Send status code 150 to indicate transfer start
+            compression = self.select_compression(file_name, compression)
+            control_socket.send(f"150 Opening data connection"
+                                f"{announce(compression[0]) if compression else ''}.\r\n".encode())
 
-        # Close the data connection
-        data_conn.close()
-        data_socket.close()
+            try:
+                # A resumed upload writes into the file itself and locks it throughout;
+                # a new one only takes the lock to swap the finished file in
+                with path_locks.write(file_path) if offset else nullcontext(), self.shaped(user, size) as channel, \
+                        metrics.transfer("STOR") as transfer:
+                    throttle = channel.throttle
+                    if compression:
+                        decompressor = Decompressor(compression[0])
+                        transfer.bytes = receive_compressed(data_conn, upload, TRANSFER_BUFFER_SIZE, decompressor,
+                                                            throttle=throttle)
+                        self.compression_stats.record(decompressor)
+                    else:
+                        transfer.bytes = receive_file(data_conn, upload, TRANSFER_BUFFER_SIZE, throttle=throttle)
+                    upload.finish()
+                with path_locks.write(file_path):
+                    upload.commit()
+                    listing_cache.invalidate(file_path)
+                    digest_index.invalidate(file_path)
+                    file_cache.invalidate(file_path)
+            except OSError as e:
+                control_socket.send(f"451 Upload aborted: {e}\r\n".encode())
+                return
+            finally:
+                # Close the data connection
+                self.close_data_channel(data_conn)
+        finally:
+            upload.discard()
 
         # Send status code 226 to indicate successful transfer
         control_socket.send(b"226 Transfer complete.\r\n")
 
-    def handle_retrieve(self, control_socket, file_path):
-        """Handle the RETR command to send a file to the client."""
+    def handle_retrieve(self, control_socket, file_path, offset=0, count=None, compression=None, user=None):
+        """Handle the RETR command to send a file to the client.
+
+        A REST offset starts the transfer part-way in; a RANG range also limits it to `count` bytes.
+        In MODE Z the data is compressed unless the file already is; the 150 reply says which.
+        The transfer is shaped under `user`'s limits.
+        """
         # Resolve the file path
         file_full_path = BASE_DIR / file_path
 
         if file_full_path.exists() and file_full_path.is_file():
-            # Find free port
-            port = self.find_free_port()
+            # Data connection using SSL protocol
+            data_conn = self.open_data_channel(control_socket)
+            if data_conn is None:
+                return
 
-            # Send Passive Mode response with the free port
-            control_socket.send(f"227 Entering Passive Mode (127,0,0,1,{port // 256},{port % 256})\r\n".encode())
+            compression = self.select_compression(file_full_path, compression)
+            control_socket.send(f"150 Opening data connection"
+                                f"{announce(compression[0]) if compression else ''}.\r\n".encode())
 
-            # Data connection using SSL protocol
-            data_socket = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
-            data_socket.bind((SERVER_HOST, port))
-            data_socket.listen(1)
-            data_socket = self.context.wrap_socket(data_socket, server_side=True)
+            # Hot files are sent from memory, everything else from disk
+            try:
+                with path_locks.read(file_full_path):
+                    data = self.hot_file(file_full_path)
+                    with io.BytesIO(data) if data is not None else open(file_full_path, "rb") as f:
+                        file_size = len(data) if data is not None else os.fstat(f.fileno()).st_size
+                        size = count if count is not None else file_size - offset
+                        with self.shaped(user, size) as channel, metrics.transfer("RETR") as transfer:
+                            throttle = channel.throttle
+                            if compression:
+                                compressor = Compressor(*compression)
+                                transfer.bytes = send_compressed(data_conn, f, TRANSFER_BUFFER_SIZE, compressor,
+                                                                 offset, count, throttle=throttle)
+                                self.compression_stats.record(compressor)
+                            elif data is not None:
+                                transfer.bytes = send_buffer(data_conn, data, TRANSFER_BUFFER_SIZE, offset, count,
+                                                             throttle)
+                            else:
+                                transfer.bytes = send_file(data_conn, f, TRANSFER_BUFFER_SIZE, offset, count,
+                                                           throttle=throttle)
+            finally:
+                # closing data connection
+                self.close_data_channel(data_conn)
+
+            control_socket.send(b"226 Transfer complete.\r\n")
+        else:
+            control_socket.send(b"550 File not found.\r\n")
+
+    def handle_bulk_retrieve(self, control_socket, paths, user=None):
+        """Handle MRET <path> [<path> ...]: send files and whole directories as one archive on one data connection."""
+        entries = collect_files(BASE_DIR, paths)
+        if not entries:
+            control_socket.send(b"550 No files found.\r\n")
+            return
+
+        data_conn = self.open_data_channel(control_socket)
+        if data_conn is None:
+            return
+        control_socket.send(f"150 Sending {len(entries)} files as an archive.\r\n".encode())
+
+        try:
+            with self.shaped(user) as channel, metrics.transfer("MRET") as transfer:
+                files, size = write_archive(data_conn, entries, TRANSFER_BUFFER_SIZE, path_locks.read,
+                                            channel.throttle)
+                transfer.bytes = size
+        finally:
+            self.close_data_channel(data_conn)
+        control_socket.send(f"226 Transfer complete: {files} files, {size} bytes.\r\n".encode())
 
-            # waiting for client connection
-            data_conn, _ = data_socket.accept()
+    def handle_bulk_store(self, control_socket, directory_path, user=None):
+        """Handle MSTR <directory>: unpack an archive from one data connection into the directory."""
+        target = BASE_DIR / directory_path
+        target.mkdir(parents=True, exist_ok=True)
 
-            control_socket.send(b"150 Opening data connection.\r\n")
+        data_conn = self.open_data_channel(control_socket)
+        if data_conn is None:
+            return
+        control_socket.send(b"150 Ready to receive archive.\r\n")
 
-            # opening file and sending
-            with file_lock:
+        try:
+            with self.shaped(user) as channel, metrics.transfer("MSTR") as transfer:
+                files, size = read_archive(data_conn, target, TRANSFER_BUFFER_SIZE, path_locks.write,
+                                           channel.throttle, self.fsync_policy)
+                transfer.bytes = size
+        except (OSError, ValueError) as e:
+            control_socket.send(f"451 Bulk transfer aborted: {e}\r\n".encode())
+            return
+        finally:
+            self.close_data_channel(data_conn)
+            listing_cache.invalidate(target, subtree=True)
+            digest_index.invalidate(target, subtree=True)
+            file_cache.invalidate(target, subtree=True)
+        control_socket.send(f"226 Transfer complete: {files} files, {size} bytes.\r\n".encode())
+
+    def handle_signature(self, control_socket, file_path):
+        """Handle XSIG <path>: send the block signature of a file, the first step of a delta upload."""
+        file_full_path = BASE_DIR / file_path
+        if not file_full_path.is_file():
+            control_socket.send(b"550 File not found.\r\n")
+            return
+
+        data_conn = self.open_data_channel(control_socket)
+        if data_conn is None:
+            return
+        control_socket.send(b"150 Sending signature.\r\n")
+
+        try:
+            with path_locks.read(file_full_path):
                 with open(file_full_path, "rb") as f:
-                    while chunk := f.read(BUFFER_SIZE):
-                        data_conn.send(chunk)
+                    block_size = block_size_for(os.fstat(f.fileno()).st_size)
+                    for chunk in iter_signature(f, block_size):
+                        data_conn.sendall(chunk)
+        finally:
+            self.close_data_channel(data_conn)
+        control_socket.send(b"226 Transfer complete.\r\n")
 
-            # closing data connection
-            data_conn.close()
-            data_socket.close()
+    def handle_delta(self, control_socket, file_name, file_path):
+        """Handle XDLT <file_name> <directory>: rebuild an existing file from a delta against its signature.
 
-            control_socket.send(b"226 Transfer complete.\r\n")
-        else:
+        The new version is assembled in a temporary file and swapped in only
+        once its SHA-256 matches, so a failed upload leaves the file as it was.
+        """
+        file_full_path = BASE_DIR / file_path / file_name
+        if not file_full_path.is_file():
             control_socket.send(b"550 File not found.\r\n")
+            return
+
+        data_conn = self.open_data_channel(control_socket)
+        if data_conn is None:
+            return
+        control_socket.send(b"150 Ready to receive delta.\r\n")
+
+        try:
+            with path_locks.write(file_full_path), metrics.transfer("XDLT") as transfer:
+                def read_exactly(n):
+                    transfer.bytes += n  # delta bytes on the wire, not the size of the rebuilt file
+                    return recv_exactly(data_conn, n)
+                size = apply_delta(read_exactly, file_full_path)
+                listing_cache.invalidate(file_full_path)
+                digest_index.invalidate(file_full_path)
+                file_cache.invalidate(file_full_path)
+        except (ConnectionError, ValueError) as e:
+            control_socket.send(f"451 Delta upload aborted: {e}\r\n".encode())
+            return
+        finally:
+            self.close_data_channel(data_conn)
+        control_socket.send(f"226 Transfer complete: {size} bytes.\r\n".encode())
+
+    def handle_site(self, control_socket, argument):
+        """Handle SITE LIMIT and SITE LIMITS: change and show the bandwidth limits at runtime.
+
+        SITE LIMIT GLOBAL <rate>, SITE LIMIT ROLE <role> <rate> and SITE LIMIT
+        USER <user> <rate> take bytes per second ("512K", "10M"; 0 removes the
+        limit). A new rate also applies to transfers already running under it.
+        Under --workers each worker shapes on its own, so SITE LIMIT is
+        refused there (see runtime_limits) and the limits come from the config.
+        SITE CACHE shows the counters of the listing, file and digest caches,
+        SITE METRICS every metric in the Prometheus text format.
+        """
+        words = argument.split()
+        subcommand = words[0].upper() if words else ""
+        if subcommand == "CACHE":
+            lines = []
+            for name, stats in (("listing", listing_cache.stats()), ("file", file_cache.stats()),
+                                ("digest", digest_index.stats())):
+                counters = ", ".join(f"{key} {value:.2f}" if isinstance(value, float) else f"{key} {value}"
+                                     for key, value in stats.items())
+                lines.append(f" {name}: {counters}")
+            control_socket.send(("211-Cache statistics:\r\n" + "\r\n".join(lines) + "\r\n211 End\r\n").encode())
+            return
+        if subcommand == "METRICS":
+            lines = [f" {line}" for line in metrics.registry.render().splitlines()]
+            control_socket.send(("211-Metrics:\r\n" + "\r\n".join(lines) + "\r\n211 End\r\n").encode())
+            return
+        if subcommand == "LIMITS":
+            stats = self.shaper.stats()
+            lines = [f" global {stats['global']}"]
+            lines += [f" role {role} {rate}" for role, rate in stats["roles"].items()]
+            lines += [f" user {user} {rate}" for user, rate in stats["users"].items()]
+            lines.append(f" active transfers {stats['active_transfers']}, throttled {stats['throttled_time']:.1f}s")
+            control_socket.send(("211-Transfer limits in bytes/s (0 = unlimited):\r\n"
+                                 + "\r\n".join(lines) + "\r\n211 End\r\n").encode())
+            return
+        if subcommand != "LIMIT" or len(words) < 3:
+            control_socket.send(b"501 Syntax: SITE LIMIT GLOBAL|ROLE|USER [<name>] <rate>, SITE LIMITS, "
+                                b"SITE CACHE or SITE METRICS\r\n")
+            return
+
+        if not runtime_limits:
+            control_socket.send(b"502 SITE LIMIT is not available with several worker processes.\r\n")
+            return
+        scope = words[1].lower()
+        names = {"role": {info["role"] for info in user_data.values()}, "user": set(user_data)}
+        if scope == "global" and len(words) == 3:
+            name = None
+        elif scope in names and len(words) == 4 and words[2] in names[scope]:
+            name = words[2]
+        else:
+            control_socket.send(b"501 Unknown limit; use GLOBAL, ROLE <role> or USER <user>.\r\n")
+            return
+        try:
+            rate = parse_rate(words[-1])
+        except ValueError:
+            control_socket.send(b"501 Invalid rate.\r\n")
+            return
+        self.shaper.set_limit(scope, name, rate)
+        control_socket.send(f"200 Limit set: {scope}{' ' + name if name else ''} {rate} bytes/s.\r\n".encode())
+
+    def handle_stat(self, control_socket, argument):
+        """Handle STAT without an argument: sessions, passive ports, transfers per command and command latencies.
+
+        Latency quantiles are estimated from the histogram buckets; SITE METRICS has the raw buckets.
+        """
+        if argument:
+            control_socket.send(b"504 STAT with a path is not supported; use LIST.\r\n")
+            return
+        sessions = self.session_stats()
+        lines = [f" {sessions['active']} sessions ({sessions['rejected']} rejected),"
+                 f" {metrics.data_channels.get()} data channels open"]
+        ports = self.data_ports.stats()
+        lines.append(f" Passive ports: {ports['in_use']} of {ports['size']} in use (peak {ports['peak_in_use']}),"
+                     f" {ports['exhaustions']} exhaustions, {ports['rejected_peers']} foreign connections refused")
+        for (command,), (transfers, seconds, *_) in sorted(metrics.transfer_duration.summary().items()):
+            size = metrics.transfer_bytes.get(command)
+            rate = size / seconds / 1024 / 1024 if seconds else 0.0
+            lines.append(f" {command}: {transfers} transfers, {size} bytes, {rate:.1f} MiB/s,"
+                         f" {metrics.transfer_failures.get(command)} failed")
+        for (command,), (calls, seconds, p50, p95, p99) in sorted(metrics.commands.summary().items()):
+            lines.append(f" {command}: {calls} commands, mean {seconds / calls * 1000:.2f} ms,"
+                         f" p50 {p50 * 1000:.2f} ms, p95 {p95 * 1000:.2f} ms, p99 {p99 * 1000:.2f} ms")
+        control_socket.send(("211-Server status:\r\n" + "\r\n".join(lines) + "\r\n211 End\r\n").encode())
 
     def handle_pwd(self, control_socket):
         """Handle the PWD command to return the current directory."""
@@ -365,27 +1447,57 @@ class FTPServer:
         dir_full_path = BASE_DIR / directory_path.strip("/")
 
         # Check if directory exists and remove it
-        with file_lock:
+        with path_locks.write(dir_full_path):
             if dir_full_path.exists() and dir_full_path.is_dir():
                 try:
                     shutil.rmtree(dir_full_path)  # Remove the directory
+                    listing_cache.invalidate(dir_full_path, subtree=True)
+                    digest_index.invalidate(dir_full_path, subtree=True)
+                    file_cache.invalidate(dir_full_path, subtree=True)
                     control_socket.send(b"250 Directory deleted successfully.\r\n")
                 except Exception as e:
                     control_socket.send(f"550 Cannot delete directory: {str(e)}\r\n".encode())
             else:
                 control_socket.send(b"550 Directory not found or cannot be deleted.\r\n")
 
-    def handle_quit(self, control_socket, client_address):
+    def handle_quit(self, control_socket, context):
         """Handle the QUIT command to disconnect the client."""
         try:
             control_socket.send(b"221 Goodbye.\r\n")
         except Exception as e:
-            print(f"Error while handling QUIT: {e}")
+            log.warning("Error while handling QUIT: %s", e, extra=context)
         finally:
             control_socket.close()
-            print(f"Connection closed with client{client_address}.")
+            log.info("Connection closed", extra=context)
+
 
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="TLS FTP server")
+    parser.add_argument("--engine", choices=["threads", "asyncio"], default="threads",
+                        help="thread-per-client server or a single asyncio event loop")
+    parser.add_argument("--workers", type=int, default=1,
+                        help="worker processes sharing the control port with SO_REUSEPORT "
+                             "(directory listings are then not cached)")
+    parser.add_argument("--fsync", choices=FSYNC_POLICIES, default=DEFAULT_FSYNC_POLICY,
+                        help="when uploads are forced to disk: never, when complete, or also periodically")
+    parser.add_argument("--metrics-port", type=int, default=METRICS_PORT,
+                        help="local port for GET /metrics (0: off); worker N of --workers uses the port + N")
+    parser.add_argument("--log-level", default=DEFAULT_LEVEL, choices=["DEBUG", "INFO", "WARNING", "ERROR"])
+    parser.add_argument("--log-format", choices=["json", "text"], default="json",
+                        help="JSON lines with session, user, command and duration fields, or plain text")
+    parser.add_argument("--log-sample", type=int, default=LOG_COMMAND_SAMPLE,
+                        help="log one in N commands (warnings and errors are always logged)")
+    args = parser.parse_args()
+    setup_logging(args.log_level, args.log_format == "json", args.log_sample)
 
-# Start the FTP Server
-ftp_server = FTPServer(SERVER_HOST, SERVER_PORT)
-ftp_server.start()
+    # Start the FTP Server
+    if args.workers > 1:
+        from supervisor import Supervisor
+        Supervisor(args.workers, args.engine, args.fsync, args.metrics_port).run()
+    elif args.engine == "asyncio":
+        from async_server import AsyncFTPServer
+        asyncio.run(AsyncFTPServer(SERVER_HOST, SERVER_PORT, fsync_policy=args.fsync,
+                                   metrics_port=args.metrics_port).start())
+    else:
+        ftp_server = FTPServer(SERVER_HOST, SERVER_PORT, fsync_policy=args.fsync, metrics_port=args.metrics_port)
+        ftp_server.start()
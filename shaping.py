@@ -0,0 +1,162 @@
+import re
+import threading
+import time
+from contextlib import contextmanager
+from decimal import Decimal
+
+# Seconds of traffic a user or role bucket may send at once after being idle
+BURST_SECONDS = 0.5
+# Transfers of at most this many bytes count as interactive and get a larger share
+INTERACTIVE_MAX_SIZE = 1024 * 1024
+INTERACTIVE_WEIGHT = 8
+
+RATE_SUFFIXES = {"K": 1024, "M": 1024 ** 2, "G": 1024 ** 3}
+RATE_PATTERN = re.compile(r"(\d+(?:\.\d+)?)([KMG]?)", re.ASCII)
+# Highest rate accepted (1 TiB/s); anything above is as good as unlimited
+MAX_RATE = 1024 ** 4
+
+
+def parse_rate(text):
+    """Parse a rate in bytes per second such as "500000", "512K" or "10M"; 0 means unlimited.
+
+    Raises ValueError for anything else, including "inf", "nan" and negative rates.
+    """
+    match = RATE_PATTERN.fullmatch(text.strip().upper())
+    if not match:
+        raise ValueError(f"Invalid rate: {text!r}")
+    number, suffix = match.groups()
+    rate = int(Decimal(number) * RATE_SUFFIXES.get(suffix, 1))
+    if rate > MAX_RATE:
+        raise ValueError(f"Rate above {MAX_RATE} bytes/s.")
+    return rate
+
+
+class TokenBucket:
+    """Token bucket of `rate` bytes per second holding up to `burst` bytes."""
+
+    def __init__(self, rate, burst=None):
+        self.updated = time.monotonic()
+        self.set_rate(rate, burst)
+
+    def set_rate(self, rate, burst=None):
+        self.rate = rate
+        self.burst = burst if burst is not None else rate * BURST_SECONDS
+        self.tokens = self.burst
+
+    def reserve(self, size, now):
+        """Take `size` tokens, going into debt if need be; return how long until the debt is paid off."""
+        self.tokens = min(self.burst, self.tokens + (now - self.updated) * self.rate)
+        self.updated = now
+        self.tokens -= size
+        return max(0.0, -self.tokens / self.rate)
+
+
+class Shaper:
+    """Bandwidth limits for data transfers: one global limit, one per role and one per user.
+
+    User and role limits are token buckets shared by all of that user's or
+    role's transfers. The global limit is split between the active
+    transfers in proportion to their weights (a virtual clock per transfer),
+    so one bulk upload cannot starve the rest: a short, interactive
+    transfer gets INTERACTIVE_WEIGHT times the share of a bulk one, and
+    whatever it leaves unused goes back to the bulk transfers as soon as it
+    ends. Limits can be changed while transfers are running.
+    """
+
+    def __init__(self, global_rate=0, role_rates=None, user_rates=None, role_weights=None):
+        self._lock = threading.Lock()
+        self.global_rate = global_rate
+        self.role_buckets = {role: TokenBucket(rate) for role, rate in (role_rates or {}).items() if rate}
+        self.user_buckets = {user: TokenBucket(rate) for user, rate in (user_rates or {}).items() if rate}
+        self.role_weights = dict(role_weights or {})
+        self.active = set()
+        self.total_weight = 0
+        self.throttled_time = 0.0
+
+    @property
+    def enabled(self):
+        """Whether any limit is set; while none is, transfers skip the shaper entirely."""
+        return bool(self.global_rate or self.role_buckets or self.user_buckets)
+
+    def set_limit(self, scope, name, rate):
+        """Set the limit of scope "global", "role" or "user" (`name` is the role or user); 0 removes it."""
+        with self._lock:
+            if scope == "global":
+                self.global_rate = rate
+                return
+            buckets = self.role_buckets if scope == "role" else self.user_buckets
+            if not rate:
+                buckets.pop(name, None)
+            elif name in buckets:
+                buckets[name].set_rate(rate)
+            else:
+                buckets[name] = TokenBucket(rate)
+
+    @contextmanager
+    def channel(self, user, role, size=None):
+        """Register a transfer of `size` bytes (None if unknown) for the duration of the block."""
+        weight = self.role_weights.get(role, 1)
+        if size is not None and size <= INTERACTIVE_MAX_SIZE:
+            weight *= INTERACTIVE_WEIGHT
+        channel = Channel(self, user, role, weight)
+        with self._lock:
+            self.active.add(channel)
+            self.total_weight += weight
+        try:
+            yield channel
+        finally:
+            with self._lock:
+                self.active.discard(channel)
+                self.total_weight -= weight
+
+    def delay(self, channel, size):
+        """Account `size` bytes sent by `channel`; return how long it should wait before sending more."""
+        with self._lock:
+            now = time.monotonic()
+            wait = 0.0
+            if self.global_rate:
+                share = self.global_rate * channel.weight / self.total_weight
+                channel.next_send = max(now, channel.next_send) + size / share
+                wait = channel.next_send - now
+            for bucket in (self.role_buckets.get(channel.role), self.user_buckets.get(channel.user)):
+                if bucket is not None:
+                    wait = max(wait, bucket.reserve(size, now))
+            self.throttled_time += wait
+            return wait
+
+    def stats(self):
+        """Return the current limits (bytes per second), active transfers and total time spent throttled."""
+        with self._lock:
+            return {
+                "global": self.global_rate,
+                "roles": {role: bucket.rate for role, bucket in self.role_buckets.items()},
+                "users": {user: bucket.rate for user, bucket in self.user_buckets.items()},
+                "active_transfers": len(self.active),
+                "throttled_time": self.throttled_time,
+            }
+
+
+class Channel:
+    """One shaped transfer; see Shaper.channel."""
+
+    def __init__(self, shaper, user, role, weight):
+        self.shaper = shaper
+        self.user = user
+        self.role = role
+        self.weight = weight
+        self.next_send = 0.0
+
+    def delay(self, size):
+        return self.shaper.delay(self, size)
+
+    def throttle(self, size):
+        """Blocking form for the threaded transfer loops: sleep off the delay for `size` bytes.
+
+        Returns at once while no limit is set, so it can be passed to every
+        transfer and still catches a limit set while the transfer runs.
+        """
+        if not self.shaper.enabled:
+            return
+        wait = self.delay(size)
+        if wait:
+            time.sleep(wait)
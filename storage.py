@@ -0,0 +1,160 @@
+import errno
+import os
+import queue
+import tempfile
+import threading
+import time
+from pathlib import Path
+
+# When an upload is forced to disk: never (left to the OS), once when it
+# completes, or also every FSYNC_INTERVAL seconds while it is written
+FSYNC_POLICIES = ("none", "close", "periodic")
+DEFAULT_FSYNC_POLICY = "close"
+FSYNC_INTERVAL = 1.0
+# Chunks received but not yet written; bounds the memory a slow disk can tie up
+WRITE_QUEUE_DEPTH = 32
+# Mode of an uploaded file that does not replace an existing one
+NEW_FILE_MODE = 0o644
+
+
+def preallocate(f, size):
+    """Reserve `size` bytes on disk for a file; return False where the filesystem cannot.
+
+    Running out of space raises OSError(ENOSPC) up front instead of part-way through an upload.
+    """
+    if not hasattr(os, "posix_fallocate"):
+        return False
+    try:
+        os.posix_fallocate(f.fileno(), 0, size)
+    except OSError as e:
+        if e.errno == errno.ENOSPC:
+            raise
+        return False
+    return True
+
+
+def fsync_directory(path):
+    """Make a rename inside a directory durable."""
+    try:
+        fd = os.open(path, os.O_RDONLY)
+    except OSError:
+        return  # directories cannot be opened on Windows
+    try:
+        os.fsync(fd)
+    finally:
+        os.close(fd)
+
+
+class WriteBehindFile:
+    """File-like writer that hands data to a background thread through a bounded queue.
+
+    write() returns once the data is queued, so receiving from the network
+    overlaps with writing to disk; it only waits when the queue is full. An
+    error in the writer thread is raised by the next write() or by drain().
+    """
+
+    def __init__(self, f, fsync_policy=DEFAULT_FSYNC_POLICY, depth=WRITE_QUEUE_DEPTH):
+        self.f = f
+        self.fsync_policy = fsync_policy
+        self._queue = queue.Queue(depth)
+        self._error = None
+        self._thread = threading.Thread(target=self._run, name="ftp-write-behind", daemon=True)
+        self._thread.start()
+
+    def _run(self):
+        last_sync = time.monotonic()
+        while (data := self._queue.get()) is not None:
+            if self._error is not None:
+                continue  # keep draining so write() never blocks on a dead writer
+            try:
+                self.f.write(data)
+                if self.fsync_policy == "periodic" and time.monotonic() - last_sync >= FSYNC_INTERVAL:
+                    self.f.flush()
+                    os.fsync(self.f.fileno())
+                    last_sync = time.monotonic()
+            except OSError as e:
+                self._error = e
+
+    def write(self, data):
+        if self._error is not None:
+            raise self._error
+        # The caller reuses its receive buffer, so queue a copy
+        self._queue.put(bytes(data))
+        return len(data)
+
+    def drain(self):
+        """Wait until everything queued is written and stop the writer thread."""
+        if self._thread.is_alive():
+            self._queue.put(None)
+            self._thread.join()
+        if self._error is not None:
+            raise self._error
+
+
+class Upload:
+    """Where a STOR writes its data.
+
+    A new upload goes to a temporary file next to the target, preallocated
+    to the size announced with ALLO, and `commit` moves it into place with
+    os.replace, so readers see the old file or the complete new one, never
+    a partial one. A resumed upload (REST offset) extends the target in place.
+    Disk writes happen on a write-behind thread (WriteBehindFile).
+    """
+
+    def __init__(self, path, offset=0, size=None, fsync_policy=DEFAULT_FSYNC_POLICY):
+        self.path = Path(path)
+        self.fsync_policy = fsync_policy
+        if offset:
+            self.temp_path = None
+            f = open(self.path, "r+b")
+            f.seek(offset)
+        else:
+            fd, self.temp_path = tempfile.mkstemp(dir=self.path.parent, prefix=f".{self.path.name}.", suffix=".part")
+            f = os.fdopen(fd, "wb")
+            try:
+                if size:
+                    preallocate(f, size)
+            except OSError:
+                f.close()
+                os.remove(self.temp_path)
+                raise
+        self.writer = WriteBehindFile(f, fsync_policy)
+        self.committed = False
+
+    def write(self, data):
+        return self.writer.write(data)
+
+    def finish(self):
+        """Write out everything received, drop unused preallocated space and fsync per the policy."""
+        self.writer.drain()
+        f = self.writer.f
+        f.truncate()
+        f.flush()
+        if self.fsync_policy != "none":
+            os.fsync(f.fileno())
+        f.close()
+
+    def commit(self):
+        """Move a finished new upload into place; the caller holds the target's write lock."""
+        if self.temp_path is not None:
+            try:
+                mode = os.stat(self.path).st_mode & 0o7777
+            except FileNotFoundError:
+                mode = NEW_FILE_MODE
+            os.chmod(self.temp_path, mode)
+            os.replace(self.temp_path, self.path)
+            if self.fsync_policy != "none":
+                fsync_directory(self.path.parent)
+        self.committed = True
+
+    def discard(self):
+        """Throw away an upload that was not committed; a resumed upload keeps what was written."""
+        if self.committed:
+            return
+        try:
+            self.writer.drain()
+        except OSError:
+            pass
+        self.writer.f.close()
+        if self.temp_path is not None and os.path.exists(self.temp_path):
+            os.remove(self.temp_path)
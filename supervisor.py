@@ -0,0 +1,161 @@
+import asyncio
+import logging
+import multiprocessing
+import os
+import signal
+import tempfile
+import time
+from pathlib import Path
+
+import logs
+import server
+from locks import InterProcessLockManager
+from storage import DEFAULT_FSYNC_POLICY
+
+# Lock files shared by all workers, and the pause before restarting a worker that died right away
+WORKER_LOCK_DIR = Path(tempfile.gettempdir()) / "ftp-server-locks"
+RESTART_BACKOFF = 1.0
+
+log = logging.getLogger("ftp.supervisor")
+
+
+def split_ports(ports, workers):
+    """Give each worker its own slice of the passive port range."""
+    ports = list(ports)
+    size = len(ports) // workers
+    return [ports[slot * size:(slot + 1) * size] for slot in range(workers)]
+
+
+class SharedUserSessions:
+    """Logged-in sessions per user, counted across all worker processes in shared memory.
+
+    Each worker slot has its own row of counters, so the sessions of a worker
+    that dies can be cleared before it is restarted.
+    """
+
+    def __init__(self, workers, users):
+        self.workers = workers
+        self.users = {name: index for index, name in enumerate(users)}
+        self.counts = multiprocessing.Array("i", workers * len(self.users))
+        self.slot = None  # set in each worker after the fork
+
+    def _index(self, slot, username):
+        return slot * len(self.users) + self.users[username]
+
+    def admit(self, username, limit):
+        """Count a login of `username` in this worker unless all workers together already have `limit`."""
+        with self.counts.get_lock():
+            if sum(self.counts[self._index(slot, username)] for slot in range(self.workers)) >= limit:
+                return False
+            self.counts[self._index(self.slot, username)] += 1
+            return True
+
+    def release(self, username):
+        with self.counts.get_lock():
+            self.counts[self._index(self.slot, username)] -= 1
+
+    def clear(self, slot):
+        """Forget the sessions of a worker that exited."""
+        with self.counts.get_lock():
+            for username in self.users:
+                self.counts[self._index(slot, username)] = 0
+
+
+def run_worker(engine, pasv_ports, fsync_policy=DEFAULT_FSYNC_POLICY, metrics_port=0, user_sessions=None):
+    """Serve clients in this process until it is killed."""
+    # Path locks and per-user session limits have to hold across processes, not just across threads
+    server.path_locks = InterProcessLockManager(WORKER_LOCK_DIR)
+    server.shared_user_sessions = user_sessions
+    server.runtime_limits = False
+    # A cached listing is only checked against its directory's mtime, which an in-place write in
+    # another worker (a resumed STOR, MFMT) leaves alone; so workers do not cache listings
+    server.listing_cache.max_dirs = 0
+
+    if engine == "asyncio":
+        from async_server import AsyncFTPServer
+        asyncio.run(AsyncFTPServer(server.SERVER_HOST, server.SERVER_PORT, reuse_port=True, pasv_ports=pasv_ports,
+                                   fsync_policy=fsync_policy, metrics_port=metrics_port).start())
+    else:
+        server.FTPServer(server.SERVER_HOST, server.SERVER_PORT, reuse_port=True, pasv_ports=pasv_ports,
+                         fsync_policy=fsync_policy, metrics_port=metrics_port).start()
+
+
+class Supervisor:
+    """Fork worker processes that all accept on the control port, and restart them when they die.
+
+    Each worker runs an ordinary FTPServer (or AsyncFTPServer) with its own
+    interpreter, so TLS and request handling spread across cores. The kernel
+    balances new control connections between workers via SO_REUSEPORT; data
+    connections go to the announcing worker because every worker leases from
+    a disjoint slice of PASV_PORT_RANGE.
+
+    Path locks and the per-user session limit are shared by the workers. The
+    other limits (MAX_SESSIONS, bandwidth shaping) and the caches are per
+    worker. The file cache and digest index check each file's size, mtime and
+    inode, so they stay correct when another worker changes a file; the
+    listing cache could not (see run_worker) and is off. Since a SITE LIMIT
+    would only reach one worker's shaper, workers refuse it; the configured
+    rates apply to each worker separately.
+    """
+
+    def __init__(self, workers, engine="threads", fsync_policy=DEFAULT_FSYNC_POLICY, metrics_port=0):
+        self.workers = workers
+        self.engine = engine
+        self.fsync_policy = fsync_policy
+        # Each worker keeps its own metrics and serves them on metrics_port + its slot
+        self.metrics_port = metrics_port
+        self.port_slices = split_ports(server.PASV_PORT_RANGE, workers)
+        self.user_sessions = SharedUserSessions(workers, server.user_data)
+        self.children = {}  # pid -> (slot, start time)
+        self.stopping = False
+
+    def spawn(self, slot):
+        pid = os.fork()
+        if pid == 0:
+            exit_code = 1
+            try:
+                signal.signal(signal.SIGTERM, signal.SIG_DFL)
+                signal.signal(signal.SIGINT, signal.default_int_handler)
+                logs.after_fork()
+                self.user_sessions.slot = slot
+                run_worker(self.engine, self.port_slices[slot], self.fsync_policy,
+                           self.metrics_port + slot if self.metrics_port else 0, self.user_sessions)
+                exit_code = 0
+            except KeyboardInterrupt:
+                exit_code = 0
+            finally:
+                os._exit(exit_code)
+        self.children[pid] = (slot, time.monotonic())
+        log.info("Worker %s started (pid %s)", slot, pid)
+
+    def stop(self, signum, frame):
+        self.stopping = True
+        for pid in self.children:
+            try:
+                os.kill(pid, signal.SIGTERM)
+            except ProcessLookupError:
+                pass
+
+    def run(self):
+        """Start every worker and keep them running until SIGTERM or Ctrl-C."""
+        signal.signal(signal.SIGTERM, self.stop)
+        signal.signal(signal.SIGINT, self.stop)
+        log.info("Supervisor starting %s %s workers on %s:%s", self.workers, self.engine, server.SERVER_HOST,
+                 server.SERVER_PORT)
+
+        for slot in range(self.workers):
+            self.spawn(slot)
+
+        while self.children:
+            pid, status = os.wait()
+            slot, started = self.children.pop(pid)
+            self.user_sessions.clear(slot)
+            if self.stopping:
+                continue
+
+            log.warning("Worker %s (pid %s) exited with status %s, restarting", slot, pid,
+                        os.waitstatus_to_exitcode(status))
+            # Don't spin if a worker keeps dying on startup
+            if time.monotonic() - started < RESTART_BACKOFF:
+                time.sleep(RESTART_BACKOFF)
+            self.spawn(slot)
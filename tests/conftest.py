@@ -0,0 +1,45 @@
+import sys
+from pathlib import Path
+
+import pytest
+
+sys.path.insert(0, str(Path(__file__).resolve().parent.parent))
+
+import bench
+import client
+
+
+@pytest.fixture(scope="session")
+def certificate(tmp_path_factory):
+    """A throwaway self-signed certificate and key shared by the test servers."""
+    return bench.make_certificate(tmp_path_factory.mktemp("tls"))
+
+
+@pytest.fixture(scope="session", params=["threads", "asyncio"])
+def ftp_server(request, tmp_path_factory, certificate):
+    """A loopback server of each engine in its own process (a bench.ServerProcess, plus its `root`)."""
+    workdir = tmp_path_factory.mktemp(request.param)
+    (workdir / "root").mkdir()
+    server = bench.ServerProcess(workdir, *certificate, request.param)
+    server.root = workdir / "root"
+    yield server
+    server.stop()
+
+
+@pytest.fixture
+def session(ftp_server, certificate, tmp_path, monkeypatch):
+    """A logged-in client whose working directory is an empty directory of its own on the server."""
+    monkeypatch.setattr(client, "CA_CERT", str(certificate[0]))
+    monkeypatch.setattr(client, "BASE_DIR", tmp_path / "local")
+    monkeypatch.setattr(client, "DOWNLOAD_DIR", tmp_path / "downloads")
+    client.BASE_DIR.mkdir()
+    remote = ftp_server.root / tmp_path.name
+    remote.mkdir()
+
+    ftp = client.FTPClient("127.0.0.1", ftp_server.port)
+    ftp.read_reply()
+    assert ftp.login(bench.USERNAME, bench.PASSWORD)
+    ftp.cwd(str(remote))
+    ftp.remote = remote
+    yield ftp
+    ftp.quit()
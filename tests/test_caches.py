@@ -0,0 +1,93 @@
+import os
+
+import client
+from digests import DEFAULT_ALGORITHM, hash_file
+
+
+def cache_stats(session):
+    """Return the server's SITE CACHE counters as {"listing" | "file" | "digest": {counter: value}}."""
+    reply = session.site("CACHE")
+    assert reply.startswith("211")
+    stats = {}
+    for line in reply.splitlines()[1:-1]:
+        name, counters = line.strip().split(": ", 1)
+        stats[name] = {key: float(value) for key, value in (counter.split(" ") for counter in counters.split(", "))}
+    return stats
+
+
+def upload(session, name, data):
+    (client.BASE_DIR / name).write_bytes(data)
+    session.store_file(name, ".")
+    assert (session.remote / name).read_bytes() == data
+
+
+def listing(session):
+    return {entry["name"]: int(entry["size"]) for entry in session.iter_mlsd(str(session.remote))
+            if entry["type"] == "file"}
+
+
+def test_digest_index_after_stor(session):
+    upload(session, "data.bin", os.urandom(100000))
+    assert session.hash("data.bin") == hash_file(session.remote / "data.bin", DEFAULT_ALGORITHM)
+    entries = cache_stats(session)["digest"]["entries"]
+
+    upload(session, "data.bin", os.urandom(100000))
+    assert cache_stats(session)["digest"]["entries"] == entries - 1
+    assert session.hash("data.bin") == hash_file(session.remote / "data.bin", DEFAULT_ALGORITHM)
+
+
+def test_digest_index_after_dele(session):
+    upload(session, "data.bin", os.urandom(100000))
+    assert session.hash("data.bin")
+    entries = cache_stats(session)["digest"]["entries"]
+
+    assert session.delete_file("data.bin").startswith("250")
+    assert cache_stats(session)["digest"]["entries"] == entries - 1
+    assert session.hash("data.bin") is None
+
+
+def test_listing_after_stor_dele_rnto(session):
+    upload(session, "a.bin", os.urandom(1000))
+    upload(session, "b.bin", os.urandom(2000))
+    assert listing(session) == {"a.bin": 1000, "b.bin": 2000}
+
+    invalidations = cache_stats(session)["listing"]["invalidations"]
+    # Overwritten in place the directory may keep its mtime, so only the invalidation keeps the size right
+    upload(session, "a.bin", os.urandom(3000))
+    assert listing(session) == {"a.bin": 3000, "b.bin": 2000}
+
+    assert session.rename("b.bin", "c.bin")[1].startswith("250")
+    assert listing(session) == {"a.bin": 3000, "c.bin": 2000}
+
+    assert session.delete_file("a.bin").startswith("250")
+    assert listing(session) == {"c.bin": 2000}
+    assert cache_stats(session)["listing"]["invalidations"] >= invalidations + 3
+
+
+def retrieve(session, name):
+    session.retrieve_file(name)
+    return (client.DOWNLOAD_DIR / name).read_bytes()
+
+
+def test_file_cache_after_stor_rnto_dele(session):
+    old, new, renamed = os.urandom(1000), os.urandom(1000), os.urandom(1000)
+    upload(session, "data.bin", old)
+    # Admitted to the cache on its second download, served from it on the third
+    for _ in range(3):
+        assert retrieve(session, "data.bin") == old
+    hits, invalidations = (cache_stats(session)["file"][key] for key in ("hits", "invalidations"))
+    assert hits >= 1
+
+    upload(session, "data.bin", new)
+    assert retrieve(session, "data.bin") == new
+    assert retrieve(session, "data.bin") == new
+
+    upload(session, "other.bin", renamed)
+    assert session.rename("other.bin", "data.bin")[1].startswith("250")
+    assert retrieve(session, "data.bin") == renamed
+    assert retrieve(session, "data.bin") == renamed
+
+    assert session.delete_file("data.bin").startswith("250")
+    session.retrieve_file("data.bin")
+    assert not (session.remote / "data.bin").exists()
+    assert cache_stats(session)["file"]["invalidations"] >= invalidations + 3
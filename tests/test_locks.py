@@ -0,0 +1,99 @@
+import threading
+
+import pytest
+
+import locks
+
+# How long a lock that should block is given to (wrongly) go through
+BLOCK_TIME = 0.2
+
+
+@pytest.fixture(params=["threads", "processes"])
+def manager(request, tmp_path):
+    """A PathLockManager, or an InterProcessLockManager with its lock files under `tmp_path`."""
+    if request.param == "threads":
+        return locks.PathLockManager()
+    if locks.fcntl is None:
+        pytest.skip("Inter-process path locks need fcntl.flock (POSIX only).")
+    return locks.InterProcessLockManager(tmp_path / "locks")
+
+
+def start(lock):
+    """Take `lock` (a manager.read/write block) in another thread that releases it at once.
+
+    Returns an event set once the lock was held, and the thread.
+    """
+    held = threading.Event()
+
+    def take():
+        with lock:
+            held.set()
+
+    thread = threading.Thread(target=take, daemon=True)
+    thread.start()
+    return held, thread
+
+
+def assert_blocked_until_release(holder, waiter):
+    """Check that `waiter` waits while `holder` is held and goes through once it is released."""
+    with holder:
+        held, thread = start(waiter)
+        assert not held.wait(BLOCK_TIME)
+    assert held.wait(5)
+    thread.join(5)
+
+
+def test_readers_share(manager, tmp_path):
+    path = tmp_path / "file"
+    with manager.read(path):
+        held, thread = start(manager.read(path))
+        assert held.wait(5)
+        thread.join(5)
+
+
+def test_writer_excludes_reader(manager, tmp_path):
+    path = tmp_path / "file"
+    assert_blocked_until_release(manager.write(path), manager.read(path))
+
+
+def test_reader_excludes_writer(manager, tmp_path):
+    path = tmp_path / "file"
+    assert_blocked_until_release(manager.read(path), manager.write(path))
+
+
+def test_writers_exclude_each_other(manager, tmp_path):
+    path = tmp_path / "file"
+    assert_blocked_until_release(manager.write(path), manager.write(path))
+
+
+def test_directory_writer_waits_for_reader_below(manager, tmp_path):
+    assert_blocked_until_release(manager.read(tmp_path / "dir" / "sub" / "file"), manager.write(tmp_path / "dir"))
+
+
+def test_directory_writer_blocks_readers_below(manager, tmp_path):
+    assert_blocked_until_release(manager.write(tmp_path / "dir"), manager.read(tmp_path / "dir" / "sub" / "file"))
+
+
+def test_siblings_are_independent(manager, tmp_path):
+    with manager.write(tmp_path / "dir" / "a"):
+        held, thread = start(manager.write(tmp_path / "dir" / "b"))
+        assert held.wait(5)
+        thread.join(5)
+
+
+def test_lock_paths_in_either_order(manager, tmp_path):
+    first, second = tmp_path / "a", tmp_path / "b"
+
+    def swap(reads, writes):
+        for _ in range(50):
+            with locks.lock_paths(manager, reads, writes):
+                pass
+
+    # Two sessions locking the same pair the other way round (RNTO a b, RNTO b a) must not deadlock
+    threads = [threading.Thread(target=swap, args=([first], [second]), daemon=True),
+               threading.Thread(target=swap, args=([second], [first]), daemon=True)]
+    for thread in threads:
+        thread.start()
+    for thread in threads:
+        thread.join(10)
+        assert not thread.is_alive()
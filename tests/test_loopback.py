@@ -0,0 +1,144 @@
+import os
+
+import client
+
+# Spans several TRANSFER_BUFFER_SIZE chunks and ends part-way into one
+FILE_SIZE = 3 * client.TRANSFER_BUFFER_SIZE + 12345
+
+
+def test_retrieve(session):
+    data = os.urandom(FILE_SIZE)
+    (session.remote / "data.bin").write_bytes(data)
+    session.retrieve_file("data.bin")
+    assert (client.DOWNLOAD_DIR / "data.bin").read_bytes() == data
+
+
+def test_store(session):
+    data = os.urandom(FILE_SIZE)
+    (client.BASE_DIR / "data.bin").write_bytes(data)
+    session.store_file("data.bin", ".")
+    assert (session.remote / "data.bin").read_bytes() == data
+    assert [path.name for path in session.remote.iterdir()] == ["data.bin"]
+
+
+def test_resume_retrieve(session):
+    data = os.urandom(FILE_SIZE)
+    (session.remote / "data.bin").write_bytes(data)
+    client.DOWNLOAD_DIR.mkdir()
+    (client.DOWNLOAD_DIR / "data.bin").write_bytes(data[:FILE_SIZE // 3])
+    session.retrieve_file("data.bin", resume=True)
+    assert (client.DOWNLOAD_DIR / "data.bin").read_bytes() == data
+
+
+def test_resume_store(session):
+    data = os.urandom(FILE_SIZE)
+    (client.BASE_DIR / "data.bin").write_bytes(data)
+    (session.remote / "data.bin").write_bytes(data[:FILE_SIZE // 3])
+    session.store_file("data.bin", ".", resume=True)
+    assert (session.remote / "data.bin").read_bytes() == data
+
+
+def test_retrieve_segmented(session):
+    data = os.urandom(4 * client.MIN_SEGMENT_SIZE + 12345)
+    (session.remote / "data.bin").write_bytes(data)
+    assert session.retrieve_file_segmented("data.bin", 4)
+    assert (client.DOWNLOAD_DIR / "data.bin").read_bytes() == data
+
+
+def test_retrieve_segmented_corrupt(session, monkeypatch):
+    retrieve_segment = client.FTPClient.retrieve_segment
+
+    def corrupt_segment(self, file_path, destination_path, start, end):
+        received = retrieve_segment(self, file_path, destination_path, start, end)
+        with open(destination_path, "r+b") as f:
+            f.seek(start)
+            f.write(bytes([f.read(1)[0] ^ 0xFF]))
+        return received
+
+    monkeypatch.setattr(client.FTPClient, "retrieve_segment", corrupt_segment)
+    (session.remote / "data.bin").write_bytes(os.urandom(2 * client.MIN_SEGMENT_SIZE))
+    # The sizes and modification time still match, only the digest gives the damage away
+    assert not session.retrieve_file_segmented("data.bin", 2)
+
+
+def test_mode_z(session):
+    text = b"".join(b"%d compressible log line\n" % i for i in range(100000))
+    (client.BASE_DIR / "log.txt").write_bytes(text)
+    session.set_mode("Z")
+    session.store_file("log.txt", ".")
+    assert (session.remote / "log.txt").read_bytes() == text
+
+    session.retrieve_file("log.txt")
+    assert (client.DOWNLOAD_DIR / "log.txt").read_bytes() == text
+    stats = session.compression_stats.stats()
+    assert stats["raw_bytes"] == 2 * len(text)
+    assert stats["wire_bytes"] < stats["raw_bytes"] / 4
+
+
+def test_mode_z_corrupt_upload(session, monkeypatch):
+    class Passthrough(client.Compressor):
+        """Sends the file as it is, so its bytes arrive as the compressed stream."""
+
+        def compress(self, data):
+            self.raw_bytes += len(data)
+            self.wire_bytes += len(data)
+            return bytes(data)
+
+        def flush(self):
+            return b""
+
+    monkeypatch.setattr(client, "Compressor", Passthrough)
+    (client.BASE_DIR / "bad.bin").write_bytes(b"not a zlib stream" * 1000)
+    session.set_mode("Z")
+    session.store_file("bad.bin", ".")
+    # The session carries on, and by the time it answers the next command the upload is discarded
+    assert session.control_connection("PWD").startswith("257")
+    assert list(session.remote.iterdir()) == []
+
+
+def test_delta(session):
+    old = os.urandom(4 * 1024 * 1024)
+    new = bytearray(old)
+    new[1000000:1000050] = os.urandom(50)
+    new[3000000:3000000] = b"inserted" * 100
+    (session.remote / "data.bin").write_bytes(old)
+    (client.BASE_DIR / "data.bin").write_bytes(new)
+    stats = session.store_file_delta("data.bin", ".")
+    assert (session.remote / "data.bin").read_bytes() == new
+    assert stats["matched"] > len(old) // 2
+    assert stats["literal"] < len(old) // 4
+
+
+def test_copy(session):
+    data = os.urandom(FILE_SIZE)
+    (session.remote / "data.bin").write_bytes(data)
+    assert session.copy("data.bin", "copy.bin").startswith("2")
+    assert (session.remote / "copy.bin").read_bytes() == data
+    assert (session.remote / "data.bin").read_bytes() == data
+
+
+def make_tree(root):
+    """Write a small directory tree of files of various sizes below `root`; return {relative path: data}."""
+    files = {}
+    for index in range(30):
+        name = ["", "a/", "a/b/"][index % 3] + f"file{index}.bin"
+        files[name] = os.urandom(index * 997)
+        (root / name).parent.mkdir(parents=True, exist_ok=True)
+        (root / name).write_bytes(files[name])
+    return files
+
+
+def test_bulk_retrieve(session):
+    files = make_tree(session.remote / "tree")
+    assert session.retrieve_files(["tree"]) == (len(files), sum(map(len, files.values())))
+    for name, data in files.items():
+        assert (client.DOWNLOAD_DIR / "tree" / name).read_bytes() == data
+
+
+def test_bulk_store(session):
+    files = make_tree(client.BASE_DIR / "tree")
+    assert session.store_files(["tree"], "uploads") == (len(files), sum(map(len, files.values())))
+    for name, data in files.items():
+        path = session.remote / "uploads" / "tree" / name
+        assert path.read_bytes() == data
+        assert path.stat().st_mtime_ns == (client.BASE_DIR / "tree" / name).stat().st_mtime_ns
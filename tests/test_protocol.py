@@ -0,0 +1,62 @@
+import pytest
+
+import protocol
+from protocol import ControlChannel
+
+
+class ChunkedSocket:
+    """Stands in for a socket whose recv returns the given chunks one by one, then b"" (closed)."""
+
+    def __init__(self, *chunks):
+        self.chunks = list(chunks)
+        self.sent = b""
+
+    def recv(self, size):
+        return self.chunks.pop(0) if self.chunks else b""
+
+    def sendall(self, data):
+        self.sent += data
+
+
+def test_pipelined_commands_in_one_segment():
+    sock = ChunkedSocket(b"USER admin\r\nPASS admin123\r\nPWD\r\n")
+    channel = ControlChannel(sock)
+    assert [channel.read_line() for _ in range(3)] == ["USER admin", "PASS admin123", "PWD"]
+    assert channel.read_line() is None
+
+
+def test_line_split_across_reads():
+    channel = ControlChannel(ChunkedSocket(b"RE", b"TR file", b".bin\r", b"\nNOOP\r\n"))
+    assert channel.read_line() == "RETR file.bin"
+    assert channel.read_line() == "NOOP"
+
+
+def test_bare_line_feed():
+    channel = ControlChannel(ChunkedSocket(b"NOOP\nPWD\r\n"))
+    assert channel.read_line() == "NOOP"
+    assert channel.read_line() == "PWD"
+
+
+def test_multiline_reply_split_across_reads():
+    channel = ControlChannel(ChunkedSocket(b"211-Features:\r\n MLSD\r", b"\n HASH\r\n211 E", b"nd\r\n200 OK\r\n"))
+    assert channel.read_reply() == "211-Features:\n MLSD\n HASH\n211 End"
+    assert channel.read_reply() == "200 OK"
+
+
+def test_reply_cut_short():
+    channel = ControlChannel(ChunkedSocket(b"211-Features:\r\n MLSD\r\n"))
+    with pytest.raises(ConnectionError):
+        channel.read_reply()
+
+
+def test_line_too_long():
+    chunks = protocol.MAX_LINE_LENGTH // protocol.RECV_SIZE + 2
+    channel = ControlChannel(ChunkedSocket(*[b"x" * protocol.RECV_SIZE] * chunks))
+    with pytest.raises(ConnectionError):
+        channel.read_line()
+
+
+def test_send_lines_in_one_write():
+    sock = ChunkedSocket()
+    ControlChannel(sock).send_lines(["RNFR a", "RNTO b"])
+    assert sock.sent == b"RNFR a\r\nRNTO b\r\n"
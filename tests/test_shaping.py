@@ -0,0 +1,70 @@
+import pytest
+
+import shaping
+from shaping import Shaper, parse_rate
+
+
+@pytest.mark.parametrize("text, rate", [
+    ("0", 0),
+    ("500000", 500000),
+    ("512K", 512 * 1024),
+    ("10m", 10 * 1024 ** 2),
+    ("1.5G", 3 * 1024 ** 3 // 2),
+    (" 2K ", 2048),
+    ("1024G", shaping.MAX_RATE),
+])
+def test_parse_rate(text, rate):
+    assert parse_rate(text) == rate
+
+
+@pytest.mark.parametrize("text", ["", "K", "-1", "-1M", "inf", "INF", "nan", "1e6", "1,5M", "10X", "1.5.2", "0x10",
+                                  "١٠", "1025G"])
+def test_parse_rate_rejects(text):
+    with pytest.raises(ValueError):
+        parse_rate(text)
+
+
+def test_disabled_without_limits():
+    shaper = Shaper()
+    assert not shaper.enabled
+    with shaper.channel("user1", "user") as channel:
+        assert channel.delay(10 ** 9) == 0.0
+
+
+def test_user_limit_after_burst():
+    shaper = Shaper(user_rates={"user1": 1000})
+    with shaper.channel("user1", "user") as channel:
+        # The first half second of traffic goes through at once, the rest waits at 1000 bytes/s
+        assert channel.delay(500) == 0.0
+        assert channel.delay(1000) == pytest.approx(1.0, abs=0.05)
+    with shaper.channel("user2", "user") as channel:
+        assert channel.delay(10 ** 6) == 0.0
+
+
+def test_role_limit_shared_by_users():
+    shaper = Shaper(role_rates={"user": 1000})
+    with shaper.channel("user1", "user") as first, shaper.channel("user2", "user") as second:
+        assert first.delay(500) == 0.0
+        assert second.delay(1000) == pytest.approx(1.0, abs=0.05)
+
+
+def test_global_limit_split_by_weight():
+    shaper = Shaper(global_rate=9000)
+    with shaper.channel("user1", "user", size=10 ** 9) as bulk, shaper.channel("user2", "user", size=1000) as small:
+        # The interactive transfer gets INTERACTIVE_WEIGHT (8) shares out of 9
+        assert bulk.delay(1000) == pytest.approx(1.0, abs=0.05)
+        assert small.delay(8000) == pytest.approx(1.0, abs=0.05)
+    with shaper.channel("user1", "user", size=10 ** 9) as bulk:
+        assert bulk.delay(9000) == pytest.approx(1.0, abs=0.05)
+
+
+def test_set_limit():
+    shaper = Shaper()
+    shaper.set_limit("user", "user1", 1000)
+    assert shaper.enabled
+    assert shaper.stats()["users"] == {"user1": 1000}
+    shaper.set_limit("user", "user1", 2000)
+    assert shaper.stats()["users"] == {"user1": 2000}
+    shaper.set_limit("user", "user1", 0)
+    shaper.set_limit("global", None, 0)
+    assert not shaper.enabled
@@ -0,0 +1,173 @@
+import os
+import ssl
+
+try:
+    import fcntl
+except ImportError:  # Windows: no reflinks, COPY uses a plain copy
+    fcntl = None
+
+# ioctl that makes a file share the extents of another (Btrfs, XFS, bcachefs)
+FICLONE = 0x40049409
+
+
+def can_sendfile(sock):
+    """Check whether file data can go from the page cache to the socket with os.sendfile."""
+    if not hasattr(os, "sendfile"):
+        return False
+    if not isinstance(sock, ssl.SSLSocket):
+        return True
+    # With kernel TLS (OP_ENABLE_KTLS, Python 3.12+) the kernel encrypts sendfile data itself
+    uses_ktls = getattr(getattr(sock, "_sslobj", None), "uses_ktls_for_send", None)
+    return bool(uses_ktls and uses_ktls())
+
+
+def send_file(sock, f, buffer_size, offset=0, count=None, hasher=None, throttle=None):
+    """Send `count` bytes (or the rest) of an open file from `offset`; return bytes sent.
+
+    A `hasher` (hashlib-style) is fed the data as it goes, which rules out
+    sendfile. A `throttle` is called with the size of each chunk sent (see
+    shaping.Channel.throttle); sendfile then goes one chunk at a time.
+    """
+    if hasher is None and can_sendfile(sock):
+        if throttle is None:
+            return sock.sendfile(f, offset, count)
+        sent = 0
+        while count is None or sent < count:
+            size = buffer_size if count is None else min(buffer_size, count - sent)
+            chunk = sock.sendfile(f, offset + sent, size)
+            if not chunk:
+                break
+            sent += chunk
+            throttle(chunk)
+        return sent
+
+    # Read into one reused buffer and send slices of it, no per-chunk bytes objects
+    buffer = bytearray(buffer_size)
+    view = memoryview(buffer)
+    f.seek(offset)
+    sent = 0
+    while count is None or sent < count:
+        size = buffer_size if count is None else min(buffer_size, count - sent)
+        read = f.readinto(view[:size])
+        if not read:
+            break
+        if hasher:
+            hasher.update(view[:read])
+        sock.sendall(view[:read])
+        sent += read
+        if throttle:
+            throttle(read)
+    return sent
+
+
+def send_buffer(sock, data, buffer_size, offset=0, count=None, throttle=None):
+    """Send `count` bytes (or the rest) of a file held in memory from `offset`; return bytes sent.
+
+    The data goes out as memoryview slices, without copies.
+    """
+    view = memoryview(data)[offset:None if count is None else offset + count]
+    for start in range(0, len(view), buffer_size):
+        chunk = view[start:start + buffer_size]
+        sock.sendall(chunk)
+        if throttle:
+            throttle(len(chunk))
+    return len(view)
+
+
+def send_compressed(sock, f, buffer_size, compressor, offset=0, count=None, hasher=None, throttle=None):
+    """Like send_file, but through a Compressor (MODE Z); return raw bytes read from the file."""
+    buffer = bytearray(buffer_size)
+    view = memoryview(buffer)
+    f.seek(offset)
+    sent = 0
+    while count is None or sent < count:
+        size = buffer_size if count is None else min(buffer_size, count - sent)
+        read = f.readinto(view[:size])
+        if not read:
+            break
+        if hasher:
+            hasher.update(view[:read])
+        data = compressor.compress(view[:read])
+        if data:
+            sock.sendall(data)
+            if throttle:
+                throttle(len(data))
+        sent += read
+    sock.sendall(compressor.flush())
+    return sent
+
+
+def receive_compressed(sock, f, buffer_size, decompressor, hasher=None, throttle=None):
+    """Like receive_file, but through a Decompressor (MODE Z); return raw bytes written."""
+    buffer = bytearray(buffer_size)
+    view = memoryview(buffer)
+    received = 0
+    while read := sock.recv_into(view):
+        for data in decompressor.iter_decompress(view[:read]):
+            if hasher:
+                hasher.update(data)
+            f.write(data)
+            received += len(data)
+        if throttle:
+            throttle(read)
+    decompressor.finish()
+    return received
+
+
+def receive_file(sock, f, buffer_size, count=None, hasher=None, throttle=None):
+    """Write data from a socket to an open file until EOF (or `count` bytes); return bytes received.
+
+    A `hasher` (hashlib-style) is fed the data as it is written; a `throttle` is called with the size of each chunk.
+    """
+    buffer = bytearray(buffer_size)
+    view = memoryview(buffer)
+    received = 0
+    while count is None or received < count:
+        size = buffer_size if count is None else min(buffer_size, count - received)
+        read = sock.recv_into(view[:size])
+        if not read:
+            break
+        if hasher:
+            hasher.update(view[:read])
+        f.write(view[:read])
+        received += read
+        if throttle:
+            throttle(read)
+    return received
+
+
+def copy_file(src, dst, buffer_size):
+    """Copy an open file into an empty one on the server's disk; return (bytes, method).
+
+    A reflink shares the data blocks and copies nothing; copy_file_range
+    copies inside the kernel (or server-side on network filesystems); only
+    when neither works does the data pass through a userspace buffer.
+    """
+    size = os.fstat(src.fileno()).st_size
+    if fcntl is not None:
+        try:
+            fcntl.ioctl(dst.fileno(), FICLONE, src.fileno())
+            return size, "reflink"
+        except OSError:
+            pass  # not supported by the filesystem, or across filesystems
+
+    copied = 0
+    if hasattr(os, "copy_file_range"):
+        try:
+            while copied < size:
+                n = os.copy_file_range(src.fileno(), dst.fileno(), size - copied, copied, copied)
+                if not n:
+                    break
+                copied += n
+            return copied, "copy_file_range"
+        except OSError:
+            if copied:
+                raise
+
+    buffer = bytearray(buffer_size)
+    view = memoryview(buffer)
+    src.seek(0)
+    while read := src.readinto(view):
+        dst.write(view[:read])
+        copied += read
+    return copied, "copy"